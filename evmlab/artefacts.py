@@ -0,0 +1,234 @@
+"""
+A compressed, content-addressed store for artefacts (failing tests, their traces, ...).
+
+Layout of a store directory:
+
+    index.jsonl            one json line per stored artefact: name, hash, size, stored (the
+                           compressed size) and time. Later lines for a name replace earlier ones
+    objects/ab/<hash>.gz   the content of each artefact, gzip-compressed, named by the sha256 of
+                           the uncompressed content, so that identical artefacts are stored once
+
+Artefacts are written and read as streams, so neither side holds a whole trace in memory.
+open_artefact opens an artefact by its old flat path (<store>/<name>), a gzip file or a plain
+file alike, so readers don't need to know how the artefacts were stored.
+"""
+import os, sys, io, json, gzip, time, shutil, fnmatch, hashlib, tempfile, threading, argparse, logging
+
+logger = logging.getLogger(__name__)
+
+INDEX = "index.jsonl"
+OBJECTS = "objects"
+GZIP_MAGIC = b"\x1f\x8b"
+# Compression of stored objects: zlib's default, a good deal faster than 9 for little less gain
+COMPRESSLEVEL = 6
+CHUNK = 1 << 20
+# Files which migrate leaves alone: append-only logs (like this index, or the signatures of the
+# fuzzer), and files which are being written
+MIGRATE_EXCLUDE = ("*.jsonl", "*.tmp")
+
+
+class ArtefactStore(object):
+    """ The artefacts in a store directory. put adds an artefact from bytes, a str or a file,
+    open returns a stream of its (decompressed) content """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = os.path.join(directory, INDEX)
+        self.entries = {}
+        self._indexSize = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, OBJECTS), exist_ok=True)
+        self.reload()
+
+    def reload(self):
+        """ Reads the index lines which were appended since the last reload, e.g. by another process """
+        with self._lock:
+            try:
+                with open(self.index, "rb") as f:
+                    f.seek(self._indexSize)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            # A partially written last line is read on the next reload
+            end = data.rfind(b"\n") + 1
+            self._indexSize = self._indexSize + end
+            for line in data[:end].decode().splitlines():
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["name"]] = entry
+                except (ValueError, KeyError):
+                    logger.warning("Skipping bad line in %s: %s" % (self.index, line.strip()))
+
+    def objectPath(self, digest):
+        return os.path.join(self.directory, OBJECTS, digest[:2], "%s.gz" % digest)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return sorted(self.entries)
+
+    def put(self, name, data=None, path=None):
+        """ Stores an artefact under name, from data (bytes or str) or the file at path.
+        Returns its index entry """
+        if path is not None:
+            with open(path, "rb") as src:
+                return self._put(name, src)
+        if isinstance(data, str):
+            data = data.encode()
+        return self._put(name, io.BytesIO(data))
+
+    def _put(self, name, src):
+        # The content is hashed while it's compressed into a temp file, which is then either
+        # moved into place, or dropped if the store has that content already
+        h = hashlib.sha256()
+        size = 0
+        (fd, tmpfile) = tempfile.mkstemp(dir=os.path.join(self.directory, OBJECTS), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=COMPRESSLEVEL,
+                                                          mtime=0) as out:
+                for chunk in iter(lambda: src.read(CHUNK), b""):
+                    h.update(chunk)
+                    size = size + len(chunk)
+                    out.write(chunk)
+            digest = h.hexdigest()
+            target = self.objectPath(digest)
+            if os.path.exists(target):
+                os.remove(tmpfile)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(tmpfile, target)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+        entry = {"name": name, "hash": digest, "size": size, "stored": os.path.getsize(target), "time": time.time()}
+        with self._lock:
+            self.entries[name] = entry
+            with open(self.index, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                self._indexSize = f.tell()
+        return entry
+
+    def open(self, name, mode="rb"):
+        """ Opens the artefact for streaming its content, in binary or text ("rt") mode """
+        entry = self.entries.get(name)
+        if entry is None:
+            self.reload()
+            entry = self.entries.get(name)
+        if entry is None:
+            raise FileNotFoundError("No artefact %s in %s" % (name, self.directory))
+        return gzip.open(self.objectPath(entry["hash"]), mode)
+
+    def extract(self, name, path):
+        """ Writes the content of the artefact to path, for readers which need a plain file """
+        with self.open(name) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK)
+
+    def summary(self):
+        """ The number of artefacts and distinct objects, and their total (compressed) size """
+        with self._lock:
+            objects = {entry["hash"]: entry for entry in self.entries.values()}
+            return {
+                "artefacts": len(self.entries),
+                "objects": len(objects),
+                "size": sum(entry["size"] for entry in self.entries.values()),
+                "stored": sum(entry["stored"] for entry in objects.values()),
+            }
+
+
+def is_store(directory):
+    return os.path.isfile(os.path.join(directory, INDEX))
+
+
+def _store_entry(path):
+    """ Returns (store, name) if path is an artefact in a store, otherwise None """
+    (directory, name) = os.path.split(os.path.abspath(path))
+    if not is_store(directory):
+        return None
+    store = ArtefactStore(directory)
+    if name not in store:
+        return None
+    return (store, name)
+
+
+def exists(path):
+    """ Whether path is a file, or an artefact in a store """
+    return os.path.isfile(path) or _store_entry(path) is not None
+
+
+def open_artefact(path, mode="rb"):
+    """ Opens an artefact for streaming: a plain file, a gzip file (decompressed), or an
+    artefact in a store, given as <store directory>/<name> """
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            compressed = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        if compressed:
+            return gzip.open(path, mode)
+        return open(path, mode)
+    found = _store_entry(path)
+    if found is None:
+        raise FileNotFoundError("No such artefact: %s" % path)
+    (store, name) = found
+    return store.open(name, mode)
+
+
+def local_file(path):
+    """ The path of a plain, uncompressed file with the content of the artefact, for readers which
+    need random access (e.g. binary traces, which are mmapped). Returns (path, temporary): if
+    temporary, the caller removes the file when done """
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+                return (path, False)
+    (fd, tmpfile) = tempfile.mkstemp(suffix="-%s" % os.path.basename(path))
+    with os.fdopen(fd, "wb") as dst, open_artefact(path) as src:
+        shutil.copyfileobj(src, dst, CHUNK)
+    return (tmpfile, True)
+
+
+def migrate(directory, keep=False, exclude=MIGRATE_EXCLUDE):
+    """ Moves the plain files of an artefacts directory into a store in that directory. Files
+    matching the exclude patterns and subdirectories are left alone. Returns the summary of the store """
+    store = ArtefactStore(directory)
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or any(fnmatch.fnmatch(name, pattern) for pattern in exclude):
+            continue
+        store.put(name, path=path)
+        if not keep:
+            os.remove(path)
+        logger.debug("Stored %s" % name)
+    return store.summary()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Manages compressed artefact stores (see evmlab.artefacts)')
+    commands = parser.add_subparsers(dest="command")
+    cmd = commands.add_parser("migrate", help="move the files of artefact directories into a store")
+    cmd.add_argument("--keep", action="store_true", help="keep the original files")
+    cmd.add_argument("-x", "--exclude", action="append",
+                     help="leave files matching this pattern alone (default: %s)" % ", ".join(MIGRATE_EXCLUDE))
+    cmd.add_argument("directories", nargs="+")
+    cmd = commands.add_parser("ls", help="list the artefacts of a store")
+    cmd.add_argument("directory")
+    cmd = commands.add_parser("cat", help="write artefacts to stdout, decompressed")
+    cmd.add_argument("paths", nargs="+", help="<store directory>/<name>, or a (gzip) file")
+    args = parser.parse_args(args)
+
+    if args.command == "migrate":
+        for directory in args.directories:
+            summary = migrate(directory, keep=args.keep, exclude=args.exclude or MIGRATE_EXCLUDE)
+            logger.info("Migrated %s: %d artefacts, %d objects, %d -> %d bytes" % (
+                directory, summary["artefacts"], summary["objects"], summary["size"], summary["stored"]))
+    elif args.command == "ls":
+        store = ArtefactStore(args.directory)
+        for name in store.names():
+            entry = store.entries[name]
+            print("%10d %10d %s %s" % (entry["size"], entry["stored"], entry["hash"][:16], name))
+    elif args.command == "cat":
+        for path in args.paths:
+            with open_artefact(path) as f:
+                shutil.copyfileobj(f, sys.stdout.buffer, CHUNK)
+    else:
+        parser.print_help()
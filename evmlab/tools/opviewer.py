@@ -12,6 +12,8 @@ from evmlab.context import buildContexts
 from evmlab.contract import Contract
 from evmlab import reproduce, utils
 from evmlab import vm as VMUtils
+from evmlab import tracefile
+from evmlab import artefacts
 from evmlab.opcodes import reverse_opcodes
 
 logger = logging.getLogger(__name__)
@@ -40,6 +42,36 @@ class SourceException(Exception):
     pass
 
 
+class BinaryTraceOps(object):
+    """Presents a binary trace (see evmlab.tracefile) as a list of geth-style ops.
+    The ops are only decoded when accessed, so large traces can be browsed without loading them."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def _op(self, step):
+        return {
+            'pc': step.pc,
+            'op': step.op,
+            'opName': step.opname,
+            'gas': step.gas,
+            'depth': step.depth + 1,
+            'stack': list(step.stack),
+        }
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        return self._op(self.reader[index])
+
+    def __iter__(self):
+        for step in self.reader.steps():
+            yield self._op(step)
+
+
 class Console:
 
     @staticmethod
@@ -877,11 +909,24 @@ class EvmTrace(object):
         return self
 
     def load_trace_file(self, path):
-        if not os.path.isfile(path):
+        # The trace may be compressed, or in an artefact store (see evmlab.artefacts)
+        if not artefacts.exists(path):
             raise Exception("%s - is not a file" % path)
 
         logger.debug("loading trace file: %s" % path)
-        with open(path) as f:
+        with artefacts.open_artefact(path) as f:
+            binary = f.read(len(tracefile.MAGIC)) == tracefile.MAGIC
+        if binary:
+            # Binary traces are mmapped, so they need a plain file
+            (local, temporary) = artefacts.local_file(path)
+            self.ops = BinaryTraceOps(tracefile.TraceReader(local))
+            if temporary:
+                # The mapping stays valid after the file is removed
+                os.remove(local)
+            logger.debug("trace loaded (binary trace, %d steps)." % len(self.ops))
+            return self
+
+        with artefacts.open_artefact(path, "rt") as f:
             #
             # 1) try json tracefile
             #
@@ -1,4 +1,5 @@
 import random
+from types import SimpleNamespace
 import evmdasm
 import evmcodegen
 from evmcodegen.codegen import Rnd
@@ -118,11 +119,33 @@ class RndCodeSmart2(_RndCodeBase):
 
     # analyzed based on statedump.json
 
-    def generate(self, length=None):
-        # override this in here to adjust weights
+    # multipliers for the likelyhood of opcodes in the distribution {opcode: factor}, see set_opcode_weights
+    _opcode_weights = None
+    _weighted_distribution = None
+
+    def set_opcode_weights(self, weights):
+        self._opcode_weights = weights
+        self._weighted_distribution = None
+
+    def distribution(self):
         distribution = getattr(evmcodegen.distributions,
                                 self._config_get("engine.RndCodeSmart2.distribution", ""),
                                 evmcodegen.distributions.EVM_CATEGORY)
+        if not self._opcode_weights:
+            return distribution
+        if self._weighted_distribution is None:
+            weighted = lambda d: {op: p * self._opcode_weights.get(op, 1) for op, p in d.items()}
+            self._weighted_distribution = SimpleNamespace(min=distribution.min,
+                                                          max=distribution.max,
+                                                          avg=distribution.avg,
+                                                          distribution=weighted(distribution.distribution),
+                                                          distribution_prolog=weighted(distribution.distribution_prolog),
+                                                          distribution_epilog=weighted(distribution.distribution_epilog))
+        return self._weighted_distribution
+
+    def generate(self, length=None):
+        # override this in here to adjust weights
+        distribution = self.distribution()
 
         if length is None:
             length = distribution.avg
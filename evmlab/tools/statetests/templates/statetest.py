@@ -53,6 +53,7 @@ class StateTestTemplate(object):
 
         # other
         self._fill_counter = 0  # track how often we've filled from this template
+        self.main_codegen = None  # name of the engine that generated the code of tx.to
 
         ### info
         self._info = SimpleNamespace(fuzzer="evmlab",
@@ -120,21 +121,25 @@ class StateTestTemplate(object):
                 logger.debug("autofill from tx.to - not renewing prestate due to prestate.txto.renew.every.x.rounds")
                 return
 
-        # force renewal of prestate
-        self._autofill_prestate(tx.to, force=True)
+        # force renewal of prestate, remember which engine generated the code the tx runs (none,
+        # if tx.to is a precompile or not a state account)
+        codegen = self._autofill_prestate(tx.to, force=True)
+        self.main_codegen = type(codegen).__name__ if codegen is not None else None
 
         return self
 
     def _autofill_prestate(self, address, force=False):
+        """ Adds a random prestate for the address. Returns the code generator which generated its
+        code, or None if no prestate was added """
         logger.debug("autofill prestate")
         if address in self.pre and not force:
             # already there
             logger.debug("autofill prestate - skipping address already exists (and not using force)")
-            return self
+            return None
 
         if address.replace("0x","") not in rndval.RndAddress.addresses[rndval.RndAddressType.SENDING_ACCOUNT]+rndval.RndAddress.addresses[rndval.RndAddressType.STATE_ACCOUNT]:
             # skip non state accounts
-            return self
+            return None
         # not a precompiled address?
         # add a random prestate for the address we interact with in the tx
         ### random code
@@ -151,12 +156,13 @@ class StateTestTemplate(object):
         else:
             codelength = None
 
+        codegen = self.pick_codegen()
         self.add_prestate(address="0x%s"%address.replace("0x",""),
-                          code=self.pick_codegen().generate(length=codelength),  # limit length, main code is in first prestate
+                          code=codegen.generate(length=codelength),  # limit length, main code is in first prestate
                           storage=self._random_storage(_min=self._config_getint("prestate.storage.random.slots.min",0),
                                                        _max=self._config_getint("prestate.storage.random.slots.max",2)))
 
-        return self
+        return codegen
 
     def _autofill_prestates_from_stack_arguments(self, tx):
         # todo: hacky hack
@@ -299,6 +305,12 @@ class StateTestTemplate(object):
             if addr not in self._pre or force:
                 self.add_prestate(address=addr, balance="0x01", code="")
 
+    def reweight_codegens(self, weighted_codegens):
+        # change the weights of the existing codegen instances, without resetting them
+        self._codegenerators_weighted = WeightedRandomizer(
+            {self._codegenerators[engine]: weight for engine, weight in weighted_codegens.items()
+             if engine in self._codegenerators})
+
     def pick_codegen(self, name=None):
         if name:
             return self._codegenerators[name]
@@ -0,0 +1,314 @@
+"""
+A compact binary format for canonical traces.
+
+Layout (little-endian), all sections 8-byte aligned:
+
+    header    "EVMLTRCE" (8 bytes), version (u32), reserved (u32)
+    pc        u32 per step
+    op        u8  per step
+    depth     u16 per step
+    gas       u64 per step
+    digest    u64 per step, the StackDigest of the stack
+    stacks    the stack-delta stream: per step, u16 'kept' (the number of items kept from
+              the stack of the previous step), u16 'pushed', followed by 'pushed' 32-byte
+              big-endian words. Every CHECKPOINT steps the full stack is stored (kept = 0)
+    index     u64 per step, the offset of the step's entry in the stack-delta stream
+    records   json: the non-step records (e.g. stateRoot), as [[position, record], ...]
+    footer    number of steps, section offsets, records length, "EVMLTRCE"
+
+The columns are accessed through memoryviews on an mmap of the file, so reading
+step N does not copy or parse anything else than step N.
+"""
+import os, sys, json, mmap, struct, array, argparse, logging
+
+from . import opcodes
+from . import vm as VMUtils
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EVMLTRCE"
+VERSION = 1
+# How often the full stack is stored, which bounds the replay needed for random access
+CHECKPOINT = 256
+
+_HEADER = struct.Struct("<8sII")
+# steps, offsets of pc, op, depth, gas, digest, stacks, index, records, records length, magic
+_FOOTER = struct.Struct("<QQQQQQQQQQ8s")
+_DELTA = struct.Struct("<HH")
+_MAX_GAS = 2**64 - 1
+
+
+class TraceFileError(Exception):
+    pass
+
+
+def is_trace_file(path):
+    """ Returns true if the file at path is a binary trace """
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def _columns():
+    return {
+        "pc": array.array("I"),
+        "op": array.array("B"),
+        "depth": array.array("H"),
+        "gas": array.array("Q"),
+        "digest": array.array("Q"),
+        "index": array.array("Q"),
+    }
+
+
+class TraceWriter(object):
+    """ Writes canonical steps (and records, such as the stateRoot) to a binary trace file.
+
+    The columns are collected in memory (23 bytes per step, plus the stack-deltas), and
+    written out when the writer is closed.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise TraceFileError("binary traces are only supported on little-endian hosts")
+        self.path = path
+        self.columns = _columns()
+        self.stacks = bytearray()
+        self.records = []
+        self.count = 0
+        self._stack = []
+        self._depth = None
+        self._op = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _kept(self, step):
+        """ The number of items the stack of this step shares with the previous one """
+        if self.count % CHECKPOINT == 0 or step.depth != self._depth:
+            return 0
+        info = opcodes.opcodes.get(self._op)
+        if info is None:
+            return 0
+        kept = len(self._stack) - info[1]
+        if kept < 0 or kept > step.stack_size or step.stack[:kept] != self._stack[:kept]:
+            return 0
+        return kept
+
+    def write(self, step):
+        if not isinstance(step, VMUtils.Step):
+            self.records.append([self.count, step])
+            return
+        if step.gas > _MAX_GAS:
+            raise TraceFileError("gas value %d does not fit in a binary trace" % step.gas)
+
+        stack = list(step.stack)
+        kept = self._kept(step)
+        pushed = stack[kept:]
+
+        cols = self.columns
+        cols["pc"].append(step.pc)
+        cols["op"].append(step.op)
+        cols["depth"].append(step.depth)
+        cols["gas"].append(step.gas)
+        cols["digest"].append(step.stack_digest)
+        cols["index"].append(len(self.stacks))
+
+        self.stacks += _DELTA.pack(kept, len(pushed))
+        for item in pushed:
+            self.stacks += int(item, 16).to_bytes(32, "big")
+
+        self._stack = stack
+        self._depth = step.depth
+        self._op = step.op
+        self.count += 1
+
+    def close(self):
+        if self.columns is None:
+            return
+
+        def pad(f):
+            f.write(b"\0" * (-f.tell() % 8))
+
+        with open(self.path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0))
+            offsets = []
+            for name in ("pc", "op", "depth", "gas", "digest"):
+                pad(f)
+                offsets.append(f.tell())
+                self.columns[name].tofile(f)
+            pad(f)
+            offsets.append(f.tell())
+            f.write(self.stacks)
+            pad(f)
+            offsets.append(f.tell())
+            self.columns["index"].tofile(f)
+            records = json.dumps(self.records).encode()
+            offsets.append(f.tell())
+            f.write(records)
+            f.write(_FOOTER.pack(self.count, *offsets, len(records), MAGIC))
+        self.columns = None
+
+
+def record(steps, path):
+    """ Passes the canonical steps through, while writing them to a binary trace at path.
+    The file is written once the steps are exhausted """
+    with TraceWriter(path) as writer:
+        for step in steps:
+            writer.write(step)
+            yield step
+
+
+def write_trace(steps, path):
+    """ Writes canonical steps to a binary trace at path, returns the number of steps """
+    with TraceWriter(path) as writer:
+        for step in steps:
+            writer.write(step)
+        return writer.count
+
+
+class TraceReader(object):
+    """ Reads a binary trace through mmap.
+
+    The columns (pc, op, depth, gas, digest) are exposed as memoryviews, and can be indexed
+    directly. Indexing the reader returns the Step at that position, with its stack. Iterating
+    over it yields all Steps, followed by the records (stateRoot etc.), just like a canonicalizer.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise TraceFileError("binary traces are only supported on little-endian hosts")
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise TraceFileError("%s is not a binary trace (empty file)" % path)
+        size = len(self._mmap)
+        if size < _HEADER.size + _FOOTER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise TraceFileError("%s is not a binary trace" % path)
+
+        footer = _FOOTER.unpack_from(self._mmap, size - _FOOTER.size)
+        if footer[-1] != MAGIC:
+            self.close()
+            raise TraceFileError("%s is truncated" % path)
+        (n, o_pc, o_op, o_depth, o_gas, o_digest, o_stacks, o_index, o_records, records_len, _) = footer
+        self.count = n
+
+        view = memoryview(self._mmap)
+        self.pc = view[o_pc:o_pc + 4 * n].cast("I")
+        self.op = view[o_op:o_op + n].cast("B")
+        self.depth = view[o_depth:o_depth + 2 * n].cast("H")
+        self.gas = view[o_gas:o_gas + 8 * n].cast("Q")
+        self.digest = view[o_digest:o_digest + 8 * n].cast("Q")
+        self.index = view[o_index:o_index + 8 * n].cast("Q")
+        self._stacks = view[o_stacks:o_index]
+        self.records = json.loads(bytes(view[o_records:o_records + records_len]).decode())
+        view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for name in ("pc", "op", "depth", "gas", "digest", "index", "_stacks"):
+            v = getattr(self, name, None)
+            if v is not None:
+                v.release()
+                setattr(self, name, None)
+        if getattr(self, "_mmap", None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def _delta(self, n):
+        """ Returns (kept, pushed items) of the stack-delta of step n """
+        offset = self.index[n]
+        (kept, num) = _DELTA.unpack_from(self._stacks, offset)
+        offset += _DELTA.size
+        pushed = []
+        for i in range(num):
+            start = offset + 32 * i
+            pushed.append('0x{0:01x}'.format(int.from_bytes(self._stacks[start:start + 32], "big")))
+        return (kept, pushed)
+
+    def stack(self, n):
+        """ Reconstructs the stack of step n, by replaying the deltas from the nearest full stack """
+        start = n
+        while start > 0 and _DELTA.unpack_from(self._stacks, self.index[start])[0] != 0:
+            start -= 1
+        stack = []
+        for i in range(start, n + 1):
+            (kept, pushed) = self._delta(i)
+            stack = stack[:kept] + pushed
+        return stack
+
+    def _step(self, n, stack):
+        return VMUtils.Step(self.pc[n], self.op[n], self.gas[n], self.depth[n], stack, self.digest[n])
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.count
+        if not 0 <= n < self.count:
+            raise IndexError("step %d out of range" % n)
+        return self._step(n, self.stack(n))
+
+    def steps(self):
+        """ Yields all Steps, in order """
+        stack = []
+        for n in range(self.count):
+            (kept, pushed) = self._delta(n)
+            stack = stack[:kept] + pushed
+            yield self._step(n, stack)
+
+    def __iter__(self):
+        records = iter(self.records)
+        pending = next(records, None)
+        for n, step in enumerate(self.steps()):
+            while pending is not None and pending[0] <= n:
+                yield pending[1]
+                pending = next(records, None)
+            yield step
+        while pending is not None:
+            yield pending[1]
+            pending = next(records, None)
+
+
+canonicalizers = {
+    "geth": VMUtils.GethVM.canonicalized,
+    "cpp": VMUtils.CppVM.canonicalized,
+    "py": VMUtils.PyVM.canonicalized,
+    "parity": VMUtils.ParityVM.canonicalized,
+    "hera": VMUtils.HeraVM.canonicalized,
+}
+
+
+def convert(infile, outfile, client):
+    """ Converts a client trace (e.g. geth or parity std-json) into a binary trace """
+    with open(infile) as f:
+        return write_trace(canonicalizers[client](f), outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts client traces into binary evmlab traces')
+    parser.add_argument("-c", "--client", choices=sorted(canonicalizers.keys()), default="geth",
+                        help="The client which produced the trace(s) (default: geth)")
+    parser.add_argument("files", nargs="+", help="trace files, the output is written to <file>.bin")
+    args = parser.parse_args()
+
+    for path in args.files:
+        outfile = "%s.bin" % path
+        num = convert(path, outfile, args.client)
+        logger.info("Converted %s -> %s (%d steps, %d -> %d bytes)" %
+                    (path, outfile, num, os.path.getsize(path), os.path.getsize(outfile)))
@@ -1,4 +1,4 @@
-import os, signal, json, itertools, traceback, sys
+import os, signal, json, itertools, traceback, sys, collections, importlib, threading
 from subprocess import Popen, PIPE, TimeoutExpired
 import platform
 import logging
@@ -12,11 +12,42 @@ FNULL = open(os.devnull, 'w')
 
 valid_opcodes = opcodes.reverse_opcodes.keys()
 
+# geth and parity std-json steps for STOP start with {"pc":<pc>,"op":0, -- those are skipped without decoding them
+STOP_MARKER = '"op":0,'
+STOP_MARKER_END = 32
+
 # The 'stateRoot' comparison can be disabled, in which case
 # the analysis will check only the internal states after every 
 # opcode, but ignore the poststate roothash
 INCLUDE_STATEROOT=True
 
+# The canonicalizers decode one json-object per trace line, which is where most of their
+# time goes. The decoder is pluggable: the stdlib json is always available, and faster
+# backends are used if they are installed. The first one available is the default
+JSON_DECODERS = collections.OrderedDict()
+for _name in ("orjson", "ujson", "rapidjson"):
+    try:
+        JSON_DECODERS[_name] = importlib.import_module(_name).loads
+    except ImportError:
+        pass
+JSON_DECODERS["json"] = json.loads
+
+json_decode = json.loads
+
+def set_json_decoder(name=None):
+    """ Sets the json decoder used by the canonicalizers, by name (e.g. 'json' for the stdlib decoder).
+    If no name is given, the fastest installed one is used. Returns the name of the decoder
+    """
+    global json_decode
+    if name is None:
+        name = next(iter(JSON_DECODERS))
+    if name not in JSON_DECODERS:
+        raise ValueError("Json decoder %s not available, choose one of %s" % (name, ", ".join(JSON_DECODERS)))
+    json_decode = JSON_DECODERS[name]
+    return name
+
+set_json_decoder()
+
 strip_0x = remove_0x_head
 bstrToInt = lambda b_str: int(b_str.replace("b", "").replace("'", ""))
 bstrToHex = lambda b_str: '0x{0:01x}'.format(bstrToInt(b_str))
@@ -32,11 +63,180 @@ def toHexQuantities(vals):
     """ Formats a list of values into a list of hex-encoded values """
     return ['0x{0:01x}'.format(parse_int_or_hex(val)) for val in vals]
 
+def trimHex(val):
+    """ Removes leading zeroes from a hex-value, '0x000a' -> '0xa' """
+    if val[:3] != "0x0" or len(val) < 4:
+        return val
+    return "0x" + (val[2:].lstrip("0") or "0")
+
+def toInt(val):
+    """ Converts an int, hex- or decimal string into an int """
+    if isinstance(val, int):
+        return val
+    if val[:2] == "0x":
+        return int(val, 16)
+    return int(val)
+
+class StackDigest(object):
+    """ An incremental digest of a client's stack.
+
+    The digest is a polynomial hash over the stack items, bottom-up, so the digest of every
+    prefix of the stack is kept around. Between two steps, the stack changes according to the
+    pop/push counts of the previous opcode (see opcodes.opcodes): the popped prefixes are
+    dropped, and only the pushed items are hashed. The model is checked against the reported
+    stack; if it does not fit, e.g. after an exceptional halt, the digest is rebuilt from the
+    reported stack.
+
+    With verify (the default), the check compares the size and all the items which were not
+    touched, so that a client which corrupts an item deeper down (e.g. a broken SWAPn) still
+    gets a different digest. That is a list comparison of O(depth) per step, though no items
+    are parsed or hashed. Without verify, only the size and the topmost untouched item are
+    compared, which is O(1) per step, and trusts the client with the rest of the stack.
+    utilities/canon_benchmark.py measures both on deep stacks.
+
+    Frames of calling contexts are kept aside while a call executes, and resumed when it returns.
+    """
+    MODULUS = 2**61 - 1
+    BASE = 0x100000001b3
+
+    def __init__(self, verify=True):
+        self.verify = verify
+        self.depth = None
+        self.last_op = None
+        self.items = []
+        self.prefix = [0]
+        self.callers = []
+
+    @staticmethod
+    def digest(stack):
+        """ The (non-incremental) digest of a stack of hex-values """
+        h = 0
+        for item in stack:
+            h = (h * StackDigest.BASE + int(item, 16) + 1) % StackDigest.MODULUS
+        return h
+
+    def _push(self, items):
+        prefix = self.prefix
+        h = prefix[-1]
+        base, modulus = StackDigest.BASE, StackDigest.MODULUS
+        for item in items:
+            h = (h * base + int(item, 16) + 1) % modulus
+            prefix.append(h)
+        self.items.extend(items)
+
+    def _rebuild(self, stack):
+        self.items = []
+        self.prefix = [0]
+        self._push(stack)
+
+    def update(self, op, depth, stack):
+        """ Updates the digest with the (reported) stack of the next step, and returns the digest """
+        if self.depth is not None and depth > self.depth:
+            # Entered a call, keep the calling frame aside until it returns
+            self.callers.append((self.items, self.prefix, self.last_op))
+            self.items, self.prefix, self.last_op = [], [0], None
+        elif self.depth is not None and depth < self.depth:
+            for _ in range(self.depth - depth):
+                if not self.callers:
+                    self.last_op = None
+                    break
+                (self.items, self.prefix, self.last_op) = self.callers.pop()
+
+        info = opcodes.opcodes.get(self.last_op)
+        if info is None:
+            self._rebuild(stack)
+        else:
+            kept = len(self.items) - info[1]
+            if self.verify:
+                fits = stack[:kept] == self.items[:kept]
+            else:
+                fits = kept == 0 or stack[kept-1] == self.items[kept-1]
+            if kept >= 0 and len(stack) == kept + info[2] and fits:
+                del self.items[kept:]
+                del self.prefix[kept+1:]
+                self._push(stack[kept:])
+            else:
+                self._rebuild(stack)
+
+        self.last_op = op
+        self.depth = depth
+        return self.prefix[-1]
+
+
+class Step(object):
+    """ A compact canonical trace step, as emitted by the canonicalizers.
+
+    Steps are compared by (pc, op, gas, depth, stack size, stack digest). The canonicalizers
+    pass in the digest from a StackDigest, so the full stacks never need to be compared. The
+    reported stack itself is only referenced, to render the steps of a failure report.
+    """
+    __slots__ = ("pc", "op", "gas", "depth", "stack_size", "stack_digest", "stack")
+
+    def __init__(self, pc, op, gas, depth, stack, stack_digest=None):
+        self.pc = pc
+        self.op = op
+        self.gas = gas
+        self.depth = depth
+        self.stack_size = len(stack)
+        if stack_digest is None:
+            stack_digest = StackDigest.digest(stack)
+        self.stack_digest = stack_digest
+        self.stack = stack
+
+    def key(self):
+        return (self.pc, self.op, self.gas, self.depth, self.stack_size, self.stack_digest)
+
+    def __eq__(self, other):
+        if not isinstance(other, Step):
+            return False
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key())
+
+    @property
+    def opname(self):
+        if self.op in opcodes.opcodes:
+            return opcodes.opcodes[self.op][0]
+        return "UNKNOWN"
+
+    def text(self):
+        stack = list(self.stack)
+        if self.stack_size > 6:
+            stack = "... {}".format(stack[-4:])
+        return "pc {:>5} op {:>10}({:>3}) gas {:>8} depth {:>2} stack {}".format(
+            self.pc, self.opname, self.op, '0x{0:01x}'.format(self.gas), self.depth, stack)
+
+    def __repr__(self):
+        return self.text()
+
+# CALL, CALLCODE, DELEGATECALL and STATICCALL, with the callee as the second stack item
+CALL_OPS = (0xf1, 0xf2, 0xf4, 0xfa)
+# Calls to addresses up to this one count as precompile hits
+MAX_PRECOMPILE = 0x10
+
+
 class Stats():
-    def __init__(self):
+    """ Statistics about a trace, gathered while it is read (see traceStats).
+
+    With coverage set, the coverage features of the trace are collected as well, in features.
+    These are tuples of
+        ("bigram", op, op):     two consecutive ops
+        ("depth", op, bucket):  an op at a call depth, bucketed by bit length (0, 1, 2-3, 4-7, 8+)
+        ("precompile", op, address): a call to a precompile
+        ("exit", op):           the last op of a call frame. STOPs are not in the canonical trace,
+                                so anything but RETURN, REVERT and SELFDESTRUCT means the frame
+                                either stopped, or ran into an error (e.g. out of gas)
+    """
+    def __init__(self, coverage=False):
         self.maxdepth= 0
         self.numConstantinople = 0
         self.stopped = False
+        self.features = set() if coverage else None
+        self._previous = None
 
     def traceStats(self, canon_trace):
         """traceStats returns some statistics about the trace"""
@@ -48,6 +248,16 @@ class Stats():
                 yield step
                 continue
 
+            if isinstance(step, Step):
+                if step.depth > self.maxdepth:
+                    self.maxdepth = step.depth
+                if step.op in [0x1b, 0x1c, 0x1d, 0x3F,0xF5]:
+                    self.numConstantinople = self.numConstantinople + 1
+                if self.features is not None:
+                    self._cover(step)
+                yield step
+                continue
+
             if "depth" in step.keys() and int(step['depth']) > self.maxdepth:
                 self.maxdepth = int(step['depth'])
             if "op" in step:
@@ -55,6 +265,23 @@ class Stats():
                     self.numConstantinople = self.numConstantinople + 1
             yield step
 
+        if self.features is not None and not self.stopped and self._previous is not None:
+            # The end of the outermost frame
+            self.features.add(("exit", self._previous.op))
+
+    def _cover(self, step):
+        previous = self._previous
+        if previous is not None:
+            self.features.add(("bigram", previous.op, step.op))
+            if step.depth < previous.depth:
+                self.features.add(("exit", previous.op))
+        self.features.add(("depth", step.op, min(step.depth.bit_length(), 4)))
+        if step.op in CALL_OPS and len(step.stack) > 1:
+            callee = int(step.stack[-2], 16)
+            if 0 < callee <= MAX_PRECOMPILE:
+                self.features.add(("precompile", step.op, callee))
+        self._previous = step
+
     def stop(self):
         self.stopped = True
 
@@ -66,6 +293,8 @@ class Stats():
 
 
 def toText(op):
+    if isinstance(op, Step):
+        return op.text()
     if len(op.keys()) == 0:
         return "END"
     if 'pc' in op.keys():
@@ -99,6 +328,28 @@ def toText(op):
         return fmt.format(**op)
     return "N/A"
 
+def withoutStacks(steps):
+    """ Drops the stacks from canonical steps, to compare traces of clients which were run
+    without stack output (e.g. geth --nostack) """
+    for step in steps:
+        if isinstance(step, Step):
+            yield Step(step.pc, step.op, step.gas, step.depth, [])
+        else:
+            yield step
+
+def _rootHex(root):
+    """ Formats a state root the same for all clients: lowercase, without 0x """
+    root = root.lower()
+    if root[:2] == "0x":
+        return root[2:]
+    return root
+
+def _stepText(step):
+    """ Renders a canonical step (or a step which is already text) for the trace output """
+    if step is None or isinstance(step, str):
+        return step
+    return toText(step)
+
 def compare_traces(clients_canon_traces, names):
 
     """ Compare 'canonical' traces from the clients"""
@@ -119,17 +370,157 @@ def compare_traces(clients_canon_traces, names):
                 wrong_clients.append(i)
 
         if step_equiv == True:
-            log('[*] {:>8} {}'.format("", step[0]))
+            log('[*] {:>8} {}'.format("", _stepText(step[0])))
         else:
             equivalent = False
             for i in range(0, num_clients):
                 if i in wrong_clients or len(wrong_clients) == num_clients-1:
-                    log('[!!] {:>7} {}'.format(names[i], step[i]))
+                    log('[!!] {:>7} {}'.format(names[i], _stepText(step[i])))
                 else:
-                    log('[*] {:>8} {}'.format(names[i], step[i]))
+                    log('[*] {:>8} {}'.format(names[i], _stepText(step[i])))
 
     return (equivalent, full_output)
 
+# The verdicts of trace_verdict
+PASS = "pass"
+DIVERGED = "diverged"
+TRUNCATED = "truncated"
+
+def _differing_fields(a, b):
+    """ The fields in which two steps differ """
+    if a is None or b is None:
+        # One of the traces ended
+        return {"missing"}
+    if not isinstance(a, Step) or not isinstance(b, Step):
+        # e.g. a stateRoot record
+        return {"record"}
+    fields = {name for name in ("pc", "op", "gas", "depth") if getattr(a, name) != getattr(b, name)}
+    if a.stack_size != b.stack_size or a.stack_digest != b.stack_digest:
+        fields.add("stack")
+    return fields
+
+
+def divergence_signature(step, names, previous=None):
+    """ The signature of a divergence, which identifies the bug behind it rather than the test:
+    failures with the same signature are most likely the same bug.
+
+    step is the first differing step (a step per client), previous the step before it. The
+    signature contains the op of the step, and the op before it (the gas of a step is the gas
+    left after the previous op), its call depth, the fields which differ, and the clients,
+    grouped by the step they agree on.
+    """
+    groups = []
+    for (name, s) in zip(names, step):
+        for group in groups:
+            if group[0] == s:
+                group[1].append(name)
+                break
+        else:
+            groups.append((s, [name]))
+    fields = set()
+    for (s, _) in groups[1:]:
+        fields.update(_differing_fields(groups[0][0], s))
+    first = next((s for s in step if isinstance(s, Step)), None)
+    before = previous[0] if previous is not None else None
+    return {
+        "op": first.opname if first is not None else None,
+        "previous": before.opname if isinstance(before, Step) else None,
+        "depth": first.depth if first is not None else None,
+        "fields": sorted(fields),
+        "clients": sorted(sorted(clients) for (_, clients) in groups),
+    }
+
+
+def signature_key(signature):
+    """ A short, readable key for a divergence signature """
+    return "{} after {} depth {}: {} differ between {}".format(
+        signature["op"], signature["previous"], signature["depth"], ",".join(signature["fields"]),
+        " / ".join(",".join(group) for group in signature["clients"]))
+
+
+def trace_verdict(clients_canon_traces, names, max_steps=None, n=20, window=5, cut=None):
+
+    """ Compare 'canonical' traces from the clients, without materializing them.
+
+    The traces are consumed step by step, so generators can be passed directly. Only
+    the last n steps are kept around, and text is only produced if a difference is found.
+    Reading stops 'window' steps after the first diff, or after max_steps equivalent steps.
+    The caller can then stop the clients, since the rest of their traces is not needed.
+
+    cut tells per client whether its output was cut off before the end (e.g. at an output limit).
+    Such a trace may end before the others without being wrong, and it has no post-state.
+
+    returns (verdict, summary), where the verdict is PASS, DIVERGED or TRUNCATED (the step budget
+    was hit without a diff, or a cut off trace ended without a diff before). The summary is empty
+    unless the traces diverged, and otherwise contains (up to) n preceding steps before the first
+    diff, and the diff-section
+    """
+    (verdict, summary, _) = trace_divergence(clients_canon_traces, names, max_steps, n, window, cut)
+    return (verdict, summary)
+
+
+def trace_divergence(clients_canon_traces, names, max_steps=None, n=20, window=5, cut=None):
+
+    """ Like trace_verdict, but also returns the divergence_signature of the first diff.
+
+    returns (verdict, summary, signature), the signature is None unless the traces diverged
+    """
+    from collections import deque
+    num_clients = len(names)
+    preceding = deque([], n)
+    diff_section = []
+    first_diff = None
+
+    for index, step in enumerate(itertools.zip_longest(*clients_canon_traces)):
+        if first_diff is None and max_steps is not None and index >= max_steps:
+            # Steps past the budget are not compared
+            return (TRUNCATED, [], None)
+        wrong_clients = [i for i in range(1, num_clients) if step[i] != step[0]]
+        if first_diff is None:
+            if len(wrong_clients) == 0:
+                # Only the raw steps are kept, formatting is deferred until we know there's a diff
+                preceding.append(step)
+                continue
+            first_diff = index
+        diff_section.append((step, wrong_clients))
+        if len(diff_section) >= window:
+            break
+
+    if first_diff is None:
+        return (TRUNCATED if cut and any(cut) else PASS, [], None)
+    if cut and any(c and s is None for (c, s) in zip(cut, diff_section[0][0])):
+        # The first diff is where a cut off trace ends, not a difference between the clients
+        return (TRUNCATED, [], None)
+
+    signature = divergence_signature(diff_section[0][0], names, preceding[-1] if preceding else None)
+    summary = ['[*] {:>8} {}'.format("", _stepText(step[0])) for step in preceding]
+    summary.append("\n---- [ %d steps in total before diff ]-------\n\n" % first_diff)
+    for (step, wrong_clients) in diff_section:
+        if len(wrong_clients) == 0:
+            summary.append('[*] {:>8} {}'.format("", _stepText(step[0])))
+            continue
+        for i in range(0, num_clients):
+            if i in wrong_clients or len(wrong_clients) == num_clients-1:
+                summary.append('[!!] {:>7} {}'.format(names[i], _stepText(step[i])))
+                # The text only shows the top of the stack, so show the full stacks of the diff
+                if isinstance(step[i], Step) and step[i].stack_size > 6:
+                    summary.append('{:>13} full stack {}'.format("", list(step[i].stack)))
+            else:
+                summary.append('[*] {:>8} {}'.format(names[i], _stepText(step[i])))
+
+    return (DIVERGED, summary, signature)
+
+
+def compare_traces_streaming(clients_canon_traces, names, n=20, window=5):
+
+    """ Like trace_verdict, without step budget.
+
+    returns (equivalent, summary), where summary is empty if the traces are equivalent,
+    and otherwise contains (up to) n preceding steps before the first diff, and the diff-section
+    """
+    (verdict, summary) = trace_verdict(clients_canon_traces, names, n=n, window=window)
+    return (verdict != DIVERGED, summary)
+
 
 def startProc(cmd):
     # passing a list to Popen doesn't work. Can't read stdout from docker container when shell=False
@@ -155,6 +546,50 @@ def finishProc(process, extraTime=False, output="stdout", timeout = 30):
         return stdoutdata.decode().strip().split("\n")
     return stderrdata.decode().strip().split("\n")
 
+def _interruptProc(process):
+    try:
+        os.killpg(process.pid, signal.SIGINT) # send signal to the process group
+    except ProcessLookupError:
+        pass
+
+def streamProc(process, extraTime=False, output="stdout", timeout = 30):
+    """ Like finishProc, but yields the output line by line while the process is still running,
+    so it can be fed straight into a canonicalizer. Only one line is held at a time.
+
+    The timeout applies from the first read. If the consumer stops early, e.g. the comparator
+    found a diff, the process is interrupted when the generator is closed.
+    """
+    if extraTime:
+        timeout = 45
+    (stream, other) = (process.stdout, process.stderr)
+    if output != 'stdout':
+        (stream, other) = (other, stream)
+
+    def onTimeout():
+        logger.info("TIMEOUT ERROR!")
+        _interruptProc(process)
+
+    def drain():
+        # The other pipe is discarded, but must be read so the process does not block on it
+        for _ in other:
+            pass
+
+    timer = threading.Timer(timeout, onTimeout)
+    drainer = threading.Thread(target=drain, daemon=True)
+    timer.start()
+    drainer.start()
+    try:
+        for line in stream:
+            yield line.decode().rstrip("\r\n")
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            _interruptProc(process)
+        process.wait()
+        drainer.join()
+        stream.close()
+        other.close()
+
 class VM(object):
 
     def __init__(self,executable="evmbin", docker = False):
@@ -174,34 +609,30 @@ class VM(object):
 class JsVM(VM):
     @staticmethod
     def canonicalized(output):
-        steps = []
-        for index, line in enumerate(output):
+        decode = json_decode
+        for line in output:
             if line and line.startswith('# {'):
-                result = json.loads(line.strip('# '))
-                steps.append(result)
-        return steps
+                yield decode(line.strip('# '))
 
 
 class HeraVM(VM):
     @staticmethod
     def canonicalized(output):
-        from . import opcodes
-        valid_opcodes = opcodes.reverse_opcodes.keys()
-
-        steps = []
+        decode = json_decode
+        digests = StackDigest()
         for x in output:
+            if not x.startswith("{"):
+                continue
             try:
-                if len(x) > 0  and x[0] == "{":
-                    step = json.loads(x)
-                    if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
-                      steps.append(step)
-                    else:
-                      step['gas'] = hex(step['gas'])
-                      step['stack'] = step['stack'][::-1]
-                      for i in range(0, len(step['stack'])):
-                          step['stack'][i] = re.sub(r'0x0+([0-9a-f]+)$', '0x\g<1>', step['stack'][i])
-
-                      steps.append(step)
+                step = decode(x)
+                if 'stateRoot' in step:
+                    if INCLUDE_STATEROOT:
+                        yield step
+                    continue
+                # Hera reports the stack bottom-up, with zero-padded values
+                stack = [trimHex(el) for el in reversed(step['stack'])]
+                yield Step(step['pc'], step['op'], toInt(step['gas']), step['depth'], stack,
+                           digests.update(step['op'], step['depth'], stack))
 
             except Exception as e:
                 logger.info('Exception parsing Hera json:')
@@ -209,44 +640,44 @@ class HeraVM(VM):
                 logger.info('problematic line:')
                 logger.info(x[:500])
 
-        return steps
-
 
 class CppVM(VM):
 
     @staticmethod
     def canonicalized(output):
         from . import opcodes
-        valid_opcodes = opcodes.reverse_opcodes.keys()
+        decode = json_decode
 
-        steps = []
-        for x in output:
-            try:
-                if x[0:2] == "[{":
-                        steps = json.loads(x)
-
-                if x[0:2] == "{\"":
+        def json_steps():
+            for x in output:
+                if x[0:2] not in ("[{", "{\""):
+                    continue
+                x = x.rstrip()
+                try:
+                    if x[0:2] == "[{":
+                        yield from decode(x)
+                        continue
                     # A bug in testeth
                     if x[-1] == '.':
                         x = x[:-1]
 
-                    step = json.loads(x)
-                    if 'stateRoot' in step.keys() and INCLUDE_STATEROOT:
-                        steps.append(step)
+                    step = decode(x)
+                    if 'stateRoot' in step and INCLUDE_STATEROOT:
+                        yield step
 
-            except Exception as e:
-                logger.info('Exception parsing cpp json:')
-                logger.info(e)
-                logger.info('problematic line:')
-                logger.info(x[:500])
-
-        canon_steps = []
+                except Exception as e:
+                    logger.info('Exception parsing cpp json:')
+                    logger.info(e)
+                    logger.info('problematic line:')
+                    logger.info(x[:500])
 
+        digests = StackDigest()
+        prev = None
         try:
-            for step in steps:
-                if 'stateRoot' in step.keys():
-                    if len(canon_steps): # dont log state root if no previous EVM steps
-                        canon_steps.append(step) # should happen last
+            for step in json_steps():
+                if 'stateRoot' in step:
+                    if prev is not None: # dont log state root if no previous EVM steps
+                        yield step # should happen last
                     continue
                 if step['op'] in ['INVALID', 'STOP'] :
                     # skip STOPs
@@ -256,34 +687,30 @@ class CppVM(VM):
                     logger.info(step)
                     continue
 
-                trace_step = {
-                    'pc'  : step['pc'],
-                    'gas': '0x{0:01x}'.format(int(step['gas'])) ,
-                    'op': opcodes.reverse_opcodes[step['op']],
-                    'depth' : step['depth'],
-                    'stack' : toHexQuantities(step['stack']),
-                }
-                canon_steps.append(trace_step)
-
-                # Sometimes, the last one is duplicated. let's just remove that, if so
+                # Sometimes, the last one is duplicated. let's just skip that, if so
+                if prev is not None and prev.depth == step['depth'] and prev.pc == step['pc']:
+                    continue
 
-                if len(canon_steps) > 1:
-                    last = canon_steps[-1]
-                    slast = canon_steps[-2]
-                    if slast['depth'] == last['depth'] and slast['pc'] == last['pc']:
-                        canon_steps = canon_steps[:-1]
+                op = opcodes.reverse_opcodes[step['op']]
+                stack = toHexQuantities(step['stack'])
+                trace_step = Step(step['pc'],
+                                  op,
+                                  int(step['gas']),
+                                  step['depth'],
+                                  stack,
+                                  digests.update(op, step['depth'], stack))
+                prev = trace_step
+                yield trace_step
 
         except Exception as e:
             logger.info('Exception parsing cpp step:')
             logger.info(e)
 
-        return canon_steps
-
 class PyVM(VM):
 
     @staticmethod
     def canonicalized(output):
-        from . import opcodes
+        decode = json_decode
 
         def formatStackItem(el):
             return '0x{0:01x}'.format(int(el.replace("b", "").replace("'", "")))
@@ -297,7 +724,7 @@ class PyVM(VM):
                 json_index = line.find("{")
                 if json_index >= 0:
                     try:
-                        yield(json.loads(line[json_index:]))
+                        yield(decode(line[json_index:]))
                     except Exception as e:
                         logger.info("Exception parsing python output:")
                         logger.info(e)
@@ -305,15 +732,15 @@ class PyVM(VM):
                         logger.info(line)
                         yield({})
 
-        canon_steps = []
+        digests = StackDigest()
+        counter = 0
         for step in json_steps():
-            #print (step)
-            if 'stateRoot' in step.keys():
+            if 'stateRoot' in step:
                 # dont log stateRoot when tx doesnt execute, to match cpp and parity
-                if len(canon_steps) and INCLUDE_STATEROOT:
-                    canon_steps.append(step)
+                if counter and INCLUDE_STATEROOT:
+                    yield step
                 continue
-            if 'event' not in step.keys():               
+            if 'event' not in step:
                 continue
             if step['event'] == 'eth.vm.op.vm':
                 if step['op'] not in valid_opcodes:
@@ -324,18 +751,14 @@ class PyVM(VM):
                     # can't distinguish them from actual STOPs (that pyeth logs)
                     continue
 
-                trace_step = {
-                    'opName' : step['op'],
-                    'op'     : step['inst'],
-                    'depth'  : step['depth'],
-                    'pc'     : bstrToInt(step['pc']),
-                    'gas'    : bstrToHex(step['gas']),
-                }
-
-                trace_step['stack'] = [formatStackItem(el) for el in step['stack']]
-                canon_steps.append(trace_step)
-
-        return canon_steps
+                stack = [formatStackItem(el) for el in step['stack']]
+                yield Step(bstrToInt(step['pc']),
+                           step['inst'],
+                           bstrToInt(step['gas']),
+                           step['depth'],
+                           stack,
+                           digests.update(step['inst'], step['depth'], stack))
+                counter = counter + 1
 
 
 class GethVM(VM):
@@ -405,27 +828,87 @@ class GethVM(VM):
     def execute(self, **kwargs):
         return finishProc(self.start(**kwargs))
 
+    def stream(self, **kwargs):
+        """ Like execute, but yields the output lines while geth is still running """
+        return streamProc(self.start(**kwargs))
+
+    @staticmethod
+    def postState(output):
+        """ Returns the post-state of an untraced 'evm statetest' run (without --json), taken
+        from the results which geth prints last: {'stateRoot': ...}, or {} if there is none
+        """
+        results = None
+        for line in output:
+            if results is not None:
+                results.append(line)
+            elif line.startswith("["):
+                results = [line]
+        if results is None:
+            return {}
+        try:
+            result = json.loads("\n".join(results))[0]
+            return {'stateRoot': _rootHex(result['stateRoot'])}
+        except (ValueError, TypeError, KeyError, IndexError):
+            return {}
+
+    @staticmethod
+    def splitBatch(output):
+        """ Splits the output of 'evm statetest' on a file with several tests into the output
+        of each test. Each test ends with its stateRoot, and the test names are taken from the
+        results which geth prints last, in the order of execution.
+
+        returns a list of (test name, lines), or None if the output can't be split unambiguously
+        """
+        segments = []
+        current = []
+        results = None
+        for line in output:
+            if results is not None:
+                results.append(line)
+            elif line.startswith("["):
+                # The (indented) json list of results, after all tests
+                results = [line]
+            else:
+                current.append(line)
+                if line.startswith('{"stateRoot"'):
+                    segments.append(current)
+                    current = []
+        if results is None:
+            logger.warn("Batch output has no results")
+            return None
+        try:
+            names = [r['name'] for r in json.loads("\n".join(results))]
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warn("Batch results could not be parsed: %s" % e)
+            return None
+        if len(segments) != len(names) or any(line.startswith("{") for line in current):
+            logger.warn("Batch output has %d stateRoots for %d tests" % (len(segments), len(names)))
+            return None
+        return list(zip(names, segments))
+
     @staticmethod
     def canonicalized(output):
         from . import opcodes
+        decode = json_decode
+        digests = StackDigest()
         addendum = []
         counter = 0
         for line in output:
-            if len(line) == 0:
+            # Cheaply skip lines which can't be steps, and STOPs, before decoding them
+            if not line.startswith("{") or STOP_MARKER in line[:STOP_MARKER_END]:
                 continue
-            step = None
-            if line[0] == "{":
-                try:
-                    step = json.loads(line)
-                except Exception as e:
-                    logger.warn('Exception [1] parsing geth output:')
-                    traceback.print_exc(file=sys.stdout)
-                    logger.warn(e)
-                    #step = ({'error' : 'Geth invalid json error'})
-            if step is None:
+            if line.startswith('{"output"'):
+                # last one is {"output":"","gasUsed":"0x34a48","time":4787059}
+                continue
+            try:
+                step = decode(line)
+            except Exception as e:
+                logger.warn('Exception [1] parsing geth output:')
+                traceback.print_exc(file=sys.stdout)
+                logger.warn(e)
                 continue
-            
-            if 'stateRoot' in step.keys() :
+
+            if 'stateRoot' in step:
                 # don't log stateRoot when tx doesnt execute, to match cpp and parity
                 # should be last step
                 if INCLUDE_STATEROOT:
@@ -433,14 +916,12 @@ class GethVM(VM):
                 continue
 
             # Ignored for now
-            if 'error' in step.keys() and 'output' in step.keys():
+            if 'error' in step and 'output' in step:
                 continue
-            if 'time' in step.keys():
-                # last one is {"output":"","gasUsed":"0x34a48","time":4787059}
-                # Remove    
+            if 'time' in step:
                 continue
 
-            if not 'op' in step.keys():
+            if not 'op' in step:
                 logger.warn("Missing 'op': %s" % str(step))
                 continue
 
@@ -450,15 +931,13 @@ class GethVM(VM):
             if step['opName'] == "" or step['op'] not in opcodes.opcodes:
                 # invalid opcode
                 continue
-            trace_step = {
-                'pc'  : step['pc'],
-                'gas': step['gas'],
-                'op': step['op'],
-                # we want a 0-based depth
-                'depth' : step['depth'] -1,
-                'stack' : step['stack'],
-            }
-            yield trace_step
+            yield Step(step['pc'],
+                       step['op'],
+                       toInt(step['gas']),
+                       # we want a 0-based depth
+                       step['depth'] -1,
+                       step['stack'],
+                       digests.update(step['op'], step['depth'], step['stack']))
             counter = counter +1
 
 
@@ -467,8 +946,6 @@ class GethVM(VM):
         if counter > 0:
             for step in addendum:
                 yield step
-#            return canon_steps+addendum
-#        return []
 
 
 class ParityVM(VM):
@@ -543,51 +1020,92 @@ class ParityVM(VM):
     def execute(self, **kwargs):
         return finishProc(self.start(**kwargs))
 
+    def stream(self, **kwargs):
+        """ Like execute, but yields the output lines while parity is still running """
+        return streamProc(self.start(**kwargs))
+
+    @staticmethod
+    def postState(output):
+        """ Returns the post-state of a 'parity-evm state-test' run, with or without tracing. The
+        state root is taken from the error about the (fake) expected root: {'stateRoot': ...},
+        or {} if there is none
+        """
+        for line in output:
+            matcher = ParityVM.staterooterr.search(line)
+            if matcher:
+                return {'stateRoot': _rootHex(matcher.group('stateroot'))}
+        return {}
+
+    @staticmethod
+    def splitBatch(output):
+        """ Splits the output of 'parity-evm state-test' on a file with several tests into the
+        output of each test. Each test starts with a line holding the test name,
+        e.g. {"action":"starting","test":"<name>:byzantium:0"}
+
+        returns a list of (test name, lines), or None if the output can't be split unambiguously
+        """
+        segments = []
+        for line in output:
+            if line.startswith("{") and not line.startswith('{"pc"') and '"test"' in line:
+                try:
+                    marker = json_decode(line)
+                except Exception:
+                    marker = {}
+                if 'test' in marker:
+                    segments.append((marker['test'].split(":")[0], [line]))
+                    continue
+            if not segments:
+                if line.startswith("{"):
+                    logger.warn("Batch output before the first test: %s" % line)
+                    return None
+                continue
+            segments[-1][1].append(line)
+        names = [name for (name, _) in segments]
+        if len(set(names)) != len(names):
+            logger.warn("Batch output has duplicate tests")
+            return None
+        return segments
+
     @staticmethod
     def canonicalized(output):
         from . import opcodes
-        canon_steps = []
+        decode = json_decode
+        digests = StackDigest()
         addendum = []
         counter = 0
-        #outputiterator = iter(output)
         for line in output:
-            if len(line) == 0:
+            # Cheaply skip lines which can't be steps, and STOPs, before decoding them
+            if not line.startswith("{") or STOP_MARKER in line[:STOP_MARKER_END]:
                 continue
-            p_step = None
-            if line[0] == "{":
-                try:
-                    p_step = json.loads(line)
-                except Exception as e:
-                    logger.warn('Exception [1] parsing parity output:')
-                    logger.warn(e)
-                    logger.warn(line)
-            if p_step is None:
+            try:
+                p_step = decode(line)
+            except Exception as e:
+                logger.warn('Exception [1] parsing parity output:')
+                logger.warn(e)
+                logger.warn(line)
                 continue
 
-            if 'test' in p_step.keys():
+            if 'test' in p_step:
                 # first step of trace has test name
                 continue
 
-            if 'stateRoot' in p_step.keys():
-                # dont log the stateRoot for basic tx's (that have no EVM steps)
-                # should be last step
-                if len(canon_steps) and INCLUDE_STATEROOT:
-                    addendum.append(step)
+            if 'stateRoot' in p_step:
+                # the stateRoot is taken from the error below instead
                 continue
 
             # Ignored for now
-            if 'error' in p_step.keys() or 'output' in p_step.keys():
+            if 'error' in p_step or 'output' in p_step:
                 # Except if the error is due to missing stateroot:
                 # If a statetest is used which does not have a proper postsatate, then Parity will 
                 # output an error, and we can parse the actual stateroot from it. 
-                if 'error' in p_step.keys() and INCLUDE_STATEROOT:
+                if 'error' in p_step and INCLUDE_STATEROOT:
                     matcher = ParityVM.staterooterr.search(p_step['error'])
                     if matcher :
                         addendum.append({'stateRoot' : matcher.group('stateroot')})
 
                 continue
 
-            if not 'op' in p_step.keys():
+            if not 'op' in p_step:
                 logger.warn("Missing 'op': %s" % str(p_step))
                 continue
                 
@@ -597,15 +1115,13 @@ class ParityVM(VM):
             if p_step['opName'] == "" or p_step['op'] not in opcodes.opcodes:
                 # invalid opcode
                 continue
-            trace_step = {
-                'pc'  : p_step['pc'],
-                'gas': p_step['gas'],
-                'op': p_step['op'],
-                # parity depth starts at 1, but we want a 0-based depth
-                'depth' : p_step['depth'] -1,
-                'stack' : p_step['stack'],
-            }
-            yield trace_step
+            yield Step(p_step['pc'],
+                       p_step['op'],
+                       toInt(p_step['gas']),
+                       # parity depth starts at 1, but we want a 0-based depth
+                       p_step['depth'] -1,
+                       p_step['stack'],
+                       digests.update(p_step['op'], p_step['depth'], p_step['stack']))
             counter = counter +1
 
 
@@ -615,5 +1131,3 @@ class ParityVM(VM):
         if counter > 0:
             for step in addendum:
                 yield step
-
-        return []
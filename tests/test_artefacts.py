@@ -0,0 +1,99 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from evmlab import artefacts
+
+
+EXAMPLE_TRACE = os.path.join(os.path.dirname(__file__), "..", "files", "example_trace.txt")
+
+
+class ArtefactStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_and_open(self):
+        store = artefacts.ArtefactStore(self.tempdir)
+        entry = store.put("a-trace.log", path=EXAMPLE_TRACE)
+        store.put("a-test.json", data='{"test": 1}')
+
+        with open(EXAMPLE_TRACE, "rb") as f:
+            content = f.read()
+        self.assertEqual(entry["size"], len(content))
+        self.assertLess(entry["stored"], entry["size"])
+        with store.open("a-trace.log") as f:
+            self.assertEqual(f.read(), content)
+        with store.open("a-test.json", "rt") as f:
+            self.assertEqual(f.read(), '{"test": 1}')
+        self.assertEqual(store.names(), ["a-test.json", "a-trace.log"])
+        with self.assertRaises(FileNotFoundError):
+            store.open("missing")
+
+    def test_dedup(self):
+        store = artefacts.ArtefactStore(self.tempdir)
+        first = store.put("1-trace.log", path=EXAMPLE_TRACE)
+        second = store.put("2-trace.log", path=EXAMPLE_TRACE)
+        self.assertEqual(first["hash"], second["hash"])
+        summary = store.summary()
+        self.assertEqual(summary["artefacts"], 2)
+        self.assertEqual(summary["objects"], 1)
+        self.assertEqual(summary["stored"], first["stored"])
+        objects = [f for (root, dirs, files) in os.walk(os.path.join(self.tempdir, artefacts.OBJECTS)) for f in files]
+        self.assertEqual(objects, ["%s.gz" % first["hash"]])
+
+    def test_index_reload(self):
+        store = artefacts.ArtefactStore(self.tempdir)
+        store.put("a", data=b"one")
+        other = artefacts.ArtefactStore(self.tempdir)
+        store.put("b", data=b"two")
+        # Replaced names keep their latest content
+        store.put("a", data=b"three")
+        with other.open("b") as f:
+            self.assertEqual(f.read(), b"two")
+        with artefacts.ArtefactStore(self.tempdir).open("a") as f:
+            self.assertEqual(f.read(), b"three")
+
+    def test_open_artefact(self):
+        plain = os.path.join(self.tempdir, "plain.json")
+        with open(plain, "w") as f:
+            f.write("plain")
+        compressed = os.path.join(self.tempdir, "compressed.json.gz")
+        with gzip.open(compressed, "wt") as f:
+            f.write("compressed")
+        artefacts.ArtefactStore(self.tempdir).put("stored.json", data="stored")
+
+        for (name, content) in (("plain.json", "plain"), ("compressed.json.gz", "compressed"), ("stored.json", "stored")):
+            path = os.path.join(self.tempdir, name)
+            self.assertTrue(artefacts.exists(path))
+            with artefacts.open_artefact(path, "rt") as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(artefacts.exists(os.path.join(self.tempdir, "missing.json")))
+        with self.assertRaises(FileNotFoundError):
+            artefacts.open_artefact(os.path.join(self.tempdir, "missing.json"))
+
+        (path, temporary) = artefacts.local_file(os.path.join(self.tempdir, "stored.json"))
+        self.assertTrue(temporary)
+        with open(path) as f:
+            self.assertEqual(f.read(), "stored")
+        os.remove(path)
+        self.assertEqual(artefacts.local_file(plain), (plain, False))
+
+    def test_migrate(self):
+        for name in ("1-test.json", "1-trace.log", "2-trace.log"):
+            shutil.copyfile(EXAMPLE_TRACE, os.path.join(self.tempdir, name))
+        with open(os.path.join(self.tempdir, "signatures.jsonl"), "w") as f:
+            f.write("{}\n")
+        os.mkdir(os.path.join(self.tempdir, "subdir"))
+
+        summary = artefacts.migrate(self.tempdir)
+        self.assertEqual(summary["artefacts"], 3)
+        self.assertEqual(summary["objects"], 1)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         [artefacts.INDEX, artefacts.OBJECTS, "signatures.jsonl", "subdir"])
+        with open(EXAMPLE_TRACE, "rb") as f, artefacts.open_artefact(os.path.join(self.tempdir, "2-trace.log")) as g:
+            self.assertEqual(f.read(), g.read())
@@ -0,0 +1,141 @@
+import os
+import sys
+import types
+import shutil
+import statistics
+import tempfile
+import unittest
+
+# The cluster is a script in utilities/, not part of the evmlab package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utilities"))
+import fuzzcluster
+
+
+class WorkerTest(unittest.TestCase):
+    """ Drives a worker's join, reports and leave against a local coordinator """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.coordinator = fuzzcluster.Coordinator(os.path.join(self.tmpdir, "coordinator"), seed="5eed")
+        self.server = fuzzcluster.serve(self.coordinator, "127.0.0.1", 0)
+        url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.worker = fuzzcluster.Worker(url, None)
+        self.artefacts = os.path.join(self.tmpdir, "worker")
+        os.makedirs(self.artefacts)
+        self.failures = []
+        config = types.SimpleNamespace(artefacts=self.artefacts)
+        status = lambda: {"pass": 10, "fail": len(self.failures), "speed": 1.5, "failures": list(self.failures)}
+        self.worker.executor = types.SimpleNamespace(status=status, _fuzzer=types.SimpleNamespace(store=None, _config=config))
+        self.batch = fuzzcluster.REPORT_BATCH
+
+    def tearDown(self):
+        fuzzcluster.REPORT_BATCH = self.batch
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def fail(self, n, size=10):
+        """ Adds a failure of the fuzzer, with its test file and shortened trace """
+        name = "test%d" % n
+        with open(os.path.join(self.artefacts, "%s.json" % name), "wb") as f:
+            f.write(b"x" * size)
+        with open(os.path.join(self.artefacts, "%s-shortened_trace.log" % name), "w") as f:
+            f.write("[!!]     geth pc 1 op %d\n" % n)
+        self.failures.append({"id": name, "file": "%s.json" % name, "traces": ["%s-geth.trace.log" % name],
+                              "other": ["%s-combined_trace.log" % name, "%s-shortened_trace.log" % name],
+                              "signature": "sig%d" % n})
+
+    def test_join_report_leave(self):
+        self.worker.join()
+        self.assertEqual(self.worker.worker, "w0")
+        self.assertEqual(self.worker.seed, "5eed-w0")
+        self.fail(1)
+        self.worker.report()
+        status = self.coordinator.status()
+        self.assertEqual((status["pass"], status["fail"], status["speed"]), (10, 1, 1.5))
+        self.assertEqual([f["key"] for f in status["failures"]], ["sig1"])
+        with self.coordinator.store.open("test1.json") as f:
+            self.assertEqual(f.read(), b"x" * 10)
+        # Only the files which the coordinator has are listed
+        self.assertEqual((status["failures"][0]["traces"], status["failures"][0]["other"]),
+                         ([], ["test1-shortened_trace.log"]))
+        # Failures are only sent once
+        self.fail(2)
+        self.worker.report()
+        self.assertEqual(sorted(f["key"] for f in self.coordinator.status()["failures"]), ["sig1", "sig2"])
+        self.assertTrue(all(f["count"] == 1 for f in self.coordinator.status()["failures"]))
+
+        fuzzcluster.request(self.worker.url, "/leave", {"worker": "w0"})
+        self.assertFalse(self.coordinator.status()["workers"]["w0"]["active"])
+
+    def test_failures_in_batches(self):
+        self.worker.join()
+        fuzzcluster.REPORT_BATCH = 400
+        reports = []
+        report = self.coordinator.report
+
+        def counting(worker, status, failures):
+            reports.append(len(failures))
+            return report(worker, status, failures)
+        self.coordinator.report = counting
+        for n in range(5):
+            self.fail(n, size=100)
+        self.worker.report()
+        self.assertEqual(reports, [2, 2, 1])
+        self.assertEqual(len(self.coordinator.status()["failures"]), 5)
+
+    def test_rejoin_keeps_seed(self):
+        self.worker.join()
+        # The coordinator was restarted, and lost its workers
+        self.coordinator.workers.clear()
+        self.worker.report()
+        self.assertEqual(self.worker.worker, "w1")
+        self.assertEqual(self.coordinator.status()["workers"]["w1"]["seed"], "5eed-w0")
+
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.coordinator = fuzzcluster.Coordinator(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def report(self, lengths, depths=(), consts=()):
+        """ Reports the trace stats of a worker, as TestExecutor.status computes them """
+        worker = self.coordinator.join("host")["worker"]
+        status = {"numTraces": len(lengths),
+                  "mean": statistics.mean(lengths) if lengths else "NA",
+                  "stdev": statistics.stdev(lengths) if len(lengths) > 2 else "NA",
+                  "numZero": lengths.count(0) if lengths else "NA",
+                  "max": max(lengths) if lengths else "NA",
+                  "maxDepth": max(depths) if depths else "NA",
+                  "numConst": statistics.mean(consts) if consts else "NA"}
+        self.coordinator.report(worker, status, [])
+        return worker
+
+    def test_trace_stats(self):
+        self.assertEqual(self.coordinator.status()["mean"], "NA")
+        self.report([0, 10, 20, 30], depths=[1, 3, 2, 1], consts=[1, 1, 1, 1])
+        self.report([0, 0, 100], depths=[5, 1, 1], consts=[0, 0, 8])
+        # A worker which hasn't traced anything yet
+        self.report([])
+        status = self.coordinator.status()
+        lengths = [0, 10, 20, 30, 0, 0, 100]
+        self.assertAlmostEqual(status["mean"], statistics.mean(lengths))
+        self.assertAlmostEqual(status["stdev"], statistics.stdev(lengths))
+        self.assertEqual((status["numZero"], status["max"], status["maxDepth"]), (3, 100, 5))
+        self.assertAlmostEqual(status["numConst"], 12 / 7)
+
+    def test_trace_stats_active_workers(self):
+        gone = self.report([1000] * 3, depths=[9] * 3, consts=[0] * 3)
+        self.report([10] * 3, depths=[1] * 3, consts=[0] * 3)
+        self.coordinator.leave(gone)
+        status = self.coordinator.status()
+        self.assertEqual((status["mean"], status["max"], status["maxDepth"]), (10, 10, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
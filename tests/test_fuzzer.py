@@ -0,0 +1,716 @@
+import os
+import sys
+import types
+import shutil
+import signal
+import socket
+import struct
+import asyncio
+import tempfile
+import unittest
+import subprocess
+
+# The fuzzer is a script in utilities/, not part of the evmlab package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "utilities"))
+import fuzzer
+
+
+class ReadLimitedTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        chunks = [b"a\nb", b"\nc\n", b"d"]
+        self.assertEqual(fuzzer.read_limited(iter(chunks)), (b"a\nb\nc\nd", False))
+
+    def test_cut_off_at_limit(self):
+        chunks = [b"1\n2\n", b"3\n4", b"\n5\n6\n"]
+        self.assertEqual(fuzzer.read_limited(iter(chunks), 3), (b"1\n2\n3\n", True))
+
+    def test_stops_reading_at_limit(self):
+        read = []
+
+        def chunks():
+            for chunk in (b"1\n2\n", b"3\n", b"4\n"):
+                read.append(chunk)
+                yield chunk
+        (output, truncated) = fuzzer.read_limited(chunks(), 2)
+        self.assertEqual((output, truncated), (b"1\n2\n", True))
+        self.assertEqual(read, [b"1\n2\n"])
+
+    def test_below_limit(self):
+        self.assertEqual(fuzzer.read_limited(iter([b"1\n", b"2\n"]), 3), (b"1\n2\n", False))
+
+    def test_written_over_memory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "out")
+            chunks = [b"1\n2\n", b"3\n4\n", b"5\n6\n"]
+            self.assertEqual(fuzzer.read_limited(iter(chunks), 5, filename, memory=6), (None, True))
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"1\n2\n3\n4\n5\n")
+            # Outputs which fit are not written
+            os.remove(filename)
+            self.assertEqual(fuzzer.read_limited(iter(chunks), None, filename, memory=12), (b"".join(chunks), False))
+            self.assertFalse(os.path.exists(filename))
+
+
+class ExecSocketTest(unittest.TestCase):
+
+    def test_unwraps_socketio(self):
+        (a, b) = socket.socketpair()
+        try:
+            stream = socket.SocketIO(a, "rwb")
+            self.assertIs(fuzzer.exec_socket(stream), a)
+            self.assertIs(fuzzer.exec_socket(a), a)
+            fuzzer.exec_socket(stream).sendall(b"test")
+            self.assertEqual(b.recv(4), b"test")
+        finally:
+            a.close()
+            b.close()
+
+
+class ExecFramesTest(unittest.TestCase):
+
+    @staticmethod
+    def frame(stream, payload):
+        return struct.pack(">BxxxL", stream, len(payload)) + payload
+
+    def test_demultiplexes(self):
+        (a, b) = socket.socketpair()
+        try:
+            b.sendall(self.frame(1, b"out\n") + self.frame(2, b"err\n") + self.frame(1, b"x" * 10))
+            b.close()
+            self.assertEqual(list(fuzzer.exec_frames(socket.SocketIO(a, "rwb"), size=4)),
+                             [b"out\n", b"err\n", b"xxxx", b"xxxx", b"xx"])
+        finally:
+            a.close()
+
+    def test_frame_cut_off(self):
+        (a, b) = socket.socketpair()
+        try:
+            b.sendall(self.frame(1, b"out\n") + self.frame(1, b"x" * 10)[:12] + b"xx")
+            b.close()
+            self.assertEqual(b"".join(fuzzer.exec_frames(a)), b"out\nxxxxxx")
+        finally:
+            a.close()
+
+
+class ClientRunnerTest(unittest.TestCase):
+    """ Runs the runner script on the host, as it would run in a container """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.runner = fuzzer.ClientRunner("geth", self.tmpdir, self.tmpdir)
+        self.proc = subprocess.Popen(self.runner.command, start_new_session=True)
+        self.assertTrue(self.runner.wait_ready())
+
+    def tearDown(self):
+        self.runner.close()
+        os.killpg(self.proc.pid, signal.SIGKILL)
+        self.proc.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def test_jobs(self):
+        out = os.path.join(self.tmpdir, "out")
+        first = self.runner.submit(["/bin/sh", "-c", "echo 'a b' > %s" % out])
+        second = self.runner.submit(["sh", "-c", "exit 3"])
+        self.assertNotEqual(first, second)
+        # Jobs can be waited for in any order
+        self.assertEqual(self.runner.wait_job(second), 3)
+        self.assertEqual(self.runner.wait_job(first), 0)
+        with open(out) as f:
+            self.assertEqual(f.read(), "a b\n")
+
+    def test_concurrent_jobs(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            slow = self.runner.submit(["sleep", "0.5"])
+            fast = self.runner.submit(["true"])
+            done = []
+
+            async def wait(job):
+                exitcode = await self.runner.wait(job)
+                done.append(job)
+                return exitcode
+            results = loop.run_until_complete(asyncio.gather(wait(slow), wait(fast)))
+            self.assertEqual(results, [0, 0])
+            # The slow job didn't hold up the fast one
+            self.assertEqual(done, [fast, slow])
+
+            # A runner which is gone resolves the jobs waited for
+            job = self.runner.submit(["sleep", "10"])
+            future = self.runner.wait(job)
+            self.runner.abort()
+            self.assertIsNone(loop.run_until_complete(future))
+        finally:
+            self.runner.close()
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class NativeClientTest(unittest.TestCase):
+    """ Runs stub commands as native clients """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fuzzer = fuzzer.Fuzzer.__new__(fuzzer.Fuzzer)
+        self.fuzzer._config = types.SimpleNamespace(step_budget=None, binary_memory_limit=0, binary_cpu_limit=0,
+                                                    logfilesPath=self.tmpdir)
+        self.test = fuzzer.RawStateTest({}, "test", "test", self.fuzzer._config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_client(self, cmd):
+        procinfo = self.fuzzer.startNative("geth", cmd, self.test)
+        for proc in procinfo["procs"]:
+            proc.wait()
+        self.fuzzer.recordCut(self.test, procinfo, "geth")
+        with open(self.test.tempTraceLocation("geth")) as f:
+            return (procinfo, f.read())
+
+    def test_output(self):
+        (procinfo, output) = self.run_client(["sh", "-c", "echo out; echo err >&2; exit 2"])
+        self.assertEqual(sorted(output.splitlines()), ["err", "out"])
+        self.assertEqual(procinfo["procs"][0].returncode, 2)
+        self.assertEqual(self.test.cut, set())
+
+    def test_step_budget(self):
+        self.fuzzer._config.step_budget = 10
+        (procinfo, output) = self.run_client(["yes", "step"])
+        # head stops at the budget, and the client on SIGPIPE
+        self.assertEqual(output.splitlines(), ["step"] * (10 + fuzzer.Fuzzer.BUDGET_SLACK))
+        self.assertEqual(procinfo["procs"][0].returncode, -signal.SIGPIPE)
+        self.assertEqual(self.test.cut, {"geth"})
+
+    def test_step_budget_not_reached(self):
+        self.fuzzer._config.step_budget = 10
+        (procinfo, output) = self.run_client(["sh", "-c", "echo step; echo step"])
+        self.assertEqual(output, "step\nstep\n")
+        self.assertEqual(self.test.cut, set())
+
+    def test_resource_limits(self):
+        self.assertIsNone(self.fuzzer.resourceLimits())
+        self.fuzzer._config.binary_memory_limit = 512
+        self.fuzzer._config.binary_cpu_limit = 30
+        (_, output) = self.run_client(["sh", "-c", "ulimit -v; ulimit -t"])
+        self.assertEqual(output.splitlines(), [str(512 * 1024), "30"])
+
+
+class PipedClientTest(unittest.TestCase):
+    """ Runs stub commands as native clients with io_mode = pipes """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fuzzer = fuzzer.Fuzzer.__new__(fuzzer.Fuzzer)
+        self.fuzzer._config = types.SimpleNamespace(step_budget=None, binary_memory_limit=0, binary_cpu_limit=0,
+                                                    logfilesPath=self.tmpdir, binaries={"geth": "evm"},
+                                                    pipe_output_memory=4)
+        self.test = fuzzer.RawStateTest({"test": {"pre": {}}}, "test", "test", self.fuzzer._config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_client(self, cmd):
+        procinfo = self.fuzzer.startPiped("geth", cmd, self.test)
+        self.fuzzer.wait_process(self.test, procinfo, "geth")
+        return (procinfo, self.test.outputs[self.test.tempTraceLocation("geth")])
+
+    def test_test_on_stdin(self):
+        (procinfo, output) = self.run_client(["cat"])
+        self.assertEqual(output, self.test.serialized())
+        self.assertEqual(procinfo["exitcode"], 0)
+        # Nothing goes through the files
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_output_merged(self):
+        (procinfo, output) = self.run_client(["sh", "-c", "cat > /dev/null; echo out; echo err >&2; exit 3"])
+        self.assertEqual(sorted(output.decode().splitlines()), ["err", "out"])
+        self.assertEqual(procinfo["exitcode"], 3)
+
+    def test_step_budget(self):
+        self.fuzzer._config.step_budget = 10
+        (procinfo, output) = self.run_client(["yes", "step"])
+        self.assertEqual(output.decode().splitlines(), ["step"] * (10 + fuzzer.Fuzzer.BUDGET_SLACK))
+        self.assertTrue(procinfo["truncated"])
+        self.assertEqual(procinfo["exitcode"], -signal.SIGKILL)
+        self.assertEqual(self.test.cut, {"geth"})
+
+    def test_client_ignores_stdin(self):
+        # A client which exits without reading the test doesn't fail the run, even if the test
+        # doesn't fit into the pipe
+        self.test = fuzzer.RawStateTest({"test": {"pre": {"0x00": {"code": "0x" + "00" * 200000}}}}, "test", "test",
+                                        self.fuzzer._config)
+        (procinfo, output) = self.run_client(["echo", "done"])
+        self.assertEqual(output, b"done\n")
+        self.assertEqual(self.test.cut, set())
+
+    def test_long_output_written(self):
+        self.fuzzer._config.step_budget = 1024 * 1024
+        procinfo = self.fuzzer.startPiped("geth", ["yes", "step"], self.test)
+        self.fuzzer.wait_process(self.test, procinfo, "geth")
+        # More than 4MB of output, which went to the trace file instead of memory
+        self.assertEqual(self.test.outputs, {})
+        self.assertEqual(fuzzer.count_lines(self.test.tempTraceLocation("geth")), self.fuzzer.budgetLines())
+        self.assertEqual(self.test.cut, {"geth"})
+
+
+class AnalyzeTracesTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), "..", "files", "example_trace.txt"), "rb") as f:
+            self.output = f.read()
+        lines = self.output.split(b"\n")
+        # A gas difference at the tenth step
+        lines[9] = lines[9].replace(b'"gas":"0x', b'"gas":"0x1', 1)
+        self.diverging = b"\n".join(lines)
+
+    def analyze(self, outputs, **kwargs):
+        traces = [("/nonexistent/%d" % i, "geth") for i in range(len(outputs))]
+        return fuzzer.analyze_traces(traces, outputs=outputs, **kwargs)
+
+    def test_full_lengths(self):
+        result = self.analyze([self.output, self.output])
+        self.assertEqual(result["verdict"], "pass")
+        self.assertEqual(result["clients"], ["geth", "geth"])
+        self.assertEqual(result["complete"], [True, True])
+        self.assertEqual(result["lengths"][0], result["lengths"][1])
+        self.assertGreater(result["lengths"][0], 100)
+        # The combined trace is built for a new divergence, which reads the traces completely
+        result = self.analyze([self.output, self.diverging])
+        self.assertEqual(result["verdict"], "diverged")
+        self.assertEqual(result["complete"], [True, True])
+
+    def test_trace_job_clients(self):
+        f = fuzzer.Fuzzer.__new__(fuzzer.Fuzzer)
+        f._config = types.SimpleNamespace(clientNames=["geth", "cpp", "parity"], step_budget=None, binary_traces=False,
+                                          coverage=False, phases=["traced"])
+        f.signatures = types.SimpleNamespace(known=lambda: frozenset())
+        test = fuzzer.RawStateTest({}, "test", "test", f._config)
+        # No run of cpp, e.g. because it failed to start
+        test.procs = [({}, "geth"), ({}, "parity")]
+        test.canon_traces = [types.SimpleNamespace(filename="geth.log"), types.SimpleNamespace(filename="parity.log")]
+        self.assertEqual(f.traceJob(test)["traces"], [("geth.log", "geth"), ("parity.log", "parity")])
+
+    def test_cut_lengths(self):
+        result = self.analyze([self.output, self.diverging])
+        known = {fuzzer.VMUtils.signature_key(result["signature"])}
+        result = self.analyze([self.output, self.diverging], known_signatures=known)
+        self.assertEqual(result["verdict"], "diverged")
+        self.assertEqual(result["complete"], [False, False])
+        self.assertLess(max(result["lengths"]), 20)
+
+
+    def test_cut_output(self):
+        lines = self.output.split(b"\n")
+        cut = b"\n".join(lines[:50]) + b"\n"
+        result = self.analyze([cut, self.output], step_budget=1000)
+        self.assertEqual(result["verdict"], "diverged")
+        # Where the cut off trace ends, the test is truncated rather than failed
+        result = self.analyze([cut, self.output], step_budget=1000, cut=["geth"])
+        self.assertEqual(result["verdict"], "truncated")
+        self.assertEqual(result["summary"], [])
+
+
+class RecordCutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        config = types.SimpleNamespace(step_budget=10, logfilesPath=self.tmpdir)
+        self.fuzzer = types.SimpleNamespace(_config=config)
+        self.fuzzer.budgetLines = lambda num_tests=1: fuzzer.Fuzzer.budgetLines(self.fuzzer, num_tests)
+        self.test = fuzzer.RawStateTest({}, "test", "test", config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, procinfo, lines=None):
+        if lines is not None:
+            with open(self.test.tempTraceLocation("geth"), "w") as f:
+                f.write("step\n" * lines)
+        fuzzer.Fuzzer.recordCut(self.fuzzer, self.test, procinfo, "geth")
+        return "geth" in self.test.cut
+
+    def test_files(self):
+        self.assertFalse(self.record({"procs": []}, 10 + fuzzer.Fuzzer.BUDGET_SLACK - 1))
+        self.assertTrue(self.record({"procs": []}, 10 + fuzzer.Fuzzer.BUDGET_SLACK))
+
+    def test_pipes(self):
+        self.assertFalse(self.record({"communicate": None, "truncated": False}))
+        self.assertTrue(self.record({"communicate": None, "truncated": True}))
+
+    def test_without_budget(self):
+        self.fuzzer._config.step_budget = None
+        self.assertFalse(self.record({"procs": []}, 1000))
+
+
+class CoverageSchedulerTest(unittest.TestCase):
+
+    def test_variety_counts_opcodes_only(self):
+        scheduler = fuzzer.CoverageScheduler({"RndCodeBytes": 50})
+        features = {
+            ("bigram", 0x60, 0x01), ("bigram", 0x01, 0x01),
+            ("exit", 0x00),
+            ("depth", 0x60, 0), ("depth", 0x01, 0), ("depth", 0xf1, 1), ("depth", 0xf1, 4),
+            ("precompile", 0xf1, 1), ("precompile", 0xf1, 4),
+        }
+        scheduler.add("RndCodeBytes", features)
+        self.assertEqual(scheduler.variety, {0x60: 2, 0x01: 3, 0x00: 1, 0xf1: 4})
+        # Features seen before don't count again
+        scheduler.add("RndCodeBytes", {("depth", 0x60, 0), ("exit", 0x01)})
+        self.assertEqual(scheduler.variety[0x60], 2)
+        self.assertEqual(scheduler.variety[0x01], 4)
+        self.assertEqual(scheduler.kinds, {"bigram": 2, "exit": 2, "depth": 4, "precompile": 2})
+
+    def test_rare_opcodes_weigh_more(self):
+        scheduler = fuzzer.CoverageScheduler({"RndCodeBytes": 50})
+        scheduler.add("RndCodeBytes", {("depth", 0x01, depth) for depth in range(5)})
+        weights = scheduler.opcodeWeights()
+        self.assertLess(weights[0x01], weights[0x02])
+        self.assertEqual(weights[0x02], 1.0)
+
+
+class TraceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.versions = {"geth": "build-1", "parity": "build-2"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cache(self, max_bytes=1000):
+        return fuzzer.TraceCache(self.tempdir, max_bytes, self.versions.get)
+
+    def put(self, cache, key, size=100):
+        tmpfile = cache.tempfile(key, "test")
+        with open(tmpfile, "wb") as f:
+            f.write(b"x" * size)
+        cache.store(key, tmpfile)
+
+    def stateTest(self, name="test", info="", code="0x6001"):
+        statetest = {name: {"_info": {"comment": info}, "pre": {"0x00": {"code": code}},
+                            "post": {"Byzantium": [], "Constantinople": []}}}
+        return fuzzer.RawStateTest(statetest, name, name, types.SimpleNamespace(phases=["untraced", "traced"]))
+
+    def test_evicts_least_recently_used(self):
+        cache = self.cache(max_bytes=250)
+        self.put(cache, "a")
+        self.put(cache, "b")
+        self.assertIsNotNone(cache.lookup("a", "geth"))
+        self.put(cache, "c")
+        self.assertIsNone(cache.lookup("b", "geth"))
+        self.assertFalse(os.path.exists(cache.path("b")))
+        self.assertIsNotNone(cache.lookup("a", "geth"))
+        self.assertIsNotNone(cache.lookup("c", "geth"))
+        summary = cache.summary()
+        self.assertEqual((summary["entries"], summary["size"], summary["evictions"]), (2, 200, 1))
+        self.assertEqual((summary["hits"], summary["misses"]), ({"geth": 3}, {"geth": 1}))
+
+    def test_reload_evicts_by_mtime(self):
+        cache = self.cache()
+        for (key, mtime) in (("a", 3000), ("b", 1000), ("c", 2000)):
+            self.put(cache, key)
+            os.utime(cache.path(key), (mtime, mtime))
+        with open(cache.tempfile("d", "test"), "wb") as f:
+            f.write(b"interrupted")
+
+        cache = self.cache(max_bytes=250)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ["a", "c"])
+        self.assertEqual(cache.size, 200)
+        # A hit makes an entry the most recently used one
+        cache.lookup("c", "geth")
+        self.put(cache, "e")
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ["c", "e"])
+
+    def test_key(self):
+        cache = self.cache()
+        key = cache.key(self.stateTest(), "geth", 1000)
+        self.assertEqual(len(key), 64)
+        # The name and _info of a test don't change what it does
+        self.assertEqual(cache.key(self.stateTest(name="other", info="comment"), "geth", 1000), key)
+        self.assertNotEqual(cache.key(self.stateTest(code="0x6002"), "geth", 1000), key)
+        self.assertNotEqual(cache.key(self.stateTest(), "parity", 1000), key)
+        self.assertNotEqual(cache.key(self.stateTest(), "geth", None), key)
+        traced = self.stateTest()
+        traced.phase = 1
+        self.assertNotEqual(cache.key(traced, "geth", 1000), key)
+        # A new build of the client. The build is looked up once per cache, i.e. per run
+        self.versions["geth"] = "build-3"
+        self.assertEqual(cache.key(self.stateTest(), "geth", 1000), key)
+        self.assertNotEqual(self.cache().key(self.stateTest(), "geth", 1000), key)
+        # Clients which can't be identified aren't cached
+        self.assertIsNone(self.cache().key(self.stateTest(), "hera", 1000))
+
+
+class SignatureIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "signatures.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_examples(self):
+        index = fuzzer.SignatureIndex(self.path, examples=2)
+        self.assertTrue(index.wantsExample("a"))
+        index.add("a", ["sig a"], "test-1", artefacts={"id": "test-1"})
+        self.assertTrue(index.wantsExample("a"))
+        self.assertEqual(index.known(), frozenset())
+        index.add("a", ["sig a"], "test-2", artefacts={"id": "test-2"})
+        self.assertFalse(index.wantsExample("a"))
+        self.assertEqual(index.known(), frozenset(["a"]))
+        # Failures beyond the examples are only counted
+        index.add("a", ["sig a"], "test-3")
+        index.add("b", ["sig b"], "test-4", artefacts={"id": "test-4"})
+        self.assertTrue(index.wantsExample("b"))
+
+        summary = index.summary()
+        self.assertEqual([entry["key"] for entry in summary], ["a", "b"])
+        self.assertEqual(summary[0]["count"], 3)
+        self.assertEqual(summary[0]["examples"], [{"id": "test-1"}, {"id": "test-2"}])
+        self.assertEqual(summary[0]["signature"], ["sig a"])
+
+    def test_save_all(self):
+        index = fuzzer.SignatureIndex(self.path, examples=0)
+        for n in range(5):
+            index.add("a", ["sig a"], "test-%d" % n, artefacts={"id": n})
+        self.assertTrue(index.wantsExample("a"))
+        self.assertEqual(index.known(), frozenset())
+
+    def test_reload(self):
+        index = fuzzer.SignatureIndex(self.path, examples=1)
+        index.add("a", ["sig a"], "test-1", artefacts={"id": "test-1"})
+        index.add("a", ["sig a"], "test-2")
+        index.add("b", ["sig b"], "test-3")
+        # A line which was cut off when the fuzzer stopped
+        with open(self.path, "a") as f:
+            f.write('{"key": "c", "sig')
+
+        reloaded = fuzzer.SignatureIndex(self.path, examples=1)
+        self.assertEqual(reloaded.summary(), index.summary())
+        self.assertEqual(reloaded.known(), frozenset(["a"]))
+        self.assertTrue(reloaded.wantsExample("b"))
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        config = types.SimpleNamespace(clientNames=["geth"], fixed_concurrency=set(), concurrency={},
+                                       concurrency_min=1, concurrency_max=8, concurrency_max_load=1.5)
+        self.controller = fuzzer.ConcurrencyController(config)
+        self.limit = fuzzer.ClientLimit(4)
+
+    def interval(self, completed, runTime=1.0, waiting=0, load=0.0, action=None):
+        """ Decides on an interval of 10s with the given number of runs, which took runTime each """
+        self.controller.clients["geth"]["action"] = action
+        self.limit.reset()
+        (self.limit.completed, self.limit.runTime) = (completed, completed * runTime)
+        self.limit.maxWaiting = waiting
+        return self.controller.decide("geth", self.limit, 10.0, load)
+
+    def test_no_runs(self):
+        self.assertEqual(self.interval(0, waiting=3), (4, None))
+
+    def test_increase_when_saturated(self):
+        (limit, reason) = self.interval(20, waiting=2)
+        self.assertEqual(limit, 5)
+        self.assertTrue(reason.startswith("saturated"))
+        self.assertEqual(self.interval(20), (4, None))
+        self.limit.limit = 8
+        self.assertEqual(self.interval(20, waiting=2), (8, None))
+
+    def test_decrease_when_increase_did_not_pay_off(self):
+        self.interval(20, waiting=2)
+        (limit, reason) = self.interval(15, waiting=2, action="increase")
+        self.assertEqual(limit, 3)
+        self.assertTrue(reason.startswith("throughput dropped"))
+
+        self.interval(20, waiting=2)
+        (limit, reason) = self.interval(20, runTime=2.0, waiting=2, action="increase")
+        self.assertEqual(limit, 3)
+        self.assertTrue(reason.startswith("runs slowed down"))
+
+        # Slower runs are fine if the throughput grew, and within the tolerance it's no change
+        self.interval(20, waiting=2)
+        self.assertEqual(self.interval(25, runTime=2.0, waiting=2, action="increase")[0], 5)
+        self.assertEqual(self.interval(24, waiting=2, action="increase")[0], 5)
+
+    def test_decrease_when_overloaded(self):
+        (limit, reason) = self.interval(20, waiting=2, load=2.0)
+        self.assertEqual(limit, 3)
+        self.assertTrue(reason.startswith("host overloaded"))
+        # The load average lags, so it's not cut again right away
+        self.assertEqual(self.interval(20, waiting=2, load=2.0), (4, None))
+        self.limit.limit = 1
+        self.controller.clients["geth"]["loadDecrease"] = 0
+        self.assertEqual(self.interval(20, load=2.0), (1, None))
+
+
+class IntrinsicGasTest(unittest.TestCase):
+
+    def test_intrinsic_gas(self):
+        self.assertEqual(fuzzer.intrinsic_gas(b""), 21000)
+        self.assertEqual(fuzzer.intrinsic_gas(bytes.fromhex("00ff00")), 21000 + 4 + 68 + 4)
+        self.assertEqual(fuzzer.intrinsic_gas(b"", create=True, fork="Frontier"), 21000)
+        self.assertEqual(fuzzer.intrinsic_gas(b"", create=True, fork="Homestead"), 53000)
+        self.assertEqual(fuzzer.intrinsic_gas(bytes.fromhex("6001"), create=True, fork="Byzantium"), 53000 + 2 * 68)
+        # Unknown forks are taken to be the latest
+        self.assertEqual(fuzzer.intrinsic_gas(b"", create=True, fork="Istanbul"), 53000)
+
+    def test_opcode_available(self):
+        self.assertTrue(fuzzer.opcode_available(0x01, "Frontier"))
+        self.assertFalse(fuzzer.opcode_available(0xf4, "Frontier"))
+        self.assertTrue(fuzzer.opcode_available(0xf4, "Homestead"))
+        self.assertFalse(fuzzer.opcode_available(0xfd, "EIP158"))
+        self.assertTrue(fuzzer.opcode_available(0xfd, "Byzantium"))
+        self.assertFalse(fuzzer.opcode_available(0x1b, "Byzantium"))
+        self.assertTrue(fuzzer.opcode_available(0x1b, "Constantinople"))
+        self.assertTrue(fuzzer.opcode_available(0x1b, "Istanbul"))
+
+
+class PreFilterTest(unittest.TestCase):
+
+    TARGET = "0x0f572e5295c57f15886f9b263e2f6d2d6c7b5ec6"
+    # PUSH1 1, PUSH1 1, ADD, PUSH1 0, SSTORE
+    CODE = "0x6001600101600055"
+
+    def statetest(self, code=CODE, to=TARGET, data="0x", gas=100000, forks=("Byzantium",)):
+        pre = {self.TARGET: {"code": code, "balance": "0x00", "nonce": "0x00", "storage": {}}}
+        return {"test": {
+            "env": {"currentGasLimit": "0x%x" % 10000000},
+            "pre": pre,
+            "transaction": {"to": to, "data": [data], "gasLimit": ["0x%x" % gas], "value": ["0x00"]},
+            "post": {fork: [{"indexes": {"data": 0, "gas": 0, "value": 0}}] for fork in forks},
+        }}
+
+    def halts(self, code, fork="Byzantium"):
+        return fuzzer.PreFilter.halts(bytes.fromhex(code), fork)
+
+    def test_halts(self):
+        self.assertTrue(self.halts(""))
+        self.assertTrue(self.halts("00"))
+        # Stack underflow, and invalid opcodes
+        self.assertTrue(self.halts("01"))
+        self.assertTrue(self.halts("fe"))
+        self.assertTrue(self.halts("1b"))
+        # Running off the end of the code
+        self.assertTrue(self.halts("60016001"))
+        self.assertFalse(self.halts("6001600101600055"))
+        self.assertFalse(self.halts("600160010160005b"))
+        # SHL is available from Constantinople on
+        self.assertTrue(self.halts("600160011b600055", "Byzantium"))
+        self.assertFalse(self.halts("600160011b600055", "Constantinople"))
+
+    def test_halts_keeps_jumps_and_calls(self):
+        # Where the code goes after a jump isn't followed
+        self.assertFalse(self.halts("600456"))
+        self.assertFalse(self.halts("6000600060006000600060006000f1"))
+
+    def test_halts_keeps_return_and_revert(self):
+        # RETURN and REVERT end the code, but with their operands in place they're kept on
+        # purpose: their memory expansion and return data are worth comparing
+        self.assertFalse(self.halts("60006000f3"))
+        self.assertFalse(self.halts("60206000fd"))
+        self.assertFalse(self.halts("6000ff"))
+        # Without operands they fault, and REVERT doesn't exist before Byzantium
+        self.assertTrue(self.halts("f3"))
+        self.assertTrue(self.halts("60206000fd", "Homestead"))
+
+    def test_check_keeps(self):
+        self.assertIsNone(fuzzer.PreFilter.check(self.statetest()))
+        # A call to a precompile runs no code, but is kept
+        self.assertIsNone(fuzzer.PreFilter.check(self.statetest(to="0x0000000000000000000000000000000000000004")))
+        # A create runs the data as its code
+        self.assertIsNone(fuzzer.PreFilter.check(self.statetest(to="", data=self.CODE, code="", gas=60000)))
+
+    def test_check_gas(self):
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(gas=21000, data="0x01")), "gas")
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(gas=20000000)), "gas")
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(to="", data=self.CODE, gas=50000)), "gas")
+        # The create fee only applies from Homestead on
+        self.assertIsNone(fuzzer.PreFilter.check(self.statetest(to="", data=self.CODE, gas=50000,
+                                                                forks=("Frontier",))))
+        # The gas costs of unknown forks aren't known, so they're not checked
+        self.assertIsNone(fuzzer.PreFilter.check(self.statetest(gas=21000, data="0x01", forks=("Istanbul",))))
+
+    def test_check_no_code(self):
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(code="0x")), "no_code")
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(to="0x" + "11" * 20)), "no_code")
+
+    def test_check_halts(self):
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(code="0x00")), "halts")
+        self.assertEqual(fuzzer.PreFilter.check(self.statetest(to="", data="0x01", code="", gas=60000)), "halts")
+
+    def test_check_any_case(self):
+        # Rejected only if every case would be
+        test = self.statetest(code="0x600160011b600055", forks=("Byzantium", "Constantinople"))
+        self.assertIsNone(fuzzer.PreFilter.check(test))
+        test = self.statetest(code="0x600160011b600055", forks=("Byzantium", "EIP158"))
+        self.assertEqual(fuzzer.PreFilter.check(test), "halts")
+
+    def test_accept_and_sample(self):
+        rejecting = fuzzer.PreFilter(sample=0.0)
+        self.assertEqual(rejecting.accept(self.statetest()), (True, None))
+        self.assertEqual(rejecting.accept(self.statetest(code="0x00")), (False, "halts"))
+        # Tests the filter doesn't understand are run
+        self.assertEqual(rejecting.accept({"test": {}}), (True, None))
+        sampling = fuzzer.PreFilter(sample=1.0)
+        self.assertEqual(sampling.accept(self.statetest(code="0x00")), (True, "halts"))
+
+        sampling.merge(rejecting.counts())
+        self.assertEqual(rejecting.summary()["checked"], 0)
+        sampling.onTraced("halts", 3)
+        sampling.onTraced("halts", 100)
+        summary = sampling.summary()
+        self.assertEqual((summary["checked"], summary["rejected"], summary["sampled"]), (4, {"halts": 2}, {"halts": 1}))
+        self.assertEqual(summary["rejectRate"], 0.5)
+        self.assertEqual(summary["traced"], {"halts": {"tests": 2, "short": 1}})
+
+
+
+class MinimizerSignatureTest(unittest.TestCase):
+    """ The failure which test_minimizer keeps, given the binary traces of the failing test """
+
+    def setUp(self):
+        import test_minimizer
+        self.minimizer = test_minimizer
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(os.path.dirname(__file__), "..", "files", "example_trace.txt")) as f:
+            self.steps = list(fuzzer.VMUtils.GethVM.canonicalized(f))
+        # A gas difference at the tenth step
+        diverging = list(self.steps)
+        step = diverging[9]
+        diverging[9] = fuzzer.VMUtils.Step(step.pc, step.op, step.gas + 1, step.depth, step.stack, step.stack_digest)
+        self.geth = self.write("test-geth.trace.log.bin", self.steps)
+        self.parity = self.write("test-parity.trace.log.bin", diverging)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, steps):
+        path = os.path.join(self.tmpdir, name)
+        fuzzer.tracefile.write_trace(steps, path)
+        return path
+
+    def expected(self, names, traces):
+        return fuzzer.VMUtils.signature_key(fuzzer.VMUtils.trace_divergence(traces, names)[2])
+
+    def test_signature(self):
+        diverging = list(fuzzer.tracefile.TraceReader(self.parity))
+        self.assertEqual(self.minimizer.reference_signature([self.parity, self.geth], ["geth", "parity"]),
+                         self.expected(["geth", "parity"], [self.steps, diverging]))
+        # The clients are compared in the order of the config
+        self.assertEqual(self.minimizer.reference_signature([self.geth, "cpp=%s" % self.parity], ["cpp", "geth"]),
+                         self.expected(["cpp", "geth"], [diverging, self.steps]))
+
+    def test_no_divergence(self):
+        other = self.write("other-parity.trace.log.bin", self.steps)
+        with self.assertRaises(ValueError):
+            self.minimizer.reference_signature([self.geth, other])
+        with self.assertRaises(ValueError):
+            self.minimizer.reference_signature([self.geth, os.path.join(self.tmpdir, "trace.bin")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+from evmlab import vm as VMUtils
+from evmlab import tracefile
+
+
+EXAMPLE_TRACE = os.path.join(os.path.dirname(__file__), "..", "files", "example_trace.txt")
+
+
+class TraceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "trace.bin")
+        with open(EXAMPLE_TRACE) as f:
+            self.steps = list(VMUtils.GethVM.canonicalized(f))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_round_trip(self):
+        records = [{"stateRoot": "0xdeadbeef"}]
+        num = tracefile.write_trace(self.steps + records, self.path)
+        self.assertEqual(num, len(self.steps))
+        self.assertTrue(tracefile.is_trace_file(self.path))
+        self.assertFalse(tracefile.is_trace_file(EXAMPLE_TRACE))
+
+        with tracefile.TraceReader(self.path) as reader:
+            self.assertEqual(len(reader), len(self.steps))
+            result = list(reader)
+        self.assertEqual(result, self.steps + records)
+        for (a, b) in zip(result, self.steps):
+            self.assertEqual(a.text(), b.text())
+            self.assertEqual([int(x, 16) for x in a.stack], [int(x, 16) for x in b.stack])
+
+    def test_random_access(self):
+        # Small checkpoint distance, so that stacks are reconstructed from deltas across checkpoints
+        checkpoint = tracefile.CHECKPOINT
+        tracefile.CHECKPOINT = 7
+        try:
+            tracefile.write_trace(self.steps, self.path)
+        finally:
+            tracefile.CHECKPOINT = checkpoint
+
+        with tracefile.TraceReader(self.path) as reader:
+            self.assertEqual(reader.pc[5], self.steps[5].pc)
+            self.assertEqual(reader.digest[-1], self.steps[-1].stack_digest)
+            for n in (len(self.steps) - 1, 0, 13, len(self.steps) // 2):
+                self.assertEqual(reader[n], self.steps[n])
+                self.assertEqual(VMUtils.StackDigest.digest(reader[n].stack), self.steps[n].stack_digest)
+            self.assertEqual(reader[-1], self.steps[-1])
+            self.assertRaises(IndexError, reader.__getitem__, len(self.steps))
+
+    def test_record_passes_steps_through(self):
+        passed = list(tracefile.record(iter(self.steps), self.path))
+        self.assertEqual(passed, self.steps)
+        with tracefile.TraceReader(self.path) as reader:
+            self.assertEqual(list(reader.steps()), self.steps)
+
+    def test_not_a_trace_file(self):
+        self.assertRaises(tracefile.TraceFileError, tracefile.TraceReader, EXAMPLE_TRACE)
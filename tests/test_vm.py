@@ -0,0 +1,314 @@
+import os
+import time
+import itertools
+import unittest
+from evmlab import vm as VMUtils
+
+
+EXAMPLE_TRACE = os.path.join(os.path.dirname(__file__), "..", "files", "example_trace.txt")
+
+
+def trace(n, diff_at=None, diff_len=1):
+    for i in range(n):
+        if diff_at is not None and diff_at <= i < diff_at + diff_len:
+            yield "step %d (bad)" % i
+        else:
+            yield "step %d" % i
+
+
+class CompareTracesTest(unittest.TestCase):
+
+    def test_streaming_equivalent(self):
+        (equivalent, summary) = VMUtils.compare_traces_streaming([trace(1000), trace(1000)], ["a", "b"])
+        self.assertTrue(equivalent)
+        self.assertEqual(summary, [])
+
+    def test_streaming_matches_full_comparison(self):
+        names = ["a", "b", "c"]
+        (equivalent, full_output) = VMUtils.compare_traces([list(trace(100)), list(trace(100, 50)), list(trace(100))], names)
+        (s_equivalent, summary) = VMUtils.compare_traces_streaming([trace(100), trace(100, 50), trace(100)], names)
+        self.assertFalse(equivalent)
+        self.assertFalse(s_equivalent)
+        # 20 preceding steps, the marker, and the diff-section
+        self.assertEqual(summary[:20], full_output[30:50])
+        self.assertEqual(summary[20], "\n---- [ 50 steps in total before diff ]-------\n\n")
+        self.assertEqual(summary[21:], full_output[50:57])
+
+    def test_streaming_stops_after_window(self):
+        consumed = []
+
+        def counting(gen):
+            for step in gen:
+                consumed.append(step)
+                yield step
+
+        (equivalent, summary) = VMUtils.compare_traces_streaming([counting(trace(10000)), trace(10000, 10, diff_len=3)],
+                                                                 ["a", "b"], n=5, window=3)
+        self.assertFalse(equivalent)
+        self.assertEqual(len(consumed), 13)
+        self.assertEqual(len(summary), 5 + 1 + 3 * 2)
+
+    def test_verdict_step_budget(self):
+        (verdict, summary) = VMUtils.trace_verdict([trace(1000), trace(1000)], ["a", "b"], max_steps=100)
+        self.assertEqual(verdict, VMUtils.TRUNCATED)
+        self.assertEqual(summary, [])
+        # Steps beyond the budget are not compared
+        (verdict, _) = VMUtils.trace_verdict([trace(1000), trace(1000, 500)], ["a", "b"], max_steps=100)
+        self.assertEqual(verdict, VMUtils.TRUNCATED)
+        (verdict, _) = VMUtils.trace_verdict([trace(1000), trace(1000, 50)], ["a", "b"], max_steps=100)
+        self.assertEqual(verdict, VMUtils.DIVERGED)
+        (verdict, _) = VMUtils.trace_verdict([trace(100), trace(100)], ["a", "b"], max_steps=100)
+        self.assertEqual(verdict, VMUtils.PASS)
+
+    def test_verdict_cut_output(self):
+        # A trace cut off before the budget ends early, which isn't a divergence
+        (verdict, summary) = VMUtils.trace_verdict([trace(1000), trace(80)], ["a", "b"], max_steps=100, cut=[False, True])
+        self.assertEqual((verdict, summary), (VMUtils.TRUNCATED, []))
+        # Both cut at the same step: nothing after it, e.g. the post-state, was compared
+        (verdict, _) = VMUtils.trace_verdict([trace(80), trace(80)], ["a", "b"], max_steps=100, cut=[True, True])
+        self.assertEqual(verdict, VMUtils.TRUNCATED)
+        # A diff before the cut still counts
+        (verdict, _) = VMUtils.trace_verdict([trace(1000), trace(80, 50)], ["a", "b"], max_steps=100, cut=[False, True])
+        self.assertEqual(verdict, VMUtils.DIVERGED)
+        # The trace which wasn't cut ended first
+        (verdict, _) = VMUtils.trace_verdict([trace(50), trace(80)], ["a", "b"], max_steps=100, cut=[False, True])
+        self.assertEqual(verdict, VMUtils.DIVERGED)
+
+    def test_streaming_different_lengths(self):
+        (equivalent, summary) = VMUtils.compare_traces_streaming([trace(10), trace(12)], ["a", "b"])
+        self.assertFalse(equivalent)
+        self.assertIn("[!!]       a None", summary)
+
+    def test_divergence_signature(self):
+        def steps(gas_at_end, n=10):
+            for i in range(n):
+                yield VMUtils.Step(i, 0x60, 1000 - i, 1, ["0x1"] * (i % 3))
+            yield VMUtils.Step(n, 0x55, gas_at_end, 1, ["0x1", "0x2"])
+
+        (verdict, summary, signature) = VMUtils.trace_divergence(
+            [steps(900), steps(800), steps(900)], ["geth", "parity", "besu"])
+        self.assertEqual(verdict, VMUtils.DIVERGED)
+        self.assertEqual(signature, {"op": "SSTORE", "previous": "PUSH1", "depth": 1, "fields": ["gas"],
+                                     "clients": [["besu", "geth"], ["parity"]]})
+        self.assertEqual(VMUtils.signature_key(signature),
+                         "SSTORE after PUSH1 depth 1: gas differ between besu,geth / parity")
+
+        # The same bug in a different test has the same signature
+        (_, _, other) = VMUtils.trace_divergence([steps(900, n=4), steps(1, n=4)], ["geth", "parity"])
+        self.assertEqual(VMUtils.signature_key(other), VMUtils.signature_key(
+            dict(signature, clients=[["geth"], ["parity"]])))
+
+        # A trace that ends early
+        (_, _, signature) = VMUtils.trace_divergence([steps(900), itertools.islice(steps(900), 5)],
+                                                    ["geth", "parity"])
+        self.assertEqual(signature["fields"], ["missing"])
+
+        (verdict, _, signature) = VMUtils.trace_divergence([steps(900), steps(900)], ["geth", "parity"])
+        self.assertEqual(verdict, VMUtils.PASS)
+        self.assertIsNone(signature)
+
+
+class StepTest(unittest.TestCase):
+
+    def test_step_text(self):
+        step = VMUtils.Step(12, 0x3f, 0x41f0f7, 0, ['0x7bb8', '0xa4fb3dba573f5003'])
+        legacy = {'pc': 12, 'gas': '0x41f0f7', 'op': 63, 'depth': 0, 'stack': ['0x7bb8', '0xa4fb3dba573f5003']}
+        self.assertEqual(VMUtils.toText(step), VMUtils.toText(legacy))
+
+        stack = ["0x%x" % i for i in range(10)]
+        step = VMUtils.Step(3, 0x01, 100, 1, stack)
+        legacy = {'pc': 3, 'gas': '0x64', 'op': 1, 'depth': 1, 'stack': stack}
+        self.assertEqual(VMUtils.toText(step), VMUtils.toText(legacy))
+
+    def test_step_equality(self):
+        stack = ["0x%x" % i for i in range(10)]
+        a = VMUtils.Step(3, 0x01, 100, 1, stack)
+        self.assertEqual(a, VMUtils.Step(3, 0x01, 100, 1, list(stack)))
+        self.assertNotEqual(a, VMUtils.Step(3, 0x01, 101, 1, stack))
+        # A difference deep down in the stack is not visible in the text, but still detected
+        self.assertNotEqual(a, VMUtils.Step(3, 0x01, 100, 1, ["0x1"] + stack[1:]))
+        self.assertNotEqual(a, {'stateRoot': '0x00'})
+
+    def test_canonicalized_steps(self):
+        with open(EXAMPLE_TRACE) as f:
+            steps = list(VMUtils.GethVM.canonicalized(f))
+        self.assertTrue(all(isinstance(s, VMUtils.Step) for s in steps))
+        self.assertEqual(steps[0].text(),
+                         "pc     0 op      PUSH1( 96) gas 0x47b760 depth  0 stack []")
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_coverage_features(self):
+        steps = [
+            VMUtils.Step(0, 0x60, 100, 1, []),  # PUSH1
+            VMUtils.Step(2, 0xf1, 97, 1, ["0x0"] * 5 + ["0x2", "0xffff"]),  # CALL to a precompile
+            VMUtils.Step(3, 0xf1, 90, 1, ["0x0"] * 5 + ["0x1234", "0xffff"]),  # CALL to a contract
+            VMUtils.Step(0, 0x54, 50, 2, ["0x0"]),  # SLOAD in the callee, which then runs out of gas
+            VMUtils.Step(4, 0x50, 40, 1, ["0x0"]),  # POP, back in the caller
+        ]
+        stats = VMUtils.Stats(coverage=True)
+        self.assertEqual(list(stats.traceStats(iter(steps))), steps)
+        self.assertEqual(stats.features, {
+            ("bigram", 0x60, 0xf1), ("bigram", 0xf1, 0xf1), ("bigram", 0xf1, 0x54), ("bigram", 0x54, 0x50),
+            ("depth", 0x60, 1), ("depth", 0xf1, 1), ("depth", 0x54, 2), ("depth", 0x50, 1),
+            ("precompile", 0xf1, 2),
+            ("exit", 0x54), ("exit", 0x50),
+        })
+        self.assertEqual(stats.result(), {"maxDepth": 2, "constatinopleOps": 0})
+
+        # Without coverage, no features are collected
+        stats = VMUtils.Stats()
+        list(stats.traceStats(iter(steps)))
+        self.assertIsNone(stats.features)
+
+
+class StackDigestTest(unittest.TestCase):
+
+    def test_incremental_matches_full(self):
+        with open(EXAMPLE_TRACE) as f:
+            steps = list(VMUtils.GethVM.canonicalized(f))
+        self.assertTrue(any(s.depth > 0 for s in steps))
+        for step in steps:
+            self.assertEqual(step.stack_digest, VMUtils.StackDigest.digest(step.stack))
+
+    def test_calls_and_irregular_stacks(self):
+        digests = VMUtils.StackDigest()
+        trace = [
+            (0x60, 0, ["0x1"]),  # PUSH1
+            (0x60, 0, ["0x1", "0x2"]),
+            (0x80, 0, ["0x1", "0x2", "0x3", "0x4", "0x5", "0x6", "0x7"]),  # DUP1 (after the previous one)
+            (0xf1, 0, ["0x1", "0x2", "0x3", "0x4", "0x5", "0x6", "0x7", "0x7"]),  # CALL
+            (0x60, 1, []),  # PUSH1 in the callee
+            (0x01, 1, ["0x5"]),  # ADD, underflows
+            (0x50, 0, ["0x1", "0x0"]),  # POP, back in the caller
+            (0x5b, 0, ["0x1"]),  # JUMPDEST
+            (0x5b, 0, ["0x1", "0x9"]),  # stack which doesn't fit the previous op
+        ]
+        for (op, depth, stack) in trace:
+            self.assertEqual(digests.update(op, depth, stack), VMUtils.StackDigest.digest(stack))
+
+    def test_corrupted_deep_item(self):
+        stack = ["0x%x" % n for n in range(20)]
+        swapped = stack[:-2] + [stack[-1], stack[-2]]
+        correct = VMUtils.StackDigest()
+        corrupt = VMUtils.StackDigest()
+        self.assertEqual(correct.update(0x90, 0, stack), corrupt.update(0x90, 0, stack))  # SWAP1
+        # A SWAP1 which also overwrites the bottom item
+        corrupted = ["0x99"] + swapped[1:]
+        self.assertNotEqual(correct.update(0x50, 0, swapped), corrupt.update(0x50, 0, corrupted))
+        self.assertEqual(corrupt.update(0x5b, 0, corrupted[:-1]), VMUtils.StackDigest.digest(corrupted[:-1]))
+        # Unverified, only the items around the top are checked
+        unverified = VMUtils.StackDigest(verify=False)
+        unverified.update(0x90, 0, stack)
+        self.assertEqual(unverified.update(0x50, 0, corrupted), VMUtils.StackDigest.digest(swapped))
+
+    def test_digest_normalizes_formatting(self):
+        self.assertEqual(VMUtils.StackDigest.digest(["0x0a", "0x00"]), VMUtils.StackDigest.digest(["0xa", "0x0"]))
+        self.assertNotEqual(VMUtils.StackDigest.digest(["0x0"]), VMUtils.StackDigest.digest([]))
+        self.assertNotEqual(VMUtils.StackDigest.digest(["0x1", "0x2"]), VMUtils.StackDigest.digest(["0x2", "0x1"]))
+
+
+class CanonicalizerTest(unittest.TestCase):
+
+    def tearDown(self):
+        VMUtils.set_json_decoder()
+
+    def test_json_decoders_agree(self):
+        with open(EXAMPLE_TRACE) as f:
+            lines = f.readlines()
+        results = []
+        for name in VMUtils.JSON_DECODERS:
+            self.assertEqual(VMUtils.set_json_decoder(name), name)
+            results.append(list(VMUtils.GethVM.canonicalized(lines)))
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
+        self.assertRaises(ValueError, VMUtils.set_json_decoder, "nosuchdecoder")
+
+    def test_geth_skips_non_steps(self):
+        lines = [
+            '{"pc":0,"op":96,"gas":"0x10","gasCost":"0x3","memory":"0x","memSize":0,"stack":[],"depth":1,"error":null,"opName":"PUSH1"}\n',
+            '{"pc":2,"op":0,"gas":"0xd","gasCost":"0x0","memory":"0x","memSize":0,"stack":["0x1"],"depth":1,"error":null,"opName":"STOP"}\n',
+            '{"output":"","gasUsed":"0x3","time":1234}\n',
+            'INFO [01-01|00:00:00] some log line\n',
+            '{"stateRoot": "0xdeadbeef"}\n',
+        ]
+        steps = list(VMUtils.GethVM.canonicalized(lines))
+        self.assertEqual(steps, [VMUtils.Step(0, 0x60, 0x10, 0, []), {"stateRoot": "0xdeadbeef"}])
+
+    def test_hera_stack(self):
+        lines = ['{"pc":1,"op":1,"gas":16,"depth":0,"stack":["0x0000000a","0x00","0x10"]}']
+        steps = list(VMUtils.HeraVM.canonicalized(lines))
+        self.assertEqual(steps, [VMUtils.Step(1, 1, 16, 0, ["0x10", "0x0", "0xa"])])
+
+    def test_cpp_duplicates(self):
+        step = '{"pc":%d,"op":"PUSH1","gas":"%d","depth":0,"stack":[]}'
+        lines = ["[%s]" % ",".join([step % (0, 10), step % (2, 7), step % (2, 7), step % (4, 4)]),
+                 '{"stateRoot": "0xdeadbeef"}.']
+        steps = list(VMUtils.CppVM.canonicalized(lines))
+        self.assertEqual([s.pc for s in steps[:-1]], [0, 2, 4])
+        self.assertEqual(steps[-1], {"stateRoot": "0xdeadbeef"})
+
+    def test_split_geth_batch(self):
+        step = '{"pc":0,"op":96,"gas":"0x10","gasCost":"0x3","memory":"0x","memSize":0,"stack":[],"depth":1,"error":null,"opName":"PUSH1"}'
+        lines = [step, '{"output":"","gasUsed":"0x3","time":1234}', '{"stateRoot": "0x01"}',
+                 step, step, '{"output":"","gasUsed":"0x6","time":1234}', '{"stateRoot": "0x02"}',
+                 '[', '  {', '    "name": "testB",', '    "pass": false', '  },',
+                 '  {', '    "name": "testA",', '    "pass": false', '  }', ']']
+        segments = VMUtils.GethVM.splitBatch(lines)
+        self.assertEqual([name for (name, _) in segments], ["testB", "testA"])
+        self.assertEqual(segments[1][1], lines[3:7])
+        self.assertEqual(len(list(VMUtils.GethVM.canonicalized(segments[1][1]))), 3)
+        # A test without stateRoot makes the output ambiguous
+        self.assertIsNone(VMUtils.GethVM.splitBatch(lines[:2] + lines[3:]))
+        self.assertIsNone(VMUtils.GethVM.splitBatch(lines[:7]))
+
+    def test_split_parity_batch(self):
+        step = '{"pc":0,"op":96,"opName":"PUSH1","gas":"0x10","stack":[],"storage":{},"depth":1}'
+        lines = ['{"action":"starting","test":"testA:byzantium:0"}', step,
+                 '{"error":"State root mismatch","gasUsed":"0x3","time":1}',
+                 '{"action":"starting","test":"testB:byzantium:0"}', step, step]
+        segments = VMUtils.ParityVM.splitBatch(lines)
+        self.assertEqual(segments, [("testA", lines[0:3]), ("testB", lines[3:6])])
+        self.assertIsNone(VMUtils.ParityVM.splitBatch([step] + lines))
+        self.assertIsNone(VMUtils.ParityVM.splitBatch(lines + lines[:2]))
+
+    def test_post_state(self):
+        root = "a" * 64
+        geth = ['[', '  {', '    "name": "testA",', '    "pass": false,', '    "stateRoot": "0x%s",' % root.upper(),
+                '    "fork": "Byzantium"', '  }', ']']
+        parity = ['{"error":"State root mismatch (got: 0x%s, expected: 0x%s)","gasUsed":"0x3","time":1}' % (root, "0" * 56 + "deadc0de")]
+        self.assertEqual(VMUtils.GethVM.postState(geth), {"stateRoot": root})
+        self.assertEqual(VMUtils.ParityVM.postState(parity), {"stateRoot": root})
+        self.assertEqual(VMUtils.GethVM.postState(geth[:3]), {})
+        self.assertEqual(VMUtils.ParityVM.postState([]), {})
+
+    def test_without_stacks(self):
+        with open(EXAMPLE_TRACE) as f:
+            steps = list(VMUtils.withoutStacks(VMUtils.GethVM.canonicalized(f)))
+        self.assertTrue(all(s.stack_size == 0 for s in steps if isinstance(s, VMUtils.Step)))
+        self.assertEqual(steps[0], VMUtils.Step(0, 0x60, 0x47b760, 0, []))
+
+
+class StreamProcTest(unittest.TestCase):
+
+    def test_stream_lines(self):
+        proc = VMUtils.startProc(["printf", "'a\\nb\\n'", ";", "echo", "err", "1>&2"])
+        self.assertEqual(list(VMUtils.streamProc(proc)), ["a", "b"])
+        self.assertIsNotNone(proc.returncode)
+
+        proc = VMUtils.startProc(["echo", "out", ";", "echo", "err", "1>&2"])
+        self.assertEqual(list(VMUtils.streamProc(proc, output="stderr")), ["err"])
+
+    def test_stream_timeout(self):
+        proc = VMUtils.startProc(["echo", "first", ";", "sleep", "20"])
+        t0 = time.time()
+        self.assertEqual(list(VMUtils.streamProc(proc, timeout=0.5)), ["first"])
+        self.assertLess(time.time() - t0, 10)
+
+    def test_stream_closed_early(self):
+        proc = VMUtils.startProc(["yes"])
+        lines = VMUtils.streamProc(proc)
+        self.assertEqual(list(itertools.islice(lines, 3)), ["y", "y", "y"])
+        lines.close()
+        self.assertIsNotNone(proc.returncode)
@@ -6,6 +6,7 @@ import unittest
 import json
 from evmlab.tools.statetests import rndval
 import evmlab.tools.statetests.templates
+from evmlab.tools.statetests.templates import statetest
 
 
 class EthFillerObjectifiedTest(unittest.TestCase):
@@ -27,3 +28,20 @@ class EthFillerObjectifiedTest(unittest.TestCase):
         import evmlab.tools.statetests.randomtest
         print(json.dumps(self.template, cls=evmlab.tools.statetests.randomtest.RandomTestsJsonEncoder))
 
+
+
+class StateTestTemplateCodegenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template = statetest.StateTestTemplate(nonce="0x1d", codegenerators={rndval.RndCodeBytes: 1}, fill_prestate_for_tx_to=True)
+
+    def test_main_codegen_state_account(self):
+        self.template.transaction.to = "0xb94f5374fce5edbc8e2a8697c15331677e6ebf0b"
+        self.template.fill()
+        self.assertEqual(self.template.main_codegen, "RndCodeBytes")
+
+    def test_main_codegen_precompile(self):
+        self.template.transaction.to = "0x0000000000000000000000000000000000000001"
+        self.template.fill()
+        self.assertIsNone(self.template.main_codegen)
+        self.assertNotIn("0x0000000000000000000000000000000000000001", self.template.pre)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Manages the compressed artefact stores of the fuzzer (see evmlab.artefacts)
+
+    python3 artefactstore.py migrate ../artefacts     # move the plain files into a store
+    python3 artefactstore.py ls ../artefacts
+    python3 artefactstore.py cat ../artefacts/<name>
+
+"""
+import logging
+from evmlab import artefacts
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(filename)s - %(funcName)20s() ][%(levelname)8s] %(message)s',
+                        level=logging.INFO)
+    artefacts.main()
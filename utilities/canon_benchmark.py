@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks trace canonicalization: the old approach (stdlib json, dict-steps formatted with toText)
+against the current canonicalizers, with each of the installed json decoders. Also measures the
+stack digests (see VMUtils.StackDigest) on deep stacks: rebuilt every step, incremental with the
+full check of the untouched items, and incremental without it.
+
+    python3 canon_benchmark.py [-f ../files/example_trace.txt] [-n 200] [--depth 1000]
+
+"""
+import argparse, json, time, os
+
+from evmlab import vm as VMUtils
+from evmlab import opcodes
+
+
+def legacy_geth_canonicalized(output):
+    """ The geth canonicalizer as it was before the canonicalizers were reworked """
+    addendum = []
+    counter = 0
+    for line in output:
+        if len(line) == 0:
+            continue
+        step = None
+        if line[0] == "{":
+            try:
+                step = json.loads(line)
+            except Exception:
+                pass
+        if step is None:
+            continue
+        if 'stateRoot' in step.keys():
+            addendum.append(step)
+            continue
+        if 'error' in step.keys() and 'output' in step.keys():
+            continue
+        if 'time' in step.keys():
+            continue
+        if not 'op' in step.keys():
+            continue
+        if step['op'] == 0:
+            continue
+        if step['opName'] == "" or step['op'] not in opcodes.opcodes:
+            continue
+        yield {
+            'pc': step['pc'],
+            'gas': step['gas'],
+            'op': step['op'],
+            'depth': step['depth'] - 1,
+            'stack': step['stack'],
+        }
+        counter = counter + 1
+
+    if counter > 0:
+        for step in addendum:
+            yield step
+
+
+def legacy(lines):
+    return [VMUtils.toText(step) for step in legacy_geth_canonicalized(lines)]
+
+
+def current(lines):
+    n = 0
+    for _ in VMUtils.GethVM.canonicalized(lines):
+        n = n + 1
+    return n
+
+
+def deep_stack_steps(depth, steps):
+    """ A trace of PUSH1/POP pairs on top of a stack of the given depth, as (op, stack) """
+    base = ["0x%x" % (n * 0x1000193) for n in range(depth)]
+    trace = []
+    for n in range(steps // 2):
+        trace.append((0x60, base))  # PUSH1
+        trace.append((0x50, base + ["0x%x" % n]))  # POP
+    return trace
+
+
+def rebuilt_digests(trace):
+    for (op, stack) in trace:
+        VMUtils.StackDigest.digest(stack)
+
+
+def incremental_digests(verify):
+    def run(trace):
+        digests = VMUtils.StackDigest(verify=verify)
+        for (op, stack) in trace:
+            # The clients report a new list every step
+            digests.update(op, 0, list(stack))
+    return run
+
+
+def measure(name, method, lines, rounds=3):
+    best = None
+    for _ in range(rounds):
+        t0 = time.time()
+        method(lines)
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    print("%-28s %8.3f s  %10.0f lines/s" % (name, best, len(lines) / best))
+    return best
+
+
+def main():
+    here = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description='Canonicalizer benchmark')
+    parser.add_argument("-f", "--file", default=os.path.join(here, "..", "files", "example_trace.txt"),
+                        help="geth/parity std-json trace to use as input")
+    parser.add_argument("-n", "--repeat", type=int, default=200, help="how many times to repeat the input")
+    parser.add_argument("--depth", type=int, default=1000, help="stack depth for the stack digest benchmark")
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        lines = f.readlines() * args.repeat
+
+    print("Input: %d lines from %s" % (len(lines), args.file))
+    before = measure("before (json + toText)", legacy, lines)
+    for name in VMUtils.JSON_DECODERS:
+        VMUtils.set_json_decoder(name)
+        after = measure("after (%s)" % name, current, lines)
+        print("%-28s %8.2fx" % ("", before / after))
+    VMUtils.set_json_decoder()
+
+    trace = deep_stack_steps(args.depth, 5000)
+    print("Stack digests: %d steps at depth %d" % (len(trace), args.depth))
+    rebuilt = measure("rebuilt every step", rebuilt_digests, trace)
+    for (name, verify) in (("incremental, verified", True), ("incremental, unverified", False)):
+        t = measure(name, incremental_digests(verify), trace)
+        print("%-28s %8.2fx" % ("", rebuilt / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,19 +33,17 @@ def execute(code, gas = 0xFFFF, verbose = False):
     intrinsic_geth_gas = VMUtils.getIntrinsicGas(code)
     print("Intrinsic gas: %s" % str(intrinsic_geth_gas) )
     # sys.exit(0)
-    g_out = gvm.execute(code = code, gas = gas,json=True, genesis = Genesis().export_geth())
-    p_out = pvm.execute(code = code, gas = gas,json=True, genesis = Genesis().export_parity())
+    # Both clients run concurrently, their output is canonicalized while they execute
+    g_out = gvm.stream(code = code, gas = gas,json=True, genesis = Genesis().export_geth())
+    p_out = pvm.stream(code = code, gas = gas,json=True, genesis = Genesis().export_parity())
 
     g_canon = VMUtils.GethVM.canonicalized(g_out)
     p_canon = VMUtils.ParityVM.canonicalized(p_out)
 
-    g_txt = [toText(x) for x in g_canon]
-    p_txt = [toText(x) for x in p_canon]
-
     import logging
     logger = logging.getLogger()
 
-    diff_found = vm.compare_traces([g_txt, p_txt],['Geth', 'Par'])
+    diff_found = vm.compare_traces([g_canon, p_canon],['Geth', 'Par'])
 
     return (diff_found , [], gvm.lastCommand, pvm.lastCommand)
 
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Runs the fuzzer on several machines: a coordinator hands out seeds and config to workers, which
+run the fuzzer locally, and report their stats and failures back over HTTP.
+
+    # On the coordinator (the web view, if flask is installed, is on port 8080)
+    python3 fuzzcluster.py coordinator --port 8090 -s DEFAULT.phases=untraced,traced
+
+    # On each worker, with its own statetests.ini for the local clients
+    python3 fuzzcluster.py worker --coordinator http://coordinator:8090 -c statetests.ini
+
+The protocol is json over HTTP POST:
+
+    /join    {host, seed}                 -> {worker, seed, config}
+    /report  {worker, status, failures}   -> {}, or 404 if the worker is unknown (it then re-joins)
+    /leave   {worker}                     -> {}
+
+Failures are reported with their test file and shortened trace. The full traces stay on the
+worker, to keep the reports small. A worker which re-joins passes the seed it is fuzzing with,
+which the coordinator keeps.
+
+GET /status returns the cluster status. Workers may join and leave at any time: a worker
+which hasn't reported for a while is considered gone, but its counts are kept.
+"""
+import json, sys, os, re, math, time, hashlib, base64, socket, threading, argparse, logging
+import urllib.request, urllib.error
+import http.server, socketserver
+
+import fuzzer
+from evmlab.artefacts import ArtefactStore
+
+logger = logging.getLogger(__name__)
+
+# The files of a failure which are sent to the coordinator: the test, which reproduces it, and
+# the shortened trace, which shows the divergence. The full traces stay with the worker
+REPORTED_ARTEFACTS = ("shortened_trace.log",)
+# Files above this size (in bytes) aren't sent, and requests above MAX_REQUEST are refused
+MAX_REPORT_FILE = 4 * 1024 * 1024
+MAX_REQUEST = 64 * 1024 * 1024
+# Failures are reported in batches of up to this many bytes of files, so that a backlog of them
+# (e.g. after the coordinator was unreachable) stays below MAX_REQUEST
+REPORT_BATCH = 16 * 1024 * 1024
+
+
+def failure_key(files):
+    """ Identifies a failure by its divergence: the differing lines of the shortened trace,
+    without the gas values, which are different for every test. Failures without a shortened
+    trace are only identified by their test file """
+    shortened = [content for (name, content) in files.items() if name.endswith("shortened_trace.log")]
+    if not shortened:
+        return hashlib.sha256("\n".join(sorted(files)).encode()).hexdigest()[:16]
+    lines = [line for line in shortened[0].splitlines() if line.startswith("[!!]")]
+    lines = [re.sub(r"gas\s+\S+", "", line) for line in lines]
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()[:16]
+
+
+class Coordinator(object):
+    """ Keeps track of the workers, their stats and the (deduplicated) failures """
+
+    def __init__(self, artefacts, config=None, seed=None, timeout=120):
+        self.artefacts = artefacts
+        # Config overrides (section.key=value) handed out to the workers
+        self.config = config or []
+        self.seed = seed or "%016x" % int.from_bytes(os.urandom(8), "big")
+        # Workers which haven't reported for this many seconds are considered gone
+        self.timeout = timeout
+        self.start_time = time.time()
+        self.workers = {}
+        self.failures = {}
+        self._joined = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.artefacts, exist_ok=True)
+        # The files of the failures are kept compressed, see evmlab.artefacts
+        self.store = ArtefactStore(self.artefacts)
+
+    def join(self, host, seed=None):
+        """ Registers a worker, and hands out its seed: the base seed, with the number of the
+        worker. Each worker derives the seeds of its generators from it, see fuzzer.derive_seed.
+        A worker which re-joins (e.g. after the coordinator was restarted) passes the seed it's
+        already fuzzing with, and keeps it """
+        with self._lock:
+            worker = "w%d" % self._joined
+            self._joined = self._joined + 1
+            self.workers[worker] = {"host": host, "seed": seed or "%s-%s" % (self.seed, worker),
+                                    "joined": time.time(), "lastSeen": time.time(), "status": {}}
+        logger.info("Worker %s joined from %s" % (worker, host))
+        return {"worker": worker, "seed": self.workers[worker]["seed"], "config": self.config}
+
+    def report(self, worker, status, failures):
+        """ Handles a report of a worker. Returns False if the worker is unknown """
+        with self._lock:
+            if worker not in self.workers:
+                return False
+            self.workers[worker]["status"] = status
+            self.workers[worker]["lastSeen"] = time.time()
+        for failure in failures:
+            self.addFailure(worker, failure)
+        return True
+
+    def leave(self, worker):
+        with self._lock:
+            if worker in self.workers:
+                # The counts of the worker are kept, but it no longer counts as active
+                self.workers[worker]["lastSeen"] = 0
+        logger.info("Worker %s left" % worker)
+
+    def addFailure(self, worker, failure):
+        """ Stores a failure reported by a worker. Only the first failure with a given key is saved,
+        later ones are only counted """
+        files = {name: base64.b64decode(content) for (name, content) in failure["files"].items()}
+        # Failures are grouped by their divergence signature, if the worker computed one
+        key = failure["artefacts"].get("signature") or \
+            failure_key({name: content.decode(errors="replace") for (name, content) in files.items()})
+        with self._lock:
+            if key in self.failures:
+                self.failures[key]["count"] = self.failures[key]["count"] + 1
+                self.failures[key]["workers"].add(worker)
+                return
+            # Only the files which were sent can be downloaded, the full traces stay with the worker
+            other = [name for name in failure["artefacts"]["other"] if name in files]
+            self.failures[key] = dict(failure["artefacts"], traces=[], other=other, count=1, workers={worker}, key=key)
+        for (name, content) in files.items():
+            self.store.put(os.path.basename(name), data=content)
+        logger.warning("New failure %s from %s: %s" % (key, worker, failure["artefacts"]["id"]))
+
+    def active(self, info):
+        return time.time() - info["lastSeen"] < self.timeout
+
+    @staticmethod
+    def traceStats(active):
+        """ The trace-length stats of TestExecutor.status, over the last traces of all active
+        workers: the means are weighted by their number of traces, the rest is combined """
+        stats = [info["status"] for info in active if info["status"].get("numTraces")]
+        if not stats:
+            return {key: "NA" for key in ("mean", "stdev", "numZero", "max", "maxDepth", "numConst")}
+        n = sum(s["numTraces"] for s in stats)
+        mean = sum(s["numTraces"] * s["mean"] for s in stats) / n
+        stdev = "NA"
+        if n > 2 and all(s["stdev"] != "NA" for s in stats):
+            # The pooled sample variance, from the sum of squares of each worker
+            squares = sum((s["numTraces"] - 1) * s["stdev"] ** 2 + s["numTraces"] * s["mean"] ** 2 for s in stats)
+            stdev = math.sqrt(max(squares - n * mean ** 2, 0) / (n - 1))
+        return {
+            "mean": mean,
+            "stdev": stdev,
+            "numZero": sum(s["numZero"] for s in stats),
+            "max": max(s["max"] for s in stats),
+            "maxDepth": max(s["maxDepth"] for s in stats),
+            "numConst": sum(s["numTraces"] * s["numConst"] for s in stats) / n,
+        }
+
+    def status(self):
+        """ The cluster status, with the keys of TestExecutor.status which can be summed up """
+        from datetime import datetime
+        with self._lock:
+            workers = {worker: dict(info) for (worker, info) in self.workers.items()}
+            failures = sorted(self.failures.values(), key=lambda f: -f["count"])
+        total = lambda key: sum(info["status"].get(key, 0) for info in workers.values())
+        active = [info for info in workers.values() if self.active(info)]
+        return {
+            "starttime": datetime.utcfromtimestamp(self.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+            "pass": total("pass"),
+            "fail": total("fail"),
+            "truncated": total("truncated"),
+            "failures": [dict(f, workers=sorted(f["workers"])) for f in failures],
+            "speed": sum(info["status"].get("speed", 0) for info in active),
+            "activeTests": sum(info["status"].get("activeTests", 0) for info in active),
+            "activeSockets": sum(info["status"].get("activeSockets", 0) for info in active),
+            **self.traceStats(active),
+            "workers": {worker: {
+                "host": info["host"],
+                "seed": info["seed"],
+                "active": self.active(info),
+                "lastSeen": round(time.time() - info["lastSeen"]) if info["lastSeen"] else "left",
+                "pass": info["status"].get("pass", 0),
+                "fail": info["status"].get("fail", 0),
+                "speed": info["status"].get("speed", 0),
+            } for (worker, info) in sorted(workers.items())},
+        }
+
+
+def handler(coordinator):
+
+    class CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+
+        def respond(self, code, obj):
+            data = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/status":
+                return self.respond(404, {"error": "not found"})
+            self.respond(200, coordinator.status())
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                if length > MAX_REQUEST:
+                    self.close_connection = True
+                    return self.respond(413, {"error": "request too large"})
+                request = json.loads(self.rfile.read(length).decode())
+                if self.path == "/join":
+                    return self.respond(200, coordinator.join(request.get("host", self.client_address[0]),
+                                                              request.get("seed")))
+                if self.path == "/report":
+                    if not coordinator.report(request["worker"], request["status"], request.get("failures", [])):
+                        return self.respond(404, {"error": "unknown worker"})
+                    return self.respond(200, {})
+                if self.path == "/leave":
+                    coordinator.leave(request["worker"])
+                    return self.respond(200, {})
+                self.respond(404, {"error": "not found"})
+            except (ValueError, KeyError) as e:
+                self.respond(400, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return CoordinatorHandler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Like http.server.ThreadingHTTPServer, which needs python 3.7 """
+    daemon_threads = True
+
+
+def serve(coordinator, host="0.0.0.0", port=8090):
+    """ Starts the coordinator's HTTP server on a thread, returns the server """
+    server = ThreadingHTTPServer((host, port), handler(coordinator))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Coordinator listening on %s:%d" % (host, server.server_address[1]))
+    return server
+
+
+def request(url, path, obj, timeout=30):
+    req = urllib.request.Request(url.rstrip("/") + path, data=json.dumps(obj).encode(),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read().decode())
+
+
+class Worker(object):
+    """ Runs the fuzzer locally, with the seed and config from the coordinator, and reports
+    its stats and failures every interval seconds """
+
+    def __init__(self, url, args, interval=30):
+        self.url = url
+        self.args = args
+        self.interval = interval
+        self.worker = None
+        self.seed = None
+        self.executor = None
+        # The number of failures of the executor that have been reported
+        self._reported = 0
+
+    def join(self):
+        """ Joins the coordinator. Once the fuzzer runs, its seed is kept when re-joining """
+        response = request(self.url, "/join", {"host": socket.gethostname(), "seed": self.seed})
+        self.worker = response["worker"]
+        self.seed = response["seed"]
+        logger.info("Joined as %s with seed %s" % (self.worker, self.seed))
+        return response
+
+    def config(self, response):
+        """ The fuzzer config: the local statetests.ini, overridden by the coordinator """
+        overrides = list(self.args.set_config) + list(response["config"])
+        overrides.append("DEFAULT.generator_seed=%s" % response["seed"])
+        args = argparse.Namespace(configfile=self.args.configfile, set_config=overrides)
+        return fuzzer.Config(args)
+
+    def failure(self, artefacts):
+        """ The artefacts of a failing test, with the contents of the test file and the shortened
+        trace (see REPORTED_ARTEFACTS). The other files are listed, but only kept by the worker """
+        names = [artefacts["file"]] + [name for name in artefacts["other"] if name.endswith(REPORTED_ARTEFACTS)]
+        store = self.executor._fuzzer.store
+        files = {}
+        for name in names:
+            path = os.path.join(self.executor._fuzzer._config.artefacts, name)
+            try:
+                with (store.open(name) if store is not None else open(path, "rb")) as f:
+                    content = f.read(MAX_REPORT_FILE + 1)
+            except IOError as e:
+                logger.warning("Failed to read artefact %s: %s" % (path, e))
+                continue
+            if len(content) > MAX_REPORT_FILE:
+                logger.warning("Not sending artefact %s, it's larger than %d bytes" % (name, MAX_REPORT_FILE))
+                continue
+            files[name] = base64.b64encode(content).decode()
+        return {"artefacts": artefacts, "files": files}
+
+    def report(self):
+        """ Sends the status, and the failures which haven't been reported yet, in batches of up
+        to REPORT_BATCH bytes. The artefacts of a failure are only read when its batch is sent """
+        status = self.executor.status()
+        failures = status.pop("failures")
+        pending = iter(failures[self._reported:])
+        size = lambda failure: sum(len(content) for content in failure["files"].values())
+        carry = None
+        while True:
+            batch = [carry] if carry is not None else []
+            batchSize = sum(size(failure) for failure in batch)
+            carry = None
+            for artefacts in pending:
+                failure = self.failure(artefacts)
+                if batch and batchSize + size(failure) > REPORT_BATCH:
+                    carry = failure
+                    break
+                batch.append(failure)
+                batchSize = batchSize + size(failure)
+            try:
+                request(self.url, "/report", {"worker": self.worker, "status": status, "failures": batch})
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    # The coordinator doesn't know us (anymore), e.g. because it was restarted
+                    logger.warning("Coordinator does not know %s, joining again" % self.worker)
+                    self.join()
+                    return
+                if e.code != 413 or len(batch) != 1:
+                    raise
+                # Retrying won't help, so the failure is only kept by the worker
+                logger.warning("Coordinator refused failure %s, it's too large" % batch[0]["artefacts"]["id"])
+            self._reported = self._reported + len(batch)
+            if carry is None:
+                return
+
+    def reportLoop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except (urllib.error.URLError, OSError) as e:
+                # The coordinator is unreachable, keep fuzzing and try again later
+                logger.warning("Failed to report to %s: %s" % (self.url, e))
+
+    def run(self):
+        f = fuzzer.Fuzzer(config=self.config(self.join()))
+        self.executor = fuzzer.TestExecutor(fuzzer=f)
+        threading.Thread(target=self.reportLoop, daemon=True).start()
+        f.start_daemons()
+        try:
+            self.executor.startFuzzing()
+        finally:
+            f.stop_daemons()
+            try:
+                request(self.url, "/leave", {"worker": self.worker})
+            except (urllib.error.URLError, OSError):
+                pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Distributed consensus fuzzer')
+    sub = parser.add_subparsers(dest="mode")
+    sub.required = True
+
+    coord = sub.add_parser("coordinator", help="hand out seeds and config, and collect the results")
+    coord.add_argument("--host", default="0.0.0.0", help="address to listen on (default: 0.0.0.0)")
+    coord.add_argument("--port", type=int, default=8090, help="port to listen on (default: 8090)")
+    coord.add_argument("--seed", default=None, help="base seed for the workers (default: random)")
+    coord.add_argument("--artefacts", default="artefacts", help="where failures are stored (default: ./artefacts)")
+    coord.add_argument("--timeout", type=int, default=120,
+                       help="seconds after which a silent worker is considered gone (default: 120)")
+    coord.add_argument("-s", "--set-config", default=[], nargs='*',
+                       help="config overrides for the workers, as <section>.<key>=<value>")
+
+    work = sub.add_parser("worker", help="run the fuzzer, and report to the coordinator")
+    work.add_argument("--coordinator", required=True, help="url of the coordinator, e.g. http://host:8090")
+    work.add_argument("-c", "--configfile", default="statetests.ini",
+                      help="path to configuration file (default: statetests.ini)")
+    work.add_argument("-s", "--set-config", default=[], nargs='*', help="local config overrides")
+    work.add_argument("--interval", type=int, default=30, help="seconds between reports (default: 30)")
+
+    args = parser.parse_args()
+
+    if args.mode == "worker":
+        Worker(args.coordinator, args, interval=args.interval).run()
+        return
+
+    coordinator = Coordinator(os.path.abspath(args.artefacts), config=args.set_config,
+                              seed=args.seed, timeout=args.timeout)
+    serve(coordinator, args.host, args.port)
+    try:
+        import fuzzerweb
+        fuzzerweb.serve(coordinator.status, ["Coordinator, base seed %s" % coordinator.seed] + args.set_config,
+                        coordinator.artefacts)
+    except (ImportError, SystemExit):
+        logger.warning("No web view, see http://%s:%d/status" % (args.host, args.port))
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,23 @@
 Executes state tests on multiple clients, checking for EVM trace equivalence
 
 """
-import json, sys, os, time, collections, shutil
+import json, sys, os, io, time, collections, shutil, random, hashlib
+import socket as socketlib
 import configparser, getpass
-import signal
-import argparse, queue, threading
+import signal, subprocess, resource
+import cProfile, pstats, tracemalloc
+import argparse, queue, threading, itertools, shlex
+import concurrent.futures, multiprocessing, multiprocessing.connection
+import asyncio, contextlib
 import select
+import evmdasm.registry
 import docker
 import logging
+import struct
 
 from evmlab import vm as VMUtils
+from evmlab import tracefile
+from evmlab.artefacts import ArtefactStore, is_store
 from evmlab.tools.statetests.templates import statetest
 
 logger = logging.getLogger(__name__)
@@ -111,6 +119,139 @@ class Config(object):
         # expose default section
         self.default = self._config[uname]
 
+        # Store the traces of failing tests in the binary trace format as well (see evmlab.tracefile)
+        self.binary_traces = self.default.getboolean('binary_traces', False)
+
+        # Traces are cut off after this many steps (0 = no limit). The clients are stopped
+        # once their output passes the budget, and the test is recorded as truncated
+        self.step_budget = self.default.getint('step_budget', 0) or None
+
+        # The phases each test goes through. Tests are first run in the cheapest phase, and only
+        # re-run in the next one if the clients disagree. The last phase is always a full trace:
+        #   untraced: no tracing, only the post-state (stateRoot) is compared
+        #   nostack:  trace pc/op/gas/depth, without stacks
+        #   traced:   full traces
+        self.phases = [p.strip() for p in self.default.get('phases', 'traced').split(",") if p.strip()]
+        for phase in self.phases:
+            if phase not in PHASES:
+                raise ValueError("Unknown phase '%s', choose from %s" % (phase, ", ".join(PHASES)))
+        if self.phases[-1:] != ["traced"]:
+            self.phases.append("traced")
+        if len(self.phases) > 1 and not set(self.clientNames) <= set(PHASE_CLIENTS):
+            logger.warning("Phases are only supported for %s, running traced only" % ", ".join(PHASE_CLIENTS))
+            self.phases = ["traced"]
+
+        # Number of tests packed into one statetest file, so each client is started once per batch
+        self.batch_size = self.default.getint('batch_size', 1)
+        if self.batch_size > 1 and not set(self.clientNames) <= set(BatchStateTest.CLIENTS):
+            logger.warning("Batch mode is only supported for %s, running single tests" % ", ".join(BatchStateTest.CLIENTS))
+            self.batch_size = 1
+        # Number of worker processes analyzing the traces, 0 to analyze them in the main loop
+        self.pool_size = self.default.getint('pool_size', 0)
+
+        # The max number of tests in flight, and the max number of concurrent execs per client
+        self.max_parallel = self.default.getint('max_parallel', 50)
+        self.concurrency = {client_name: self.default.getint('%s.concurrency' % client_name, self.max_parallel)
+                            for client_name in self.clientNames}
+        # With adaptive_concurrency (off by default), the number of concurrent execs of the clients
+        # whose concurrency isn't configured is tuned while fuzzing, between concurrency_min and
+        # concurrency_max (see ConcurrencyController). It is lowered while the load average per
+        # core is above concurrency_max_load, and re-evaluated every concurrency_interval seconds
+        self.adaptive_concurrency = self.default.getboolean('adaptive_concurrency', False)
+        self.fixed_concurrency = {client_name for client_name in self.clientNames
+                                  if not self.adaptive_concurrency or '%s.concurrency' % client_name in self.default}
+        self.concurrency_min = self.default.getint('concurrency_min', 1)
+        self.concurrency_max = self.default.getint('concurrency_max', self.max_parallel)
+        self.concurrency_max_load = self.default.getfloat('concurrency_max_load', 1.5)
+        self.concurrency_interval = self.default.getint('concurrency_interval', 10)
+
+        # How tests get to the clients, and traces back:
+        #   files: through the test and log files on the shared volume
+        #   pipes: the test is streamed to the client on stdin, and the trace read back from its
+        #          output (the exec socket, or the pipes of a native client). Nothing is written
+        #          to disk, unless the test fails or force_save is set, or an output is longer
+        #          than pipe_output_memory
+        self.io_mode = self.default.get('io_mode', 'files')
+        if self.io_mode not in ("files", "pipes"):
+            raise ValueError("Unknown io_mode '%s', choose from files, pipes" % self.io_mode)
+        if self.io_mode == "pipes" and self.batch_size > 1:
+            logger.warning("Batch mode is not supported with io_mode = pipes, running single tests")
+            self.batch_size = 1
+        # With io_mode = pipes, the output of a client is kept in memory up to this many MB. A
+        # longer output is written to its trace file as it's read, like with io_mode = files
+        self.pipe_output_memory = self.default.getint('pipe_output_memory', 4)
+
+        # Resource limits for clients which run natively (<client>.binary): address space in MB,
+        # and cpu time in seconds (0 = no limit)
+        self.binary_memory_limit = self.default.getint('binary_memory_limit', 0)
+        self.binary_cpu_limit = self.default.getint('binary_cpu_limit', 0)
+
+        # The number of daemon containers per client, tests go to the least busy one
+        self.instances = {client_name: self.default.getint('%s.instances' % client_name, 1)
+                          for client_name in self.clientNames}
+        # How often the containers are checked, and how long a job may run before its container
+        # is considered wedged, and restarted
+        self.health_check_interval = self.default.getint('health_check_interval', 30)
+        self.job_timeout = self.default.getint('job_timeout', 300)
+
+        # The number of failures per divergence signature which are saved in full (0 = all). Later
+        # failures with the same signature are only counted, in <artefacts>/signatures.jsonl
+        self.signature_examples = self.default.getint('signature_examples', 3)
+
+        # Collect coverage features from the traces (see VMUtils.Stats), and report their growth.
+        # With coverage_feedback, the code generators are steered towards under-covered behaviour
+        # every coverage_interval tests (see CoverageScheduler)
+        self.coverage_feedback = self.default.getboolean('coverage_feedback', False)
+        self.coverage = self.default.getboolean('coverage', False) or self.coverage_feedback
+        self.coverage_interval = self.default.getint('coverage_interval', 500)
+
+        # Profile the fuzzer for profile_duration seconds (cpu: cProfile, memory: tracemalloc),
+        # profile_after seconds after starting. Profiles can also be started by SIGUSR1 or fuzzerweb
+        self.profile = [k.strip() for k in self.default.get('profile', '').split(",") if k.strip()]
+        for kind in self.profile:
+            if kind not in Profiler.KINDS:
+                raise ValueError("Unknown profile '%s', choose from %s" % (kind, ", ".join(Profiler.KINDS)))
+        self.profile_after = self.default.getint('profile_after', 0)
+        self.profile_duration = self.default.getint('profile_duration', 60)
+        self.profile_top = self.default.getint('profile_top', 30)
+
+        # Every stats_interval seconds, the status and the stage latencies (see Metrics) are
+        # written to stats_file as json, if set
+        self.stats_file = self.default.get('stats_file', None)
+        self.stats_interval = self.default.getint('stats_interval', 60)
+
+        # Keep the artefacts of failing tests in a compressed, content-addressed store in the
+        # artefacts dir (see evmlab.artefacts), instead of as plain files. Off by default; an
+        # artefacts dir which already holds a store (see artefactstore.py migrate) is used as one
+        self.artefact_store = self.default.getboolean('artefact_store', False)
+
+        # Statically check the generated tests, and skip the ones which can't produce a useful
+        # trace (see PreFilter), off by default. prefilter_sample is the fraction of those which
+        # is run anyway
+        self.prefilter = self.default.getboolean('prefilter', False)
+        self.prefilter_sample = self.default.getfloat('prefilter_sample', 0.01)
+
+        # Cache the client outputs in trace_cache (a directory, off if unset), so that a client isn't
+        # run again on a test it has run before, as long as neither changed (see TraceCache). The
+        # least recently used entries are evicted once the cache grows past trace_cache_size MB
+        self.trace_cache = self.default.get('trace_cache', None)
+        if self.trace_cache:
+            self.trace_cache = resolve(self.trace_cache)
+        self.trace_cache_size = self.default.getint('trace_cache_size', 1024)
+
+        # Run the tests through a runner inside each client container, instead of a docker exec per test
+        self.runner = self.default.getboolean('runner', False)
+
+        # Number of processes generating tests, 0 to generate them on a thread of the main process.
+        # Each generator process seeds its RNG from generator_seed and its index, so a run can be
+        # reproduced by passing the seed that is logged at startup
+        self.generator_processes = self.default.getint('generator_processes', 0)
+        self.generator_seed = self.default.get('generator_seed', None) or "%016x" % int.from_bytes(os.urandom(8), "big")
+
+        if self.batch_size > 1 and self.phases[0] == "untraced":
+            logger.warning("Batch mode is not supported for untraced runs, running single tests")
+            self.batch_size = 1
+
         # expose all the codegen settings
         self.codegen = self._config["codegen"] if self._config.has_section("codegen") else None
 
@@ -139,6 +280,11 @@ class Config(object):
     def logfilesPath(self):
         return "%s/logs/" % self.temp_path
 
+    @property
+    def binaries(self):
+        """ The clients which run natively, with the path to their binary """
+        return {name: path for (name, isDocker, path) in self.active_clients if not isDocker}
+
     @property
     def clientNames(self):
         return [name for (name, y, z) in self.active_clients]
@@ -150,7 +296,9 @@ class Config(object):
         for (name, isDocker, path) in self.active_clients:
             out.append("  * {} : {} docker:{}".format(name, path, isDocker))
 
-        out.append("Test generator: native (py)")
+        out.append("Test generator: native (py), %s, seed %s" % (
+            "%d processes" % self.generator_processes if self.generator_processes > 0 else "thread",
+            self.generator_seed))
         out.append("Fork config:   %s" % self.fork_config)
         out.append("Artefacts:     %s" % self.artefacts)
         out.append("Tempfiles:     %s" % self.temp_path)
@@ -159,6 +307,12 @@ class Config(object):
         return out
 
 
+# The phases a test can be run in, cheapest first (see Config.phases)
+PHASES = ("untraced", "nostack", "traced")
+# The clients which can run untraced / stackless, and report their post-state
+PHASE_CLIENTS = {"geth": VMUtils.GethVM.postState, "parity": VMUtils.ParityVM.postState}
+
+
 class RawStateTest(object):
 
     def __init__(self, statetest, identifier, filename, config):
@@ -170,6 +324,47 @@ class RawStateTest(object):
         self.traceFiles = []
         self.additionalArtefacts = []
         self._config = config
+        self.socketEvent = ""
+        self.socketData = b''
+        self.stats = None
+        self.traceStats = None
+        # The verdict of the trace comparison, see VMUtils.trace_verdict
+        self.verdict = None
+        # The name of the code generator engine which generated the code the transaction runs
+        self.codegen = None
+        # Why the PreFilter rejected the test, if it's run anyway as a sample
+        self.prefilterReason = None
+        # The key of the divergence signature of a failing test, and whether its artefacts were saved
+        self.signature = None
+        self.saved = False
+        # Index into Config.phases, and when the processes of the current phase were started
+        self.phase = 0
+        self.startTime = None
+        # The serialized test, and the client outputs by trace location (io_mode = pipes)
+        self._data = None
+        self.outputs = {}
+        # The TraceCache keys of the clients run on the test, and the clients whose output came from the cache
+        self.cacheKeys = {}
+        self.cacheHits = set()
+        self._contentHash = None
+        # The clients whose output was cut off at the step budget (see Fuzzer.recordCut)
+        self.cut = set()
+
+    @property
+    def phaseName(self):
+        return self._config.phases[self.phase]
+
+    def nextPhase(self):
+        """ Prepares the test for a re-run in the next phase """
+        self.phase = self.phase + 1
+        self.procs = []
+        self.canon_traces = []
+        self.traceFiles = []
+        self.outputs = {}
+        self.verdict = None
+        self.cacheKeys = {}
+        self.cacheHits = set()
+        self.cut = set()
 
     @property
     def filename(self):
@@ -179,13 +374,39 @@ class RawStateTest(object):
     def id(self):
         return self.identifier
 
+    @property
+    def numTests(self):
+        return 1
+
     @property
     def fullfilename(self):
         return os.path.abspath("%s/%s" % (self._config.testfilesPath, self.filename))
 
-    def writeToFile(self):
-        # write to unique tmpfile
+    def serialized(self):
+        """ The statetest as json bytes """
+        if self._data is None:
+            self._data = json.dumps(self.statetest).encode()
+        return self._data
+
+    def contentHash(self):
+        """ A hash of what the test does: the tests, without their names and _info """
+        if self._contentHash is None:
+            tests = [{k: v for (k, v) in test.items() if k != "_info"} for test in self.statetest.values()]
+            self._contentHash = hashlib.sha256(json.dumps(tests, sort_keys=True).encode()).hexdigest()
+        return self._contentHash
+
+    def writeToFile(self, data=None):
+        # write to unique tmpfile, data is the already serialized statetest (if any)
+        if data is not None:
+            self._data = data
+        if self._config.io_mode == "pipes":
+            # The test is kept in memory, and only written when it's saved
+            return
         logger.debug("Writing file %s" % self.fullfilename)
+        if data is not None:
+            with open(self.fullfilename, 'wb') as outfile:
+                outfile.write(data)
+            return
         with open(self.fullfilename, 'w') as outfile:
             json.dump(self.statetest, outfile)
 
@@ -217,11 +438,19 @@ class RawStateTest(object):
         #
         self.traceFiles.append(filename)
 
-    def saveArtefacts(self):
+    def saveArtefacts(self, store=None):
+        """ Saves the test and its traces in the artefacts dir, or in the store if given """
+        if store is not None:
+            self._storeArtefacts(store)
+            return
         # Save the actual test json
         saveloc = "%s/%s" % (self._config.artefacts, self.filename)
         logger.info("Saving testcase as %s", saveloc)
-        shutil.move(self.fullfilename, saveloc)
+        if self._config.io_mode == "pipes":
+            with open(saveloc, "wb") as f:
+                f.write(self.serialized())
+        else:
+            shutil.move(self.fullfilename, saveloc)
 
         newTracefiles = []
 
@@ -229,16 +458,46 @@ class RawStateTest(object):
             fname = os.path.basename(f)
             newloc = "%s/%s" % (self._config.artefacts,fname)
             logger.info("Saving trace as %s", newloc)
-            shutil.move(f, newloc)
+            if f in self.outputs:
+                # Traces read over pipes were never written
+                with open(newloc, "wb") as out:
+                    out.write(self.outputs[f])
+            else:
+                shutil.move(f, newloc)
             newTracefiles.append(newloc)
 
         self.traceFiles = newTracefiles
 
-    def addArtefact(self, fname, data):
+    def _storeArtefacts(self, store):
+        logger.info("Storing testcase %s", self.filename)
+        if self._config.io_mode == "pipes":
+            store.put(self.filename, data=self.serialized())
+        else:
+            store.put(self.filename, path=self.fullfilename)
+            os.remove(self.fullfilename)
+
+        newTracefiles = []
+        for f in self.traceFiles:
+            fname = os.path.basename(f)
+            logger.info("Storing trace %s", fname)
+            if f in self.outputs:
+                store.put(fname, data=self.outputs[f])
+            else:
+                store.put(fname, path=f)
+                os.remove(f)
+            newTracefiles.append("%s/%s" % (self._config.artefacts, fname))
+
+        self.traceFiles = newTracefiles
+
+    def addArtefact(self, fname, data, store=None):
         fullpath = "%s/%s-%s" % (self._config.artefacts, self.id, fname)
-        logger.info("Saving artefact %s", fullpath)
-        with open(fullpath, "w+") as f:
-            f.write(data)
+        if store is not None:
+            logger.info("Storing artefact %s", os.path.basename(fullpath))
+            store.put(os.path.basename(fullpath), data=data)
+        else:
+            logger.info("Saving artefact %s", fullpath)
+            with open(fullpath, "w+") as f:
+                f.write(data)
         self.additionalArtefacts.append(fullpath)
 
     def listArtefacts(self):
@@ -247,6 +506,7 @@ class RawStateTest(object):
             "file": self.filename,
             "traces": [os.path.basename(f) for f in self.traceFiles],
             "other": [os.path.basename(f) for f in self.additionalArtefacts],
+            "signature": self.signature,
         }
 
 
@@ -269,7 +529,8 @@ class StateTest(RawStateTest):
 
 
             # Replace the top level name 'randomStatetest' with something meaningful (same as filename)
-        statetest['randomStatetest%s' % self.identifier] = statetest.pop('randomStatetest', None)
+        if 'randomStatetest' in statetest:
+            statetest['randomStatetest%s' % self.identifier] = statetest.pop('randomStatetest')
 
         self.statetest = statetest
         self.canon_traces = []
@@ -278,6 +539,1175 @@ class StateTest(RawStateTest):
         self.additionalArtefacts = []
 
 
+class BatchStateTest(RawStateTest):
+    """ A batch of StateTests, packed into one statetest file so that each client is started
+    once for the whole batch. Afterwards, the client outputs are split into a trace per test,
+    and each test is compared on its own.
+    """
+
+    # The clients whose batch output can be split, see GethVM.splitBatch and ParityVM.splitBatch
+    CLIENTS = {"geth": VMUtils.GethVM.splitBatch, "parity": VMUtils.ParityVM.splitBatch}
+
+    def __init__(self, tests, counter, config):
+        statetest = {}
+        for test in tests:
+            statetest.update(test.statetest)
+        identifier = "%s-batch-%d" % (config.host_id, counter)
+        super().__init__(statetest, identifier, fPool.get(), config=config)
+        self.tests = tests
+
+    @property
+    def numTests(self):
+        return len(self.tests)
+
+    def split(self):
+        """ Splits the client outputs into a trace-file per test, and hands the processes over to the
+        tests, so they can be processed as if they were run on their own.
+
+        returns False if any output can't be split unambiguously
+        """
+        byName = {list(test.statetest.keys())[0]: test for test in self.tests}
+        for (proc_info, client_name) in self.procs:
+            try:
+                with open(self.tempTraceLocation(client_name)) as f:
+                    segments = BatchStateTest.CLIENTS[client_name](line.rstrip("\n") for line in f)
+            except FileNotFoundError:
+                logger.warning("The file %s could not be found!" % self.tempTraceLocation(client_name))
+                return False
+            if segments is None or sorted(name for (name, _) in segments) != sorted(byName.keys()):
+                logger.warning("Could not split the %s output of batch %s" % (client_name, self.id))
+                return False
+            for (name, lines) in segments:
+                with open(byName[name].tempTraceLocation(client_name), "w") as f:
+                    f.write("\n".join(lines))
+                    f.write("\n")
+            if client_name in self.cut:
+                # Only the output of the test which ran last was cut off
+                byName[segments[-1][0]].cut.add(client_name)
+
+        for test in self.tests:
+            test.procs = list(self.procs)
+            test.socketEvent = self.socketEvent
+            test.socketData = self.socketData
+            test.startTime = self.startTime
+        return True
+
+    def removeFiles(self):
+        fPool.put(self._filename)
+
+
+# Every how many steps the canonicalization is timed, see CanonicalTrace
+CANON_SAMPLE = 16
+
+
+class CanonicalTrace(object):
+    """ A canonical trace which is read lazily from a client trace-file. Iterating over it
+    canonicalizes the file step by step, so that the comparator never has to hold the
+    whole trace in memory. It can be iterated several times, each time the file is re-read.
+    Binary traces (see evmlab.tracefile) are read as-is, without canonicalizer.
+    If the output is given (io_mode = pipes), it's read from memory instead of the file.
+    """
+
+    def __init__(self, filename, canonicalizer, stats=None, test=None, output=None):
+        self.filename = filename
+        self.canonicalizer = canonicalizer
+        self.stats = stats
+        self.test = test
+        self.output = output
+        # The number of steps read during the last iteration, and whether it read the whole trace
+        # (the comparator stops reading early once the traces diverge, or at the step budget)
+        self.length = 0
+        self.complete = False
+        # The (estimated) time spent canonicalizing, over all iterations
+        self.canonTime = 0.0
+
+    def __iter__(self):
+        self.length = 0
+        self.complete = False
+        try:
+            if self.output is None and tracefile.is_trace_file(self.filename):
+                with tracefile.TraceReader(self.filename) as reader:
+                    steps = reader
+                    if self.stats is not None:
+                        steps = self.stats.traceStats(steps)
+                        self.stats = None
+                    for step in steps:
+                        self.length += 1
+                        yield step
+                self.complete = True
+                return
+            with open_output(self.filename, self.output) as output:
+                canon_steps = self.canonicalizer(output)
+                if self.stats is not None:
+                    canon_steps = self.stats.traceStats(canon_steps)
+                    # Only gather stats during the first pass
+                    self.stats = None
+                canon_steps = iter(canon_steps)
+                while True:
+                    # Timing every step would cost about as much as canonicalizing a cheap one,
+                    # so only every CANON_SAMPLE-th step is timed. The first one includes the
+                    # setup, so it only counts once
+                    if self.length % CANON_SAMPLE == 0:
+                        t0 = time.perf_counter()
+                        step = next(canon_steps, None)
+                        self.canonTime += (time.perf_counter() - t0) * (CANON_SAMPLE if self.length else 1)
+                    else:
+                        step = next(canon_steps, None)
+                    if step is None:
+                        self.complete = True
+                        break
+                    self.length += 1
+                    # Steps are compared as-is, text is only rendered for the failure report
+                    yield step
+        except FileNotFoundError:
+            # We hit these sometimes, maybe twice every million execs or so
+            logger.warning("The file %s could not be found!" % self.filename)
+            if self.test is not None:
+                logger.warning("Socket event %s" % self.test.socketEvent)
+                logger.warning("Socket data %s" % str(self.test.socketData))
+            #TODO, try to find out what happened -- if there's any output from the process
+
+
+def open_output(filename, output=None):
+    """ Opens a client output: the given bytes if any, otherwise the file """
+    if output is not None:
+        return io.StringIO(output.decode(errors="replace"))
+    return open(filename)
+
+
+def read_limited(chunks, limit=None, filename=None, memory=None):
+    """ Joins the chunks of a client output, cutting it off after limit lines.
+    At most memory bytes of it are held: once the output gets longer, it's written to filename
+    as it's read instead, and the output returned is None. Returns (output, truncated) """
+    out = bytearray()
+    spill = None
+    lines = 0
+    truncated = False
+    try:
+        for chunk in chunks:
+            if limit is not None:
+                newlines = chunk.count(b"\n")
+                if lines + newlines >= limit:
+                    # Cut off after the last line within the limit
+                    end = -1
+                    for _ in range(limit - lines):
+                        end = chunk.index(b"\n", end + 1)
+                    chunk = chunk[:end + 1]
+                    truncated = True
+                lines += newlines
+            if spill is None and memory is not None and len(out) + len(chunk) > memory:
+                spill = open(filename, "wb")
+                spill.write(out)
+                out = None
+            if spill is not None:
+                spill.write(chunk)
+            else:
+                out += chunk
+            if truncated:
+                break
+    finally:
+        if spill is not None:
+            spill.close()
+    return (bytes(out) if spill is None else None, truncated)
+
+
+def count_lines(filename):
+    """ The number of lines in a file, 0 if there is no such file """
+    lines = 0
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                lines += chunk.count(b"\n")
+    except FileNotFoundError:
+        pass
+    return lines
+
+
+def exec_frames(sock, size=65536):
+    """ The output of a docker exec started with socket=True, in chunks of at most size bytes. The
+    socket multiplexes stdout and stderr in frames, each with an 8 byte header: the stream (1 byte,
+    then 3 bytes padding) and the length of the payload (4 bytes, big endian) """
+    raw = exec_socket(sock)
+
+    def read(n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = raw.recv(n - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    while True:
+        header = read(8)
+        if len(header) < 8:
+            return
+        (stream, length) = struct.unpack(">BxxxL", header)
+        while length > 0:
+            chunk = read(min(length, size))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def exec_socket(sock):
+    """ The socket of a docker exec started with socket=True. docker-py returns a SocketIO wrapping
+    it for connections over the unix socket, and the socket itself otherwise """
+    if isinstance(sock, socketlib.SocketIO):
+        return sock._sock
+    return sock
+
+
+def analyze_traces(traces, phase="traced", step_budget=None, full=False, binary_traces=False, outputs=None,
+                   known_signatures=(), coverage=False, cache=None, cut=()):
+    """ Canonicalizes and compares the client outputs of one test. This is the cpu-heavy part of
+    processing a test, so it can be run in a worker pool: only file names go in, and a compact
+    verdict comes out, as a dict with
+        verdict:       VMUtils.PASS, DIVERGED or TRUNCATED
+        clients:       the names of the clients whose traces were analyzed, in the order of lengths
+        summary:       the shortened trace, if the traces diverged
+        signature:     the divergence signature (see VMUtils.divergence_signature), if they diverged
+        lengths:       the number of steps, per client. These are the steps which were read: a trace
+                       is only read up to the divergence window or the step budget, unless the
+                       combined trace is built
+        complete:      per client, whether its whole trace was read, so lengths is its full length
+        stats:         the trace statistics of the first client (see VMUtils.Stats)
+        coverage:      the coverage features of the first client's trace, if coverage is set
+        trace_output:  the combined trace, if the traces diverged or full is set
+        binary_traces: the binary traces written along with the combined trace
+        pTime:         the processing time in seconds
+        timings:       the time per stage, in seconds: canonicalize (per client), compare
+                       and combine (building the full combined trace)
+        cached:        the files written for the TraceCache, per client
+
+    traces is a list of (filename, client name), outputs (if given) the client outputs, which are
+    then read instead of the files. known_signatures are the keys of signatures which have enough
+    examples already: for those, the full trace is not needed. cache maps client names to the
+    file their output is written to for the TraceCache: the canonical trace as binary trace (the
+    raw output in the untraced phase). They are only kept if the traces were read completely:
+    if the clients agree, or when the combined trace is built. cut are the names of the clients
+    whose output was cut off at the step budget: where their trace ends, the test is truncated
+    """
+    t1 = time.time()
+    names = [client_name for (filename, client_name) in traces]
+    outputs = outputs or [None] * len(traces)
+    result = {"verdict": VMUtils.PASS, "clients": names, "summary": [], "signature": None, "lengths": [], "complete": [],
+              "stats": {},
+              "coverage": None, "trace_output": None, "binary_traces": [], "timings": {}, "cached": {}}
+    cache = cache or {}
+
+    if phase == "untraced":
+        # Only the post-states are compared
+        states = []
+        for ((filename, client_name), data) in zip(traces, outputs):
+            try:
+                with open_output(filename, data) as output:
+                    states.append(PHASE_CLIENTS[client_name](output))
+            except FileNotFoundError:
+                logger.warning("The file %s could not be found!" % filename)
+                states.append({})
+        logger.debug("Post-states: %s" % states)
+        if not states or states[0] == {} or any(state != states[0] for state in states):
+            result["verdict"] = VMUtils.DIVERGED
+        elif cache:
+            for ((filename, client_name), data) in zip(traces, outputs):
+                if client_name not in cache:
+                    continue
+                if data is None:
+                    shutil.copyfile(filename, cache[client_name])
+                else:
+                    with open(cache[client_name], "wb") as f:
+                        f.write(data)
+                result["cached"][client_name] = cache[client_name]
+        result["pTime"] = time.time() - t1
+        return result
+
+    stats = VMUtils.Stats(coverage=coverage)
+    canon_traces = []
+    for ((filename, client_name), data) in zip(traces, outputs):
+        canonicalizer = Fuzzer.canonicalizers[client_name]
+        if phase == "nostack":
+            canonicalizer = lambda output, c=canonicalizer: VMUtils.withoutStacks(c(output))
+        # Only the first client's trace is used for the statistics
+        canon_traces.append(CanonicalTrace(filename, canonicalizer, stats if not canon_traces else None, output=data))
+
+    # The traces for the cache are written while they are compared
+    compared = [tracefile.record(canon_trace, cache[name]) if name in cache else canon_trace
+                for (canon_trace, name) in zip(canon_traces, names)]
+    t2 = time.time()
+    (verdict, summary, signature) = VMUtils.trace_divergence(compared, names, max_steps=step_budget,
+                                                             cut=[name in cut for name in names])
+    for (trace, name) in zip(compared, names):
+        if name not in cache:
+            continue
+        if verdict == VMUtils.PASS:
+            result["cached"][name] = cache[name]
+            continue
+        # Not read completely: closing the recorder writes what it has, which is thrown away
+        trace.close()
+        if os.path.exists(cache[name]):
+            os.remove(cache[name])
+    # The traces are canonicalized while they are compared, the rest of the time is the comparison
+    canonTimes = {name: canon_trace.canonTime for (name, canon_trace) in zip(names, canon_traces)}
+    result["timings"] = {"canonicalize": canonTimes,
+                         "compare": max(0.0, time.time() - t2 - sum(canonTimes.values()))}
+    result["verdict"] = verdict
+    result["summary"] = summary
+    result["signature"] = signature
+    result["stats"] = stats.result()
+    result["coverage"] = stats.features
+
+    known = signature is not None and VMUtils.signature_key(signature) in known_signatures
+    if phase == "traced" and ((verdict == VMUtils.DIVERGED and not known) or full):
+        # Only now do we need the full combined trace, so read the traces once more
+        if binary_traces:
+            # Write the binary traces while reading, they are saved along with the text traces
+            for (i, canon_trace) in enumerate(canon_traces):
+                binfile = "%s.bin" % canon_trace.filename
+                canon_traces[i] = tracefile.record(canon_trace, binfile)
+                result["binary_traces"].append(binfile)
+        t3 = time.time()
+        # The traces are read completely now, so the ones which weren't cached yet are recorded too
+        combined = [tracefile.record(canon_trace, cache[name]) if name in cache and name not in result["cached"]
+                    else canon_trace for (canon_trace, name) in zip(canon_traces, names)]
+        (_, result["trace_output"]) = VMUtils.compare_traces(combined, names)
+        result["cached"].update((name, cache[name]) for name in names if name in cache)
+        result["timings"]["combine"] = time.time() - t3
+        if verdict != VMUtils.DIVERGED:
+            result["summary"] = Fuzzer.get_summary(result["trace_output"])
+
+    # After building the combined trace, these are the full lengths
+    result["lengths"] = [canon_trace.length for canon_trace in canon_traces]
+    result["complete"] = [canon_trace.complete for canon_trace in canon_traces]
+    result["pTime"] = time.time() - t1
+    return result
+
+
+class LatencyHistogram(object):
+    """ The latencies of a stage: the total count and time, and a rolling window of the most
+    recent samples, for the percentiles """
+
+    WINDOW = 1024
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = collections.deque([], self.WINDOW)
+
+    def add(self, seconds):
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.samples.append(seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {"count": self.count}
+        percentile = lambda q: samples[int(q * (len(samples) - 1))]
+        return {
+            "count": self.count,
+            "total": round(self.total, 3),
+            "mean": round(sum(samples) / len(samples), 6),
+            "p50": round(percentile(0.50), 6),
+            "p95": round(percentile(0.95), 6),
+            "p99": round(percentile(0.99), 6),
+            "max": round(samples[-1], 6),
+        }
+
+
+class Metrics(object):
+    """ Latency histograms of the stages of the fuzzer, overall and per client:
+
+        generate:     filling a test from the template
+        prefilter:    statically checking a test before it's run (see PreFilter)
+        write:        writing the test file
+        start:        starting a client on a test (docker exec, runner submit or fork)
+        exec:         running a client, from start until its trace is complete
+        end:          setting up the trace comparison, after the clients are done
+        canonicalize: reading and canonicalizing a client's trace
+        compare:      comparing the canonical traces
+        combine:      building the combined trace of a failing test
+        analyze:      canonicalize + compare + combine, for all clients of a test
+        pool_wait:    waiting for a worker of the analysis pool, and for the result to be handled
+        process:      the accounting of a test, and saving the artefacts of failures
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = collections.defaultdict(LatencyHistogram)
+        self.clients = collections.defaultdict(lambda: collections.defaultdict(LatencyHistogram))
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, client=None):
+        with self._lock:
+            self.stages[stage].add(seconds)
+            if client is not None:
+                self.clients[client][stage].add(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage, client=None):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - t0, client)
+
+    def recordAnalysis(self, result):
+        """ Records the stage timings of an analyze_traces result """
+        timings = result.get("timings", {})
+        for (client, seconds) in timings.get("canonicalize", {}).items():
+            self.record("canonicalize", seconds, client)
+        for stage in ("compare", "combine"):
+            if stage in timings:
+                self.record(stage, timings[stage])
+        self.record("analyze", result["pTime"])
+
+    def summary(self):
+        """ The histograms, as a json-friendly dict """
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime": round(time.time() - self.start_time, 3),
+                "stages": {stage: h.summary() for (stage, h) in sorted(self.stages.items())},
+                "clients": {client: {stage: h.summary() for (stage, h) in sorted(stages.items())}
+                            for (client, stages) in sorted(self.clients.items())},
+            }
+
+
+class Profiler(object):
+    """ Profiles the running fuzzer for a while, and writes the results to the artefacts dir:
+
+        cpu:    cProfile, on the threads registered with addThread (the scheduler and the
+                postprocessing thread), dumped as pstats, and the top functions as text
+        memory: tracemalloc, the top allocations at the end, and the top growth during the window
+
+    None of it blocks the scheduler: the profilers are switched on and off by the profiled
+    threads themselves, and the results are written on a timer thread. The analysis pool and
+    the generator processes are not profiled.
+    """
+
+    KINDS = ("cpu", "memory")
+
+    def __init__(self, artefacts, prefix, top=30):
+        self.artefacts = artefacts
+        self.prefix = prefix
+        self.top = top
+        # name -> function which runs a callable on that thread
+        self.threads = {}
+        self.running = None
+        self.results = []
+        self._lock = threading.Lock()
+
+    def addThread(self, name, run):
+        self.threads[name] = run
+
+    def start(self, duration=60, kinds=KINDS):
+        """ Starts profiling for duration seconds, returns False if a profile is already running """
+        for kind in kinds:
+            if kind not in self.KINDS:
+                raise ValueError("Unknown profile '%s', choose from %s" % (kind, ", ".join(self.KINDS)))
+        with self._lock:
+            if self.running is not None:
+                logger.info("A profile is already running")
+                return False
+            self.running = {"kinds": list(kinds), "start": time.time(), "duration": duration}
+        logger.info("Profiling (%s) for %d seconds" % (", ".join(kinds), duration))
+        profiles = {}
+        if "cpu" in kinds:
+            for (name, run) in self.threads.items():
+                profiles[name] = cProfile.Profile()
+                run(profiles[name].enable)
+        snapshot = None
+        stopTracing = False
+        if "memory" in kinds:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                stopTracing = True
+            snapshot = tracemalloc.take_snapshot()
+        timer = threading.Timer(duration, self._finish, args=(profiles, snapshot, stopTracing))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _finish(self, profiles, snapshot, stopTracing):
+        try:
+            stamp = "%s-%s" % (self.prefix, time.strftime("%Y%m%d_%H%M%S"))
+            files = []
+            if profiles:
+                self._disable(profiles)
+                stats = pstats.Stats(*profiles.values())
+                filename = os.path.join(self.artefacts, "%s-cpu.pstats" % stamp)
+                stats.dump_stats(filename)
+                with open(os.path.join(self.artefacts, "%s-cpu.txt" % stamp), "w") as f:
+                    pstats.Stats(filename, stream=f).sort_stats("cumulative").print_stats(self.top)
+                files.extend(["%s-cpu.pstats" % stamp, "%s-cpu.txt" % stamp])
+            if snapshot is not None:
+                end = tracemalloc.take_snapshot()
+                if stopTracing:
+                    tracemalloc.stop()
+                with open(os.path.join(self.artefacts, "%s-memory.txt" % stamp), "w") as f:
+                    f.write("Top %d allocations\n" % self.top)
+                    for stat in end.statistics("lineno")[:self.top]:
+                        f.write("%s\n" % stat)
+                    f.write("\nTop %d growth during the profile\n" % self.top)
+                    for stat in end.compare_to(snapshot, "lineno")[:self.top]:
+                        f.write("%s\n" % stat)
+                files.append("%s-memory.txt" % stamp)
+            if files:
+                logger.info("Profile written to %s" % ", ".join(files))
+            with self._lock:
+                self.results.extend(files)
+        except Exception:
+            logger.exception("Failed to write the profile")
+        finally:
+            with self._lock:
+                self.running = None
+
+    def _disable(self, profiles):
+        """ Disables the profiles on their threads, and waits until they are """
+        disabled = []
+        for (name, profile) in profiles.items():
+            event = threading.Event()
+
+            def disable(profile=profile, event=event):
+                profile.disable()
+                event.set()
+
+            self.threads[name](disable)
+            disabled.append((name, event))
+        for (name, event) in disabled:
+            if not event.wait(30):
+                logger.warning("Thread %s did not stop profiling in time" % name)
+
+    def status(self):
+        with self._lock:
+            return {"running": dict(self.running) if self.running else None,
+                    "threads": sorted(self.threads),
+                    "results": self.results[-10:]}
+
+
+class TraceCache(object):
+    """ A persistent cache of client outputs, so that a client isn't run again on a test it has run
+    before. The key covers what the output depends on: the test content (see contentHash), the
+    client and its build (the image id of a docker client, the hash of a native binary), the
+    forks, the phase and the step budget. Traced runs are cached as binary traces of the canonical
+    trace (see evmlab.tracefile), which CanonicalTrace reads as-is, untraced runs as the output.
+
+    The entries are files in the cache directory, named by their key, so the cache carries over
+    between runs. It is bounded to max_bytes: the least recently used entries are evicted first,
+    by mtime, which is bumped on every hit.
+    """
+
+    def __init__(self, directory, max_bytes, identify):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Returns the build of a client, or None if it can't be told
+        self._identify = identify
+        self._versions = {}
+        # key -> size, least recently used first
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                # Left over from a run which was interrupted
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for (mtime, name, size) in sorted(entries):
+            self._entries[name] = size
+            self.size = self.size + size
+        with self._lock:
+            self._evict()
+
+    def version(self, client_name):
+        if client_name not in self._versions:
+            self._versions[client_name] = self._identify(client_name)
+        return self._versions[client_name]
+
+    def key(self, test, client_name, step_budget=None):
+        """ The key of running the client on the test, or None if the client can't be identified """
+        version = self.version(client_name)
+        if version is None:
+            return None
+        forks = sorted(fork for body in test.statetest.values() for fork in body.get("post", {}))
+        material = [test.contentHash(), client_name, version, forks, test.phaseName, step_budget]
+        return hashlib.sha256(json.dumps(material).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def tempfile(self, key, test_id):
+        """ Where an entry is written before it's stored """
+        return os.path.join(self.directory, "%s.%s.tmp" % (key, test_id))
+
+    def lookup(self, key, client_name):
+        """ Returns the file of the entry, or None if it's not cached """
+        with self._lock:
+            if key not in self._entries:
+                self.misses[client_name] += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.size = self.size - self._entries.pop(key, 0)
+                self.misses[client_name] += 1
+            return None
+        with self._lock:
+            self.hits[client_name] += 1
+        return path
+
+    def store(self, key, tmpfile):
+        """ Moves the file written by analyze_traces into the cache """
+        try:
+            size = os.path.getsize(tmpfile)
+            os.replace(tmpfile, self.path(key))
+        except OSError as e:
+            logger.warning("Could not cache %s: %s" % (tmpfile, e))
+            return
+        with self._lock:
+            self.size = self.size - self._entries.pop(key, 0) + size
+            self._entries[key] = size
+            self.stores = self.stores + 1
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            (key, size) = self._entries.popitem(last=False)
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.size = self.size - size
+            self.evictions = self.evictions + 1
+
+    def summary(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + sum(self.misses.values())
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "maxSize": self.max_bytes,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "hitRate": hits / lookups if lookups else "NA",
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+
+class SignatureIndex(object):
+    """ The consensus failures, by divergence signature (see VMUtils.divergence_signature). Only
+    the first few failures of a signature are saved in full, the others are most likely the same
+    bug, and are only counted.
+
+    The index is kept in an append-only file of json lines, one per failure, which is read back
+    on startup, so the counts carry over between runs
+    """
+
+    def __init__(self, path, examples=3):
+        self.path = path
+        # The number of failures per signature which are saved in full, 0 to save all
+        self.examples = examples
+        self.signatures = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._add(json.loads(line))
+                    except ValueError:
+                        # e.g. a partially written line
+                        logger.warning("Skipping bad line in %s: %s" % (path, line.strip()))
+
+    def _add(self, record):
+        entry = self.signatures.get(record["key"])
+        if entry is None:
+            entry = {"key": record["key"], "signature": record["signature"], "count": 0, "examples": [],
+                     "first": record["time"], "last": record["time"]}
+            self.signatures[record["key"]] = entry
+        entry["count"] = entry["count"] + 1
+        entry["last"] = record["time"]
+        if record.get("artefacts") is not None:
+            entry["examples"].append(record["artefacts"])
+
+    def wantsExample(self, key):
+        """ Whether a failure with the given signature should be saved in full """
+        entry = self.signatures.get(key)
+        return self.examples == 0 or entry is None or len(entry["examples"]) < self.examples
+
+    def known(self):
+        """ The keys of the signatures which need no more examples """
+        if self.examples == 0:
+            return frozenset()
+        return frozenset(key for (key, entry) in self.signatures.items() if len(entry["examples"]) >= self.examples)
+
+    def add(self, key, signature, test_id, artefacts=None):
+        """ Records a failure, artefacts is the listArtefacts of the test if it was saved """
+        record = {"key": key, "signature": signature, "id": test_id, "time": time.time()}
+        if artefacts is not None:
+            record["artefacts"] = artefacts
+        with self._lock:
+            self._add(record)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def summary(self):
+        """ The signatures, most frequent first """
+        with self._lock:
+            entries = sorted(self.signatures.values(), key=lambda entry: -entry["count"])
+            return [dict(entry, examples=list(entry["examples"])) for entry in entries]
+
+
+# The forks in order, and the ones on which a CREATE transaction costs extra intrinsic gas
+FORKS = ("Frontier", "Homestead", "EIP150", "EIP158", "Byzantium", "Constantinople")
+TX_GAS = 21000
+TX_CREATE_GAS = 32000
+TX_DATA_ZERO_GAS = 4
+TX_DATA_NONZERO_GAS = 68
+# The opcodes which were added after Frontier, with the fork which added them
+OPCODE_FORKS = {0xf4: "Homestead", 0x3d: "Byzantium", 0x3e: "Byzantium", 0xfa: "Byzantium", 0xfd: "Byzantium",
+                0x1b: "Constantinople", 0x1c: "Constantinople", 0x1d: "Constantinople", 0x3f: "Constantinople",
+                0xf5: "Constantinople"}
+
+
+def opcode_available(op, fork):
+    """ Whether the opcode exists on the fork (unknown forks are taken to be the latest) """
+    added = OPCODE_FORKS.get(op)
+    if added is None or fork not in FORKS:
+        return True
+    return FORKS.index(fork) >= FORKS.index(added)
+
+
+def intrinsic_gas(data, create=False, fork="Byzantium"):
+    """ The gas a transaction costs before any code runs (unknown forks are taken to be the latest) """
+    zeros = data.count(0)
+    gas = TX_GAS + zeros * TX_DATA_ZERO_GAS + (len(data) - zeros) * TX_DATA_NONZERO_GAS
+    if create and (fork not in FORKS or FORKS.index(fork) >= FORKS.index("Homestead")):
+        gas = gas + TX_CREATE_GAS
+    return gas
+
+
+def _hexbytes(value):
+    value = value[2:] if value[:2] in ("0x", "0X") else value
+    return bytes.fromhex(value)
+
+
+class PreFilter(object):
+    """ Statically checks generated tests before they are run, and rejects the ones which can't
+    produce a useful trace, since they would still cost an exec on every client:
+
+        gas:     the gas limit is below the intrinsic gas, or above the block gas limit, so the
+                 transaction is invalid
+        no_code: the transaction goes to an account without code (other than a precompile)
+        halts:   the code which runs first faults (invalid opcode, stack underflow) or stops
+                 (STOP, or the end of the code) within its first HALT_STEPS instructions
+
+    A rejected test is replaced by the next one from the generator. A sample of them is run
+    anyway, so that the filter can be checked against what the clients do: for those, the trace
+    lengths are tallied, see traced.
+    """
+
+    REASONS = ("gas", "no_code", "halts")
+    # How far into the entry code to look, only straight-line code is followed
+    HALT_STEPS = 4
+
+    def __init__(self, sample=0.0, seed=None):
+        self.sample = sample
+        self._random = random.Random(seed)
+        self.checked = 0
+        self.rejected = collections.Counter()
+        self.sampled = collections.Counter()
+        # Per reason: the number of sampled tests which were traced, and how many of those
+        # had no more than HALT_STEPS steps
+        self.traced = collections.defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def halts(code, fork):
+        """ Whether the code certainly faults or stops within its first HALT_STEPS instructions """
+        height = 0
+        pc = 0
+        for _ in range(PreFilter.HALT_STEPS):
+            if pc >= len(code):
+                # Running off the end of the code is a STOP
+                return True
+            instruction = evmdasm.registry.INSTRUCTIONS_BY_OPCODE.get(code[pc])
+            if instruction is None or instruction.category == "unofficial" or not opcode_available(code[pc], fork):
+                return True
+            if instruction.name == "STOP" or height < instruction.pops:
+                return True
+            if instruction.name in ("JUMP", "JUMPI") or instruction.category in ("terminate", "system"):
+                # Where it goes on from here isn't followed. RETURN, REVERT and SELFDESTRUCT with
+                # their operands in place end the code early, but they're kept: their memory
+                # expansion, return data and refunds are worth comparing between the clients
+                return False
+            height = height + instruction.pushes - instruction.pops
+            pc = pc + 1 + instruction.length_of_operand
+        return False
+
+    @staticmethod
+    def check(statetest):
+        """ The reason to reject the test, or None if it may produce a useful trace. Tests with
+        several cases (forks, post-states) are rejected only if all of them would be """
+        reason = None
+        for test in statetest.values():
+            tx = test["transaction"]
+            create = tx.get("to", "") in ("", "0x")
+            account = test["pre"].get(tx.get("to", "").lower(), {}) if not create else {}
+            blockGasLimit = int(test["env"]["currentGasLimit"], 16)
+            for (fork, cases) in test["post"].items():
+                for case in cases:
+                    indexes = case["indexes"]
+                    data = _hexbytes(tx["data"][indexes["data"]])
+                    gas = int(tx["gasLimit"][indexes["gas"]], 16)
+                    # The gas costs of forks after FORKS may be lower, so those aren't checked
+                    if gas > blockGasLimit or (fork in FORKS and gas < intrinsic_gas(data, create, fork)):
+                        reason = reason or "gas"
+                        continue
+                    code = data if create else _hexbytes(account.get("code", ""))
+                    if not code:
+                        if not create and 0 < int(tx["to"], 16) <= VMUtils.MAX_PRECOMPILE:
+                            return None
+                        reason = reason or "no_code"
+                        continue
+                    if PreFilter.halts(code, fork):
+                        reason = reason or "halts"
+                        continue
+                    return None
+        return reason
+
+    def accept(self, statetest):
+        """ Checks a test, returns (accepted, reason): reason is set for rejected tests which
+        are run as a sample """
+        try:
+            reason = self.check(statetest)
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            # Something the filter doesn't understand, let the clients have a go
+            logger.debug("Could not check test: %s" % e)
+            reason = None
+        with self._lock:
+            self.checked = self.checked + 1
+            if reason is None:
+                return (True, None)
+            self.rejected[reason] += 1
+            if self._random.random() < self.sample:
+                self.sampled[reason] += 1
+                return (True, reason)
+        return (False, reason)
+
+    def counts(self):
+        """ The counts since the last call, which a generator process sends along with its tests """
+        with self._lock:
+            counts = {"checked": self.checked, "rejected": dict(self.rejected), "sampled": dict(self.sampled)}
+            self.checked = 0
+            self.rejected = collections.Counter()
+            self.sampled = collections.Counter()
+        return counts
+
+    def merge(self, counts):
+        """ Adds the counts of a generator process """
+        with self._lock:
+            self.checked = self.checked + counts["checked"]
+            self.rejected.update(counts["rejected"])
+            self.sampled.update(counts["sampled"])
+
+    def onTraced(self, reason, length):
+        """ Tallies the trace length of a sampled test, rejected for reason """
+        with self._lock:
+            entry = self.traced[reason]
+            entry[0] = entry[0] + 1
+            if length <= self.HALT_STEPS:
+                entry[1] = entry[1] + 1
+
+    def summary(self):
+        with self._lock:
+            rejected = sum(self.rejected.values())
+            return {
+                "checked": self.checked,
+                "rejected": dict(self.rejected),
+                "rejectRate": rejected / self.checked if self.checked else "NA",
+                "sampled": dict(self.sampled),
+                "traced": {reason: {"tests": tests, "short": short} for (reason, (tests, short)) in self.traced.items()},
+            }
+
+
+class CoverageScheduler(object):
+    """ Keeps track of the coverage features of the tests (see VMUtils.Stats), and derives weights
+    for the test generation from them, which favour behaviour that is still under-covered:
+
+    - the code generator engines are weighted by how many new features their tests found lately,
+      relative to each other (but never below a tenth of their configured weight)
+    - the opcodes of RndCodeSmart2 are weighted by how few distinct features they occur in,
+      compared to the median opcode: rarely seen opcodes are generated more often
+    """
+
+    # The smoothing of the new features per test of an engine
+    ALPHA = 0.05
+    # The range of the opcode weights
+    MIN_WEIGHT = 0.25
+    MAX_WEIGHT = 4.0
+
+    def __init__(self, weights, interval=500):
+        # The configured engine weights, by name
+        self.baseWeights = dict(weights)
+        self.interval = interval
+        self.features = set()
+        self.kinds = collections.Counter()
+        # The number of distinct features per opcode
+        self.variety = collections.Counter()
+        self.engines = {name: {"tests": 0, "new": 0, "rate": 0.0} for name in weights}
+        self.tests = 0
+        self.startTime = time.time()
+        # (seconds, tests, features), every interval tests
+        self.history = collections.deque([], 100)
+        self._lock = threading.Lock()
+
+    def add(self, engine, features):
+        """ Adds the features of a test, which was generated by the given engine. Returns True
+        every interval tests, when the weights should be updated """
+        with self._lock:
+            new = features - self.features
+            self.features.update(new)
+            for feature in new:
+                self.kinds[feature[0]] += 1
+                # Only bigrams are made of opcodes: the other kinds are an opcode followed by
+                # something else (a depth bucket, or a precompile address)
+                ops = set(feature[1:]) if feature[0] == "bigram" else (feature[1],)
+                for op in ops:
+                    self.variety[op] += 1
+            if engine in self.engines:
+                stats = self.engines[engine]
+                stats["tests"] = stats["tests"] + 1
+                stats["new"] = stats["new"] + len(new)
+                stats["rate"] = (1 - self.ALPHA) * stats["rate"] + self.ALPHA * len(new)
+            self.tests = self.tests + 1
+            if self.tests % self.interval != 0:
+                return False
+            self.history.append((round(time.time() - self.startTime), self.tests, len(self.features)))
+            before = self.history[-2][2] if len(self.history) > 1 else 0
+        logger.info("Coverage: %d features after %d tests, %d new in the last %d" % (
+            len(self.features), self.tests, len(self.features) - before, self.interval))
+        return True
+
+    def engineWeights(self):
+        rates = [stats["rate"] for stats in self.engines.values()]
+        mean = sum(rates) / len(rates) if rates else 0
+        if mean == 0:
+            return dict(self.baseWeights)
+        return {name: weight * max(0.1, self.engines[name]["rate"] / mean)
+                for (name, weight) in self.baseWeights.items()}
+
+    def opcodeWeights(self):
+        ops = list(VMUtils.opcodes.opcodes)
+        with self._lock:
+            variety = [self.variety[op] for op in ops]
+        median = sorted(variety)[len(variety) // 2]
+        return {op: min(self.MAX_WEIGHT, max(self.MIN_WEIGHT, ((median + 1) / (count + 1)) ** 0.5))
+                for (op, count) in zip(ops, variety)}
+
+    def weights(self):
+        """ The weights for the test generation, see apply_generation_weights """
+        return {"engines": self.engineWeights(), "opcodes": self.opcodeWeights()}
+
+    def summary(self):
+        with self._lock:
+            return {
+                "features": len(self.features),
+                "kinds": dict(self.kinds),
+                "tests": self.tests,
+                "engines": {name: {"tests": stats["tests"], "new": stats["new"], "rate": round(stats["rate"], 2)}
+                            for (name, stats) in self.engines.items()},
+                "growth": list(self.history),
+            }
+
+
+class ClientLimit(object):
+    """ Limits the number of concurrent runs of a client, like a semaphore whose size can be
+    changed. The runs are measured as well, for the ConcurrencyController """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._changed = asyncio.Condition()
+        self.reset()
+
+    def reset(self):
+        """ Starts a new measurement """
+        self.completed = 0
+        self.runTime = 0.0
+        self.waitTime = 0.0
+        self.maxWaiting = self.waiting
+
+    def slot(self):
+        """ A slot for one run, to hold with async with """
+        return ClientSlot(self)
+
+    async def acquire(self):
+        """ Waits for a free slot, returns when the run started """
+        t0 = time.time()
+        async with self._changed:
+            self.waiting = self.waiting + 1
+            self.maxWaiting = max(self.maxWaiting, self.waiting)
+            try:
+                await self._changed.wait_for(lambda: self.active < self.limit)
+            finally:
+                self.waiting = self.waiting - 1
+            self.active = self.active + 1
+        t1 = time.time()
+        self.waitTime = self.waitTime + t1 - t0
+        return t1
+
+    async def release(self, started):
+        self.completed = self.completed + 1
+        self.runTime = self.runTime + time.time() - started
+        async with self._changed:
+            self.active = self.active - 1
+            self._changed.notify()
+
+    async def resize(self, limit):
+        async with self._changed:
+            self.limit = limit
+            self._changed.notify_all()
+
+
+class ClientSlot(object):
+    """ A run holding a slot of a ClientLimit (an async context manager, which
+    contextlib.asynccontextmanager only provides from python 3.7 on) """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._started = None
+
+    async def __aenter__(self):
+        self._started = await self._limit.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._limit.release(self._started)
+
+
+class ConcurrencyController(object):
+    """ Tunes the number of concurrent runs per client (AIMD): every interval, a client whose runs
+    had to wait for a slot gets one more, unless that didn't pay off last time. If the last
+    increase lowered the client's throughput, or made its runs a lot slower without any gain,
+    or if the host is overloaded, the limit is cut to three quarters instead.
+
+    Clients with a configured <client>.concurrency keep it.
+    """
+
+    DECREASE = 0.75
+    # Throughput changes within this fraction count as no change
+    TOLERANCE = 0.05
+    # Run time growth (per run) that counts as thrashing, if the throughput didn't grow
+    SLOWDOWN = 1.5
+    # The load average reacts slowly: after lowering a limit for the load, wait this long
+    # before doing it again
+    LOAD_HOLDOFF = 60
+
+    def __init__(self, config):
+        self.config = config
+        self.limits = {}
+        self.clients = {}
+        start = min(config.concurrency_max, max(config.concurrency_min, os.cpu_count() or 1))
+        for client_name in config.clientNames:
+            fixed = client_name in config.fixed_concurrency
+            self.limits[client_name] = ClientLimit(config.concurrency[client_name] if fixed else start)
+            self.clients[client_name] = {"fixed": fixed, "throughput": None, "runTime": None,
+                                         "action": None, "reason": None, "loadDecrease": 0}
+        self._last = time.time()
+
+    @property
+    def maximum(self):
+        """ The max number of concurrent runs, of all clients """
+        return sum(self.config.concurrency[client_name] if state["fixed"] else self.config.concurrency_max
+                   for (client_name, state) in self.clients.items())
+
+    def load(self):
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            return 0.0
+
+    def decide(self, client_name, limit, elapsed, load):
+        """ Returns the new limit of a client, and the reason for the change (None to keep it) """
+        state = self.clients[client_name]
+        config = self.config
+        if limit.completed == 0:
+            # Nothing to go by
+            return (limit.limit, None)
+        throughput = limit.completed / elapsed
+        runTime = limit.runTime / limit.completed
+        (previous, previousRunTime) = (state["throughput"], state["runTime"])
+        (state["throughput"], state["runTime"]) = (throughput, runTime)
+        decreased = max(config.concurrency_min, int(limit.limit * self.DECREASE))
+
+        if load > config.concurrency_max_load and limit.limit > config.concurrency_min:
+            if time.time() - state["loadDecrease"] < self.LOAD_HOLDOFF:
+                return (limit.limit, None)
+            state["loadDecrease"] = time.time()
+            return (decreased, "host overloaded (load %.2f per core)" % load)
+        if state["action"] == "increase" and previous is not None:
+            if throughput < previous * (1 - self.TOLERANCE):
+                return (decreased, "throughput dropped (%.2f -> %.2f tests/s)" % (previous, throughput))
+            if runTime > previousRunTime * self.SLOWDOWN and throughput <= previous * (1 + self.TOLERANCE):
+                return (decreased, "runs slowed down (%.2fs -> %.2fs) without a gain" % (previousRunTime, runTime))
+        if limit.maxWaiting > 0 and limit.limit < config.concurrency_max:
+            return (limit.limit + 1, "saturated (%d waiting, %.2fs queued per run)" % (
+                limit.maxWaiting, limit.waitTime / limit.completed))
+        return (limit.limit, None)
+
+    async def step(self):
+        """ Re-evaluates the limits, at the end of an interval """
+        now = time.time()
+        elapsed = max(now - self._last, 1e-9)
+        self._last = now
+        load = self.load()
+        for (client_name, limit) in self.limits.items():
+            state = self.clients[client_name]
+            if state["fixed"]:
+                limit.reset()
+                continue
+            (new, reason) = self.decide(client_name, limit, elapsed, load)
+            state["action"] = None
+            if new != limit.limit:
+                state["action"] = "increase" if new > limit.limit else "decrease"
+                state["reason"] = reason
+                logger.info("Concurrency of %s: %d -> %d, %s" % (client_name, limit.limit, new, reason))
+                await limit.resize(new)
+            limit.reset()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.config.concurrency_interval)
+            await self.step()
+
+    def summary(self):
+        return {client_name: {
+            "limit": self.limits[client_name].limit,
+            "active": self.limits[client_name].active,
+            "waiting": self.limits[client_name].waiting,
+            "fixed": state["fixed"],
+            "throughput": round(state["throughput"], 2) if state["throughput"] is not None else "NA",
+            "runTime": round(state["runTime"], 3) if state["runTime"] is not None else "NA",
+            "lastChange": state["reason"],
+        } for (client_name, state) in self.clients.items()}
+
+
 class TestExecutor(object):
 
     def __init__(self, fuzzer):
@@ -289,11 +1719,57 @@ class TestExecutor(object):
             "total_count": 0,
             "num_active_tests": 0,
             "num_active_sockets": 0,
+            "truncated_count": 0,
+            "num_pending_results": 0,
         }
         self.failures = []
         self.traceLengths = collections.deque([], 100)
         self.traceDepths = collections.deque([], 100)
         self.traceConstantinopleOps = collections.deque([], 100)
+        # Per phase: the number of runs, how many of those were re-run in the next phase,
+        # and the total time from start to verdict
+        self.phaseStats = {phase: {"runs": 0, "escalated": 0, "time": 0.0} for phase in PHASES}
+
+        # Traces are analyzed in a pool of worker processes, unless the pool size is 0. The workers
+        # are forked off a separate server process, since forking the threaded fuzzer itself is unsafe.
+        # Python 3.6 has no mp_context: there, the workers are started right away instead, before
+        # the fuzzer starts any threads
+        self._pool = None
+        if fuzzer._config.pool_size > 0:
+            if sys.version_info >= (3, 7):
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=fuzzer._config.pool_size, mp_context=multiprocessing.get_context("forkserver"))
+            else:
+                self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=fuzzer._config.pool_size)
+                self._pool.submit(int).result()
+        # Analyzed tests, and a pipe to wake up the poll loop when there are any
+        self._results = queue.Queue()
+        self._wakeup = os.pipe()
+        # The concurrent runs per client, set up when fuzzing starts
+        self.concurrency = None
+        self.profiler = Profiler(fuzzer._config.artefacts, "profile-%s" % fuzzer._config.host_id,
+                                 top=fuzzer._config.profile_top)
+
+    def onPhase(self, test, escalated):
+        stats = self.phaseStats[test.phaseName]
+        stats["runs"] = stats["runs"] + 1
+        if escalated:
+            stats["escalated"] = stats["escalated"] + 1
+        if test.startTime is not None:
+            stats["time"] = stats["time"] + time.time() - test.startTime
+
+    def phaseSummary(self):
+        elapsed = time.time() - self.stats["start_time"]
+        summary = {}
+        for phase in self._fuzzer._config.phases:
+            stats = self.phaseStats[phase]
+            summary[phase] = {
+                "runs": stats["runs"],
+                "escalated": stats["escalated"],
+                "speed": stats["runs"] / elapsed,
+                "latency": stats["time"] / stats["runs"] if stats["runs"] else "NA",
+            }
+        return summary
 
     def onPass(self):
         self.stats["pass_count"] = self.stats["pass_count"] + 1
@@ -302,7 +1778,8 @@ class TestExecutor(object):
     def onFail(self, testcase):
         self.stats["fail_count"] = self.stats["fail_count"] + 1
         self.stats["total_count"] = self.stats["total_count"] + 1
-        self.failures.append(testcase.listArtefacts())
+        if testcase.saved:
+            self.failures.append(testcase.listArtefacts())
 
     def numFails(self):
         return self.stats["fail_count"]
@@ -320,15 +1797,65 @@ class TestExecutor(object):
         # End previous procs
         if test is None:
             return
-        data = self._fuzzer.end_processes(test)
-        if data is not None:
-            (traceLength, stats) = data
+        if isinstance(test, BatchStateTest):
+            self.postprocess_batch(test, reporting)
+            return
+        if test.phaseName == "traced":
+            with self._fuzzer.metrics.timer("end"):
+                self._fuzzer.end_processes(test)
+
+        job = self._fuzzer.traceJob(test, forceSave=self._fuzzer._config.force_save)
+        if self._pool is None:
+            self.finish_test(test, analyze_traces(**job), reporting)
+            return
+
+        # The traces are analyzed in the pool, the wakeup pipe tells the scheduler to handle the result
+        submitted = time.time()
+
+        def done(future):
+            self._results.put((test, future, reporting, submitted))
+            os.write(self._wakeup[1], b"\0")
+
+        self.stats["num_pending_results"] = self.stats["num_pending_results"] + 1
+        self._pool.submit(analyze_traces, **job).add_done_callback(done)
+
+    def handle_results(self):
+        """ Finishes the tests whose traces have been analyzed in the pool """
+        while True:
+            try:
+                (test, future, reporting, submitted) = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self.stats["num_pending_results"] = self.stats["num_pending_results"] - 1
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Failed to analyze the traces of test %s" % test.id)
+                test.removeFiles()
+                continue
+            self._fuzzer.metrics.record("pool_wait", max(0.0, time.time() - submitted - result["pTime"]))
+            self.finish_test(test, result, reporting)
+
+    def finish_test(self, test, result, reporting=False):
+        """ Handles the outcome of analyze_traces for a test """
+        self._fuzzer.metrics.recordAnalysis(result)
+        if test.phaseName != "traced":
+            self.postprocess_phase(test, result)
+            return
+        self.onPhase(test, False)
+
+        # Process previous traces
+        with self._fuzzer.metrics.timer("process"):
+            failingTestcase = self._fuzzer.processTraces(test, forceSave=self._fuzzer._config.force_save, result=result)
+        if test.traceStats is not None:
+            (traceLength, stats) = test.traceStats
             self.traceLengths.append(traceLength)
             self.traceDepths.append(stats['maxDepth'])
             self.traceConstantinopleOps.append(stats['constatinopleOps'])
 
-        # Process previous traces
-        failingTestcase = self._fuzzer.processTraces(test, forceSave=self._fuzzer._config.force_save)
+        if test.verdict == VMUtils.TRUNCATED:
+            self.stats["truncated_count"] = self.stats["truncated_count"] + 1
+
         if failingTestcase is None:
             self.onPass()
         else:
@@ -338,84 +1865,246 @@ class TestExecutor(object):
             # Do some reporting
             logger.info("Fails: {}, Pass: {}, #test {} speed: {:f} tests/s (trace_len avg: {}, max: {}, zero_trace_rate: {})".format(
                 self.numFails(), self.numPass(), self.numTotals(), self.testsPerSecond(),
-                self._fuzzer._total_trace_len / self._fuzzer._num_traces_processed, self._fuzzer._max_trace_len, self._fuzzer._num_zero_traces/self._fuzzer._num_traces_processed
+                self._fuzzer._total_trace_len / max(1, self._fuzzer._num_traces_processed), self._fuzzer._max_trace_len,
+                self._fuzzer._num_zero_traces / max(1, self._fuzzer._num_traces_processed)
             ))
 
+    def postprocess_phase(self, test, result=None):
+        """ Handles a test which was run in one of the cheaper phases: if the clients agree it
+        passes, otherwise it is re-run in the next phase """
+        agree = self._fuzzer.checkPhase(test, result)
+        self.onPhase(test, not agree)
+        if agree:
+            test.removeFiles()
+            self.onPass()
+            return
+        logger.info("Clients disagree on test %s in phase %s, re-running it" % (test.id, test.phaseName))
+        test.nextPhase()
+        self._fuzzer.reruns.append(test)
+
+    def postprocess_batch(self, batch, reporting=False):
+        batch.removeFiles()
+        if len(batch.socketData) > 0:
+            logger.warning("Got spurious docker failure on batch %s: %s", batch.id, str(batch.socketData))
+        elif batch.split():
+            for test in batch.tests:
+                self.postprocess_test(test, reporting)
+            return
+        # Run the tests one by one instead
+        logger.info("Re-running the %d tests of batch %s as single tests" % (batch.numTests, batch.id))
+        self._fuzzer.reruns.extend(batch.tests)
+
     def startFuzzing(self):
+        # A loop of its own (like asyncio.run, which needs python 3.7), so that fuzzing can run
+        # on any thread
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.fuzz())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def fuzz(self):
+        """ Runs the fuzzer as a set of asyncio tasks:
+
+        - generation: pulls tests (and re-runs) from the generator into a bounded queue
+        - scheduling: starts a task per test, as long as fewer than max_parallel tests are in flight
+        - execution:  every client of a test is started as soon as that client has a free slot
+                      (see ConcurrencyController), and waited for without blocking anything else
+        - postprocessing: analyzes finished tests, on a separate thread (or in the worker pool)
+
+        All queues are bounded, so a slow stage holds back the stages before it instead of
+        piling up work. No stage sleeps: each waits on exactly what it needs.
+        """
+        config = self._fuzzer._config
+        loop = asyncio.get_event_loop()
+        reporting = config.enable_reporting
         print_stats_every_x_seconds = 90
         self.stats["start_time"] = time.time()
-        next_stats_print = self.stats["start_time"] + print_stats_every_x_seconds
-        # This is the max cap of paralellism, it's just to prevent
-        # things going out of hand if tests start piling up
-        # We don't expect to actually reach it
-        MAX_PARALELL = 50
-        # The poller which we use, to register our
-        # processes IO channels on
-        poller = select.poll()
-        active_sockets = {}
-
-        # The poll-mask. We listen to everything, except 'ready to write'
-        mask = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP | select.POLLNVAL
-
-        for test in self._fuzzer.generate_tests():
-            test.socketEvent = ""
-            test.socketData = b''
-            if self.stats["num_active_tests"] < MAX_PARALELL:
-                #test.writeToFile()
-                # Start new procs
-                self._fuzzer.start_processes(test)
+
+        runs = asyncio.Queue(maxsize=config.max_parallel)
+        finished = asyncio.Queue(maxsize=config.max_parallel)
+        in_flight = asyncio.Semaphore(config.max_parallel)
+        self.concurrency = ConcurrencyController(config)
+        client_slots = self.concurrency.limits
+        # Postprocessing (the accounting, and the analysis if there's no worker pool) runs on one thread
+        postprocessor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Running clients which are waited for on a thread get one of these: with io_mode = pipes,
+        # the thread streams the test and the output, and native clients are waited for on one if
+        # there's no pidfd. It's sized to the client limits, so these never starve the default
+        # executor, which starts the clients and runs the generator
+        io_threads = concurrent.futures.ThreadPoolExecutor(max_workers=max(self.concurrency.maximum, 1))
+        tasks = set()
+
+        def wakeup():
+            # Traces have been analyzed in the pool
+            os.read(self._wakeup[0], 4096)
+            loop.run_in_executor(postprocessor, self.handle_results)
+
+        loop.add_reader(self._wakeup[0], wakeup)
+
+        self.profiler.addThread("scheduler", loop.call_soon_threadsafe)
+        self.profiler.addThread("postprocessor", postprocessor.submit)
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.start, config.profile_duration,
+                                    config.profile or Profiler.KINDS)
+        except (RuntimeError, ValueError, NotImplementedError):
+            # Signals can only be handled on the main thread
+            logger.info("Not fuzzing on the main thread, profiling on SIGUSR1 is disabled")
+
+        async def wait_closed(test, socket):
+            """ Waits until the exec is finished, which is when its socket is closed """
+            closed = loop.create_future()
+            fd = socket.fileno()
+            loop.add_reader(fd, lambda: closed.done() or closed.set_result(None))
+            self.stats["num_active_sockets"] = self.stats["num_active_sockets"] + 1
+            try:
+                await closed
+            finally:
+                loop.remove_reader(fd)
+                self.stats["num_active_sockets"] = self.stats["num_active_sockets"] - 1
+            # We don't expect any data here, but we'll take a peek and stash it just in case
+            test.socketData = test.socketData + await loop.run_in_executor(None, socket.readall)
+            test.socketEvent = test.socketEvent + "[closed]"
+            socket.close()
+
+        async def wait_exited(proc):
+            """ Waits until a native client process has exited, through a pidfd where available """
+            try:
+                fd = os.pidfd_open(proc.pid)
+            except (AttributeError, OSError):
+                await loop.run_in_executor(io_threads, proc.wait)
+                return
+            exited = loop.create_future()
+            loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(fd)
+                os.close(fd)
+            proc.wait()
+
+        async def run_client(test, client_name):
+            async with client_slots[client_name].slot():
+                procinfo = await loop.run_in_executor(None, self._fuzzer.start_process, test, client_name)
+                started = time.time()
+                try:
+                    if procinfo is None or "cached" in procinfo:
+                        pass
+                    elif "runner" in procinfo:
+                        procinfo["exitcode"] = await procinfo["runner"].wait(procinfo["job"])
+                    elif "communicate" in procinfo:
+                        output = await loop.run_in_executor(io_threads, procinfo["communicate"])
+                        if output is not None:
+                            test.outputs[test.tempTraceLocation(client_name)] = output
+                    elif "procs" in procinfo:
+                        for proc in procinfo["procs"]:
+                            await wait_exited(proc)
+                        procinfo["exitcode"] = procinfo["procs"][0].returncode
+                    else:
+                        await wait_closed(test, procinfo["output"])
+                    if procinfo is not None:
+                        self._fuzzer.recordCut(test, procinfo, client_name)
+                finally:
+                    # The job is released even if waiting failed, so its instance doesn't look wedged
+                    if procinfo is not None and not self._fuzzer.job_done(procinfo):
+                        # Treated like a docker failure, the test is skipped (see Fuzzer.end_processes)
+                        test.socketData = test.socketData + b"instance restarted"
+                if procinfo is not None and "cached" not in procinfo:
+                    self._fuzzer.metrics.record("exec", time.time() - started, client_name)
+                return procinfo
+
+        async def run_test(test):
+            try:
+                test.startTime = time.time()
+                procinfos = await asyncio.gather(*[run_client(test, c) for c in config.clientNames])
+                # The processes are kept in the order of the clients, like start_processes does
+                test.procs = [(p, c) for (p, c) in zip(procinfos, config.clientNames) if p is not None]
+                logger.info("All procs finished for test %s" % test.id)
+                self.stats["num_active_tests"] = self.stats["num_active_tests"] - 1
+                await finished.put(test)
+            except Exception:
+                logger.exception("Failed to run test %s" % test.id)
+                self.stats["num_active_tests"] = self.stats["num_active_tests"] - 1
+            finally:
+                in_flight.release()
+
+        async def generate():
+            tests = self._fuzzer.generate_runs()
+            while True:
+                # The generator blocks, so it's advanced on a thread
+                await runs.put(await loop.run_in_executor(None, next, tests))
+
+        async def schedule():
+            while True:
+                test = await runs.get()
+                await in_flight.acquire()
+                test.socketEvent = ""
+                test.socketData = b''
                 self.stats["num_active_tests"] = self.stats["num_active_tests"] + 1
-                self.stats["num_active_sockets"] = len(active_sockets.keys())
-                # Put the new test to the first position
-                test.numprocs = 0
-                # Register the test IO channel with the poller
-                for (proc_info, client_name) in test.procs:
-                    socket = proc_info["output"]
-
-                    poller.register(socket, mask)
-                    # Make a lookup, socket fd-> (test and socket)
-                    # The poller returns only the fd, a number, we need to 
-                    # remember the actual socket and the test
-                    active_sockets[socket.fileno()] = (test , socket)
-                    # Stash the number of processes somewhere
-                    test.numprocs = test.numprocs + 1
-            else:
-                logger.info("Max paralellism hit -- will sleep for a bit")
-                time.sleep(10)
-            # Check if anyting happened
-            socketlist = poller.poll()
-            if len(socketlist) == 0:
-                continue
-            for (socketfd, event) in socketlist:
-                # At least one process for this test is finished
-
-                # Stop listeninng to this socket
-                poller.unregister(socketfd)
-                # Find the test
-                (test, socket) = active_sockets.pop(socketfd)
-                # read it, close it
-                if event & (select.POLLIN| select.POLLPRI):
-                    # We don't expect any data here, but we'll take a peek and stash
-                    # it just in case
-                    data = socket.readall()
-                    test.socketData = test.socketData + data
-                #Also, we'll save the event, may assist with debugging later
-                test.socketEvent = test.socketEvent + ("[%d]" % event)
-                socket.close()
-                test.numprocs = test.numprocs - 1
-                if test.numprocs == 0:
-                    logger.info("All procs finished for test %s" % test.id)
-                    self.stats["num_active_tests"] = self.stats["num_active_tests"] - 1
-                    self.postprocess_test(test, reporting=self._fuzzer._config.enable_reporting)
+                task = asyncio.ensure_future(run_test(test))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
 
-            if time.time()> next_stats_print:
+        async def postprocess():
+            while True:
+                test = await finished.get()
+                try:
+                    await loop.run_in_executor(postprocessor, self.postprocess_test, test, reporting)
+                except Exception:
+                    logger.exception("Failed to postprocess test %s" % test.id)
+
+        async def health():
+            instances = [i for client_instances in self._fuzzer.instances.values() for i in client_instances]
+            while instances:
+                await asyncio.sleep(config.health_check_interval)
+                for instance in instances:
+                    if await loop.run_in_executor(None, self._fuzzer.instance_healthy, instance):
+                        continue
+                    old_runner = await loop.run_in_executor(None, self._fuzzer.restart_instance, instance)
+                    if old_runner is not None:
+                        old_runner.abort()
+
+        async def profile():
+            if config.profile:
+                await asyncio.sleep(config.profile_after)
+                self.profiler.start(config.profile_duration, config.profile)
+
+        async def write_stats():
+            while config.stats_file:
+                await asyncio.sleep(config.stats_interval)
+                await loop.run_in_executor(None, self.writeStats, config.stats_file)
+
+        async def report():
+            while True:
+                await asyncio.sleep(print_stats_every_x_seconds)
                 logger.info("=" * 25)
                 logger.info("current status: %r"%self.status())
                 logger.info("tracelength distribution (top 10): %r" % dict(collections.Counter(self.traceLengths).most_common(10)))
+                logger.info("phases: %r" % self.phaseSummary())
                 logger.info("=" * 25)
-                next_stats_print = time.time() + print_stats_every_x_seconds
-
 
+        try:
+            await asyncio.gather(generate(), schedule(), postprocess(), report(), health(), self.concurrency.run(),
+                                 write_stats(), profile())
+        finally:
+            loop.remove_reader(self._wakeup[0])
+            loop.remove_signal_handler(signal.SIGUSR1)
+            postprocessor.shutdown(wait=False)
+            io_threads.shutdown(wait=False)
+
+    def writeStats(self, filename):
+        """ Writes the status and the stage latencies to the given file, as json """
+        stats = {"status": self.status(), "metrics": self._fuzzer.metrics.summary()}
+        # Written to a temp file first, so that readers never see a partial file
+        tmpfile = "%s.tmp" % filename
+        try:
+            with open(tmpfile, "w") as f:
+                json.dump(stats, f, default=str)
+            os.replace(tmpfile, filename)
+        except OSError as e:
+            logger.warning("Could not write the stats to %s: %s" % (filename, e))
 
     def dry_run(self):
         tstart = time.time()
@@ -437,8 +2126,10 @@ class TestExecutor(object):
             "starttime": datetime.utcfromtimestamp(self.stats["start_time"]).strftime('%Y-%m-%d %H:%M:%S'),
             "pass": self.numPass(),
             "fail": self.numFails(),
+            "truncated": self.stats["truncated_count"],
             "failures": self.failures,
             "speed": self.testsPerSecond(),
+            "numTraces": len(self.traceLengths),
             "mean": statistics.mean(self.traceLengths) if self.traceLengths else "NA",
             "stdev": statistics.stdev(self.traceLengths) if len(self.traceLengths) > 2 else "NA",
             "numZero": self.traceLengths.count(0) if self.traceLengths else "NA",
@@ -447,6 +2138,284 @@ class TestExecutor(object):
             "numConst": statistics.mean(self.traceConstantinopleOps) if self.traceConstantinopleOps else "NA",
             "activeSockets": self.stats["num_active_sockets"],
             "activeTests": self.stats["num_active_tests"],
+            "pendingResults": self.stats["num_pending_results"],
+            "phases": self.phaseSummary(),
+            "generators": self._fuzzer.generatorSummary(),
+            "instances": self._fuzzer.instanceSummary(),
+            "signatures": self._fuzzer.signatures.summary(),
+            "coverage": self._fuzzer.coverage.summary() if self._fuzzer.coverage is not None else None,
+            "concurrency": self.concurrency.summary() if self.concurrency is not None else {},
+            "profile": self.profiler.status(),
+            "traceCache": self._fuzzer.traceCache.summary() if self._fuzzer.traceCache is not None else None,
+            "prefilter": self._fuzzer.prefilter.summary() if self._fuzzer.prefilter is not None else None,
+        }
+
+
+def codegen_weights(config):
+    """ The code generators enabled in the [codegen] section, with their weights """
+    codegens = {}
+    for engine in (statetest.rndval.RndCodeBytes, statetest.rndval.RndCodeInstr, statetest.rndval.RndCodeSmart2):
+        if config.codegen.getboolean("engine.%s.enabled" % engine.__name__, True):  # is engine enabled?
+            codegens[engine] = int(config.codegen.get("engine.%s.weight" % engine.__name__,
+                                                      "50"))  # create engine/weight mapping
+    return codegens
+
+
+def make_statetest_template(config):
+    """ Creates the statetest template, with the code generators enabled in the [codegen] section """
+    template = statetest.StateTestTemplate(nonce="0x1d",
+                                           codegenerators=codegen_weights(config),
+                                           fill_prestate_for_args=True,
+                                           fill_prestate_for_tx_to=True,
+                                           _config=config)
+    template.info.fuzzer = "evmlab tin"
+    template.add_precomipled_prestates()
+    return template
+
+
+def apply_generation_weights(template, weights):
+    """ Applies the weights of the CoverageScheduler to a statetest template """
+    template.reweight_codegens({engine: weights["engines"].get(engine.__name__, 0) for engine in template.codegens})
+    for codegen in template.codegens.values():
+        if hasattr(codegen, "set_opcode_weights"):
+            codegen.set_opcode_weights(weights["opcodes"])
+
+
+def derive_seed(seed, index):
+    """ The RNG seed of generator number index. Seeding with a str is deterministic (it is hashed
+    with sha512), so the same base seed always yields the same tests per generator """
+    return "%s-%d" % (seed, index)
+
+
+def generate_worker(config, index, conn):
+    """ Runs in a generator process: fills statetests from its own template, and sends them
+    serialized over conn, as (counter, json bytes, code generator, generation time, prefilter
+    reason, prefilter counts). The counters are interleaved between
+    the generators (index, index + n, index + 2n, ...), so that test identifiers stay unique.
+    Sending blocks while the pipe is full, which throttles the generator to the executor.
+    The fuzzer sends new generation weights over the same connection (see CoverageScheduler).
+    Tests rejected by the PreFilter are not sent, its counts go along with the next test.
+    """
+    random.seed(derive_seed(config.generator_seed, index))
+    template = make_statetest_template(config)
+    prefilter = None
+    if config.prefilter:
+        prefilter = PreFilter(config.prefilter_sample, seed="%s-prefilter" % derive_seed(config.generator_seed, index))
+    counter = index
+    while True:
+        try:
+            while conn.poll():
+                apply_generation_weights(template, conn.recv())
+            t0 = time.time()
+            s = StateTest(template.fill(), counter, config=config)
+            reason = None
+            if prefilter is not None:
+                (accepted, reason) = prefilter.accept(s.statetest)
+                if not accepted:
+                    continue
+            data = json.dumps(s.statetest).encode()
+            conn.send((counter, data, template.main_codegen, time.time() - t0, reason,
+                       prefilter.counts() if prefilter is not None else None))
+        except (BrokenPipeError, EOFError):
+            # The fuzzer has exited
+            return
+        counter = counter + config.generator_processes
+
+
+class ClientRunner(object):
+    """ A long-lived runner inside a client container, which replaces a docker exec per test.
+
+    The runner is a small shell loop, which reads "<job> <command>" lines from a request fifo,
+    runs each command in the background, and writes "<job> <exitcode>" to a response fifo when
+    it's done. The fifos live on the mounted logs volume, so the fuzzer talks to the runner
+    without going through the docker API.
+    """
+
+    SCRIPT = """# evmlab client runner, see fuzzer.ClientRunner
+requests=$1
+responses=$2
+exec 3<>"$requests"
+echo "ready $$" > "$responses"
+while read -r job cmd <&3; do
+    ( (sh -c "$cmd" < /dev/null; echo "$job $?" > "$responses") & )
+done
+"""
+
+    def __init__(self, name, hostdir, containerdir):
+        self.name = name
+        self._containerdir = containerdir
+        self._requests = os.path.join(hostdir, "%s.in" % name)
+        self._responses = os.path.join(hostdir, "%s.out" % name)
+        self._script = os.path.join(hostdir, "runner.sh")
+        os.makedirs(hostdir, exist_ok=True)
+        with open(self._script, "w") as f:
+            f.write(ClientRunner.SCRIPT)
+        for fifo in (self._requests, self._responses):
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+        # Both fifos are opened read-write, so that opening never blocks, and neither end sees EOF
+        # when the other side goes away
+        self._in = os.open(self._requests, os.O_RDWR)
+        self._out = os.open(self._responses, os.O_RDWR | os.O_NONBLOCK)
+        self._buffer = b''
+        self._jobs = itertools.count()
+        # Jobs waited for, and jobs which finished before anyone waited for them
+        self._waiters = {}
+        self._done = {}
+        self._loop = None
+
+    @property
+    def command(self):
+        """ The command which starts the runner inside the container """
+        return ["/bin/sh"] + [os.path.join(self._containerdir, os.path.basename(f))
+                              for f in (self._script, self._requests, self._responses)]
+
+    def wait_ready(self, timeout=10):
+        """ Returns True once the runner has announced itself, False on timeout """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            select.select([self._out], [], [], max(deadline - time.time(), 0))
+            for line in self._read():
+                if line.startswith("ready"):
+                    return True
+        return False
+
+    def _read(self):
+        try:
+            self._buffer = self._buffer + os.read(self._out, 65536)
+        except BlockingIOError:
+            pass
+        lines = self._buffer.split(b"\n")
+        self._buffer = lines.pop()
+        return [line.decode() for line in lines]
+
+    def submit(self, cmd):
+        """ Submits a command to the runner, returns the job number.
+        Commands wrapped in /bin/sh -c (see Fuzzer.shWrap) are passed on as they are """
+        if cmd[:2] == ["/bin/sh", "-c"]:
+            line = cmd[2]
+        else:
+            line = " ".join(shlex.quote(c) for c in cmd)
+        job = next(self._jobs)
+        # Lines shorter than PIPE_BUF are written atomically, even when submitting from several threads
+        os.write(self._in, ("%d %s\n" % (job, line)).encode())
+        return job
+
+    def _on_response(self):
+        for line in self._read():
+            (job, exitcode) = line.split()[:2]
+            (job, exitcode) = (int(job), int(exitcode))
+            if job in self._waiters:
+                self._waiters.pop(job).set_result(exitcode)
+            else:
+                self._done[job] = exitcode
+
+    def wait(self, job):
+        """ Returns an asyncio future which resolves to the exit code of the job """
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            loop.add_reader(self._out, self._on_response)
+            self._loop = loop
+        future = loop.create_future()
+        if job in self._done:
+            future.set_result(self._done.pop(job))
+        else:
+            self._waiters[job] = future
+        return future
+
+    def wait_job(self, job):
+        """ Blocks until the job is done, and returns its exit code (None if the runner is gone).
+        For callers without an event loop, like the tools which run a single test """
+        while job not in self._done:
+            if self._out is None:
+                return None
+            select.select([self._out], [], [])
+            self._on_response()
+        return self._done.pop(job)
+
+    def abort(self):
+        """ Resolves all waiting jobs with None (the runner is gone) and closes the fifos """
+        for future in self._waiters.values():
+            if not future.done():
+                future.set_result(None)
+        self._waiters = {}
+        self.close()
+
+    def close(self):
+        if self._out is None:
+            return
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._out)
+        os.close(self._in)
+        os.close(self._out)
+        (self._in, self._out) = (None, None)
+
+
+class ClientInstance(object):
+    """ One daemon container of a client. A client can have several (see <client>.instances),
+    and each test goes to the instance with the least outstanding jobs. The instance keeps track
+    of its jobs, so that wedged containers can be detected and restarted.
+    """
+
+    def __init__(self, client_name, name, image):
+        self.client_name = client_name
+        self.name = name
+        self.image = image
+        self.container = None
+        self.runner = None
+        # False while the instance is restarted, so that no new jobs are sent to it
+        self.healthy = True
+        # Incremented on every restart. Jobs from an earlier generation were cut off by the restart
+        self.generation = 0
+        self.restarts = 0
+        self.completed = 0
+        self.latencies = collections.deque([], 100)
+        self._pending = {}
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def outstanding(self):
+        return len(self._pending)
+
+    def begin(self):
+        """ Registers a new job, returns its token """
+        with self._lock:
+            token = next(self._tokens)
+            self._pending[token] = time.time()
+            return token
+
+    def end(self, token):
+        with self._lock:
+            start = self._pending.pop(token, None)
+            if start is not None:
+                self.latencies.append(time.time() - start)
+                self.completed = self.completed + 1
+
+    def oldest(self):
+        """ The age of the oldest outstanding job, in seconds """
+        with self._lock:
+            if not self._pending:
+                return 0
+            return time.time() - min(self._pending.values())
+
+    def reset(self):
+        """ Forgets the outstanding jobs, after a restart """
+        with self._lock:
+            self._pending = {}
+            self.generation = self.generation + 1
+            self.restarts = self.restarts + 1
+
+    def summary(self):
+        import statistics
+        return {
+            "outstanding": self.outstanding,
+            "completed": self.completed,
+            "restarts": self.restarts,
+            "runner": self.runner is not None,
+            "latency": round(statistics.mean(self.latencies), 3) if self.latencies else "NA",
+            "maxLatency": round(max(self.latencies), 3) if self.latencies else "NA",
         }
 
 
@@ -468,27 +2437,78 @@ class Fuzzer(object):
         self._max_trace_len = 0
         self._num_zero_traces = 0
 
-        self._dockerclient = docker.from_env()
+        # Docker is only needed if any client runs in a container (see Config.binaries)
+        self._dockerclient = None
+        if any(isDocker for (name, isDocker, path) in config.active_clients):
+            self._dockerclient = docker.from_env()
+
+        # Tests from batches which could not be split, to be run on their own
+        self.reruns = collections.deque()
 
         if config.docker_force_update_image is not None:
             for image in config.docker_force_update_image:
                 self.docker_remove_image(image=image, force=True)
 
-        codegens = {}
-        for engine in (statetest.rndval.RndCodeBytes, statetest.rndval.RndCodeInstr, statetest.rndval.RndCodeSmart2):
-            if self._config.codegen.getboolean("engine.%s.enabled" % engine.__name__, True):  # is engine enabled?
-                codegens[engine] = int(self._config.codegen.get("engine.%s.weight" % engine.__name__,
-                                                                "50"))  # create engine/weight mapping
-
-        # todo: instantiate once?
-
-        self.statetest_template = statetest.StateTestTemplate(nonce="0x1d",
-                                                              codegenerators=codegens,
-                                                              fill_prestate_for_args=True,
-                                                              fill_prestate_for_tx_to=True,
-                                                              _config=self._config)
-        self.statetest_template.info.fuzzer = "evmlab tin"
-        self.statetest_template.add_precomipled_prestates()
+        # The daemon containers per client (see ClientInstance)
+        self.instances = {}
+        self._pickLock = threading.Lock()
+
+        # Per generator: the number of tests it produced, see generatorSummary
+        self.generated = collections.Counter()
+        self._generateStart = None
+
+        # The latencies per stage
+        self.metrics = Metrics()
+
+        # Where the artefacts of failing tests go, if not in plain files. An artefacts dir which
+        # has been migrated to a store keeps being used as one
+        self.store = None
+        if config.artefact_store or is_store(config.artefacts):
+            self.store = ArtefactStore(config.artefacts)
+
+        # The client outputs of earlier runs, see TraceCache
+        self.traceCache = None
+        if config.trace_cache:
+            self.traceCache = TraceCache(config.trace_cache, config.trace_cache_size * 1024 * 1024, self.clientVersion)
+
+        # The consensus failures seen so far, by divergence signature
+        self.signatures = SignatureIndex(os.path.join(config.artefacts, "signatures.jsonl"), config.signature_examples)
+
+        # Skips the generated tests which can't produce a useful trace
+        self.prefilter = None
+        if config.prefilter:
+            self.prefilter = PreFilter(config.prefilter_sample, seed="%s-prefilter" % config.generator_seed)
+
+        # The coverage of the tests, which steers the test generation with coverage_feedback. The
+        # weights are passed on to the generator processes, or taken by the generator thread
+        self.coverage = None
+        if config.coverage:
+            self.coverage = CoverageScheduler({engine.__name__: weight for (engine, weight) in codegen_weights(config).items()},
+                                              config.coverage_interval)
+        self._generatorConns = []
+        self._weights = None
+
+        # The template used when generating on a thread, seeded like the first generator process
+        random.seed(derive_seed(self._config.generator_seed, 0))
+        self.statetest_template = make_statetest_template(self._config)
+
+    def clientVersion(self, client_name):
+        """ What identifies the build of a client, for the TraceCache: the image id of a docker
+        client, the hash of the binary of a native one. None if it can't be told """
+        for (name, isDocker, path) in self._config.active_clients:
+            if name != client_name:
+                continue
+            try:
+                if isDocker:
+                    return self._dockerclient.images.get(path).id
+                h = hashlib.sha256()
+                with open(shutil.which(path) or path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        h.update(chunk)
+                return "sha256:%s" % h.hexdigest()
+            except Exception as e:
+                logger.warning("Not caching the outputs of %s, can't tell its version: %s" % (client_name, e))
+        return None
 
     def docker_remove_image(self, image, force=True):
         self._dockerclient.images.remove(image=image, force=force)
@@ -506,15 +2526,20 @@ class Fuzzer(object):
         ```
 
         """
-        daemons = []
         # Start the processes
         for (client_name, isDocker, cmd) in self._config.active_clients:
             if isDocker:
-                logger.info("Starting daemon for %s : %s", client_name, cmd)
-                # First, kill off any existing daemons
-                self.kill_daemon(client_name)
-                procinfo = self.start_daemon(client_name, cmd)
-                daemons.append((procinfo, client_name))
+                instances = []
+                # The first instance is named after the client, the others get a suffix
+                for i in range(self._config.instances[client_name]):
+                    name = client_name if i == 0 else "%s-%d" % (client_name, i)
+                    instance = ClientInstance(client_name, name, cmd)
+                    logger.info("Starting daemon %s for %s : %s", name, client_name, cmd)
+                    # First, kill off any existing daemons
+                    self.kill_daemon(name)
+                    self.start_daemon(instance)
+                    instances.append(instance)
+                self.instances[client_name] = instances
             else:
                 logger.warning("Not a docker client %s", client_name)
 
@@ -523,23 +2548,98 @@ class Fuzzer(object):
         for (client_name, isDocker, cmd) in self._config.active_clients:
             if isDocker:
                 logger.info("Stopping daemon for %s : %s", client_name, cmd)
-                self.kill_daemon(client_name)
+                instances = self.instances.pop(client_name, [])
+                for instance in instances:
+                    if instance.runner is not None:
+                        instance.runner.close()
+                    self.kill_daemon(instance.name)
+                if not instances:
+                    self.kill_daemon(client_name)
             else:
                 logger.warning("Not a docker client %s", client_name)
 
-    def start_daemon(self, clientname, imagename):
-        self._dockerclient.containers.run(image=imagename,
+    def start_daemon(self, instance):
+        # With an init process, the finished jobs of the runner are reaped
+        instance.container = self._dockerclient.containers.run(image=instance.image,
                                     entrypoint="sleep",
                                     command=["356d"],
-                                    name=clientname,
+                                    name=instance.name,
                                     detach=True,
                                     remove=True,
+                                    init=True,
                                     volumes={
                                         self._config.testfilesPath: {'bind': '/testfiles/', 'mode': "rw"},
                                         self._config.logfilesPath: {'bind': '/logs/', 'mode': "rw"},
                                     })
 
-        logger.info("Started docker daemon %s %s" % (imagename, clientname))
+        logger.info("Started docker daemon %s %s" % (instance.image, instance.name))
+        if self._config.runner:
+            self.start_runner(instance)
+
+    def start_runner(self, instance):
+        """ Starts a ClientRunner in the container. If it doesn't come up, the instance falls back
+        to a docker exec per test """
+        runner = ClientRunner(instance.name, os.path.join(self._config.logfilesPath, ".runner"), "/logs/.runner")
+        instance.container.exec_run(runner.command, detach=True)
+        if not runner.wait_ready():
+            logger.warning("Runner for %s did not start, falling back to docker exec" % instance.name)
+            runner.close()
+            return
+        logger.info("Started runner for %s" % instance.name)
+        instance.runner = runner
+
+    def instance_healthy(self, instance):
+        """ An instance is unhealthy if a job has been running for longer than job_timeout,
+        or its container is no longer running """
+        if instance.oldest() > self._config.job_timeout:
+            logger.warning("%s has had a job running for %d seconds" % (instance.name, instance.oldest()))
+            return False
+        try:
+            instance.container.reload()
+        except Exception as e:
+            logger.warning("Failed to inspect %s: %s" % (instance.name, e))
+            return False
+        if instance.container.status != "running":
+            logger.warning("%s is %s" % (instance.name, instance.container.status))
+            return False
+        return True
+
+    def restart_instance(self, instance):
+        """ Replaces the container of an instance. The jobs which were running on it are cut off,
+        see job_done. Returns the runner of the old container (if any), which the caller closes """
+        logger.warning("Restarting %s (restarted %d times before)" % (instance.name, instance.restarts))
+        instance.healthy = False
+        old_runner = instance.runner
+        instance.runner = None
+        instance.reset()
+        self.kill_daemon(instance.name)
+        self.start_daemon(instance)
+        instance.healthy = True
+        return old_runner
+
+    def pick_instance(self, client_name):
+        """ Picks the healthy instance with the least outstanding jobs, and registers a job on it.
+        Returns (instance, token), or (None, None) if the client has no instances """
+        instances = self.instances.get(client_name)
+        if not instances:
+            return (None, None)
+        with self._pickLock:
+            instance = min(instances, key=lambda i: (not i.healthy, i.outstanding))
+            return (instance, instance.begin())
+
+    def job_done(self, procinfo):
+        """ Records the end of a job. Returns False if its instance was restarted while it ran,
+        in which case the output can't be trusted """
+        instance = procinfo.get("instance")
+        if instance is None:
+            return True
+        # Ending a job twice is harmless, the token is only released once
+        instance.end(procinfo["token"])
+        return procinfo["generation"] == instance.generation
+
+    def instanceSummary(self):
+        return {instance.name: instance.summary()
+                for instances in self.instances.values() for instance in instances}
 
     def kill_daemon(self, clientname):
         try:
@@ -560,14 +2660,26 @@ class Fuzzer(object):
         returns (filename, object)
         """
 
-        # We'll offload test generation to another thread
+        # We'll offload test generation to another thread, which either fills the tests
+        # itself, or receives them from the generator processes
         q = queue.Queue(maxsize = 20)
+        self._generateStart = time.time()
         def createATest():
             counter = 0
             while True:
+                (weights, self._weights) = (self._weights, None)
+                if weights is not None:
+                    apply_generation_weights(self.statetest_template, weights)
                 # prestates are reused and regenerated according to the settings in prestate.txto.*, prestate.other.*
-                test_obj = self.statetest_template.fill()
-                s = StateTest(test_obj, counter, config=self._config)
+                with self.metrics.timer("generate"):
+                    test_obj = self.statetest_template.fill()
+                    s = StateTest(test_obj, counter, config=self._config)
+                s.codegen = self.statetest_template.main_codegen
+                if self.prefilter is not None:
+                    with self.metrics.timer("prefilter"):
+                        (accepted, s.prefilterReason) = self.prefilter.accept(s.statetest)
+                    if not accepted:
+                        continue
                 ## testing
                 # print(test_obj.keys())
                 # tname = list(test_obj.keys())[0]
@@ -577,16 +2689,109 @@ class Fuzzer(object):
                 # end
 
                 s._filename = fPool.get()
-                s.writeToFile()
+                with self.metrics.timer("write"):
+                    s.writeToFile()
                 counter = counter + 1
+                self.generated["thread"] += 1
                 q.put(s, block=True)
 
-        t = threading.Thread(target=createATest)
+        def receiveTests(conns):
+            while True:
+                for conn in multiprocessing.connection.wait(conns):
+                    try:
+                        (counter, data, codegen, seconds, reason, counts) = conn.recv()
+                    except EOFError:
+                        logger.warning("Generator %d exited" % conns.index(conn))
+                        conns.remove(conn)
+                        continue
+                    # The test is already renamed by the generator, the data is written as is
+                    s = StateTest(json.loads(data.decode()), counter, config=self._config, overwriteFork=False)
+                    s.codegen = codegen
+                    s.prefilterReason = reason
+                    if counts is not None:
+                        self.prefilter.merge(counts)
+                    self.metrics.record("generate", seconds)
+                    s._filename = fPool.get()
+                    with self.metrics.timer("write"):
+                        s.writeToFile(data)
+                    self.generated["process-%d" % (counter % self._config.generator_processes)] += 1
+                    q.put(s, block=True)
+
+        if self._config.generator_processes > 0:
+            conns = self.start_generators()
+            t = threading.Thread(target=receiveTests, args=(conns,))
+        else:
+            t = threading.Thread(target=createATest)
         t.start()
         # And here, just pop off the queue and yield
         while True:
             yield q.get()
 
+    def start_generators(self):
+        """ Starts the generator processes, returns the connections to receive tests on.
+        Like the analysis pool, they are forked off a server process rather than the fuzzer itself
+        """
+        context = multiprocessing.get_context("forkserver")
+        conns = []
+        for index in range(self._config.generator_processes):
+            # Duplex, for the generation weights
+            (conn, child) = context.Pipe()
+            p = context.Process(target=generate_worker, args=(self._config, index, child),
+                                name="generator-%d" % index, daemon=True)
+            p.start()
+            child.close()
+            conns.append(conn)
+        self._generatorConns = list(conns)
+        logger.info("Started %d generator processes, seed %s" % (len(conns), self._config.generator_seed))
+        return conns
+
+    def updateGenerators(self, weights):
+        """ Passes new generation weights on to the generators """
+        if not self._generatorConns:
+            self._weights = weights
+            return
+        for conn in self._generatorConns:
+            try:
+                conn.send(weights)
+            except (BrokenPipeError, OSError):
+                # The generator has exited
+                pass
+
+    def generatorSummary(self):
+        """ The number of tests generated, and tests/s, per generator """
+        if self._generateStart is None:
+            return {}
+        elapsed = max(time.time() - self._generateStart, 1e-9)
+        return {name: {"tests": count, "testsPerSecond": round(count / elapsed, 2)}
+                for (name, count) in sorted(self.generated.items())}
+
+    def generate_batches(self, size):
+        """Groups the generated tests into batches of (up to) size tests, written to one file.
+        """
+        batch = []
+        counter = 0
+        for test in self.generate_tests():
+            batch.append(test)
+            if len(batch) == size:
+                b = BatchStateTest(batch, counter, self._config)
+                b.writeToFile()
+                counter = counter + 1
+                batch = []
+                yield b
+
+    def generate_runs(self):
+        """Yields the tests (or batches of tests) to run. Tests which need to be re-run, because
+        their batch could not be split or they go on to the next phase, are yielded in between.
+        """
+        if self._config.batch_size > 1:
+            tests = self.generate_batches(self._config.batch_size)
+        else:
+            tests = self.generate_tests()
+        for test in tests:
+            while self.reruns:
+                yield self.reruns.popleft()
+            yield test
+
     def benchmark(self, method=None, duration=None):
         counter = 0
 
@@ -618,13 +2823,79 @@ class Fuzzer(object):
 
         return sum(tdiffs)/len(tdiffs)
 
-    def processTraces(self, test, forceSave=False):
+    def traceJob(self, test, forceSave=False):
+        """ The arguments for analyze_traces, to process the given test """
+        if test.phaseName == "traced":
+            traces = [(canon_trace.filename, client_name)
+                      for (canon_trace, (proc_info, client_name)) in zip(test.canon_traces, test.procs)]
+        elif len(test.socketData) > 0:
+            logger.warning("Got spurious docker failure: %s", str(test.socketData))
+            traces = []
+        else:
+            traces = [(test.tempTraceLocation(client_name), client_name) for (proc_info, client_name) in test.procs]
+        return {
+            "traces": traces,
+            "phase": test.phaseName,
+            "step_budget": self._config.step_budget,
+            "full": forceSave,
+            "binary_traces": self._config.binary_traces,
+            "outputs": [test.outputs.get(filename) for (filename, client_name) in traces] if test.outputs else None,
+            "known_signatures": self.signatures.known() if not forceSave else frozenset(),
+            "coverage": self._config.coverage,
+            "cache": {client_name: self.traceCache.tempfile(test.cacheKeys[client_name], test.id)
+                      for (filename, client_name) in traces
+                      if client_name in test.cacheKeys and client_name not in test.cacheHits},
+            "cut": sorted(test.cut),
+        }
+
+    def cacheTraces(self, test, result):
+        """ Stores the outputs which analyze_traces wrote for the TraceCache """
+        for (client_name, tmpfile) in result.get("cached", {}).items():
+            self.traceCache.store(test.cacheKeys[client_name], tmpfile)
+
+    def processTraces(self, test, forceSave=False, result=None):
+        """ Handles the result of analyze_traces for a test: the accounting, and saving the
+        artefacts of failing tests. If no result is given, the traces are analyzed here
+        """
         if test is None:
             return None
 
-        # Process previous traces
-
-        (equivalent, trace_output) = VMUtils.compare_traces(test.canon_traces, self._config.clientNames)
+        if result is None:
+            result = analyze_traces(**self.traceJob(test, forceSave))
+        self.cacheTraces(test, result)
+        test.verdict = result["verdict"]
+        equivalent = test.verdict != VMUtils.DIVERGED
+        stats = result["stats"]
+
+        # The trace length statistics only count traces which were read completely. The others
+        # were cut off at the divergence window or the step budget, and their length is unknown
+        complete = result["complete"]
+        for (tracelen, full, client_name) in zip(result["lengths"], complete, result["clients"]):
+            if not full:
+                logger.info("Compared %s steps for %s on test %s, pTime:%.02f ms" % (
+                            tracelen, client_name, test.identifier, 1000 * result["pTime"]))
+                continue
+            self._num_traces_processed += 1
+            self._total_trace_len += tracelen
+            self._max_trace_len = max(self._max_trace_len, tracelen)
+            if tracelen == 0:
+                self._num_zero_traces += 1
+            logger.info("Processed %s steps for %s on test %s, pTime:%.02f ms (depth: %s, ConstantinopleOps: %s)"
+                        % (tracelen, client_name, test.identifier, 1000 * result["pTime"],
+                        stats.get("maxDepth","nA"), stats.get("constatinopleOps","nA")))
+        if result["lengths"] and all(complete):
+            test.traceStats = (result["lengths"][-1], stats)
+        if test.prefilterReason is not None and self.prefilter is not None:
+            longest = max(result["lengths"] or [0])
+            # A cut off trace is at least as long as what was read
+            if all(complete) or longest > PreFilter.HALT_STEPS:
+                self.prefilter.onTraced(test.prefilterReason, longest)
+        if self.coverage is not None and result["coverage"] is not None:
+            if self.coverage.add(test.codegen, result["coverage"]) and self._config.coverage_feedback:
+                self.updateGenerators(self.coverage.weights())
+
+        if test.verdict == VMUtils.TRUNCATED:
+            logger.info("Test %s truncated after %d steps" % (test.identifier, self._config.step_budget))
 
         if equivalent and not forceSave:
             test.removeFiles()
@@ -632,17 +2903,32 @@ class Fuzzer(object):
 
         if not equivalent:
             logger.warning("CONSENSUS BUG!!!")
-
-        trace_summary = self.get_summary(trace_output)
+            if result["signature"] is not None:
+                test.signature = VMUtils.signature_key(result["signature"])
+                if not forceSave and not self.signatures.wantsExample(test.signature):
+                    # Seen often enough, only count it
+                    logger.info("Test %s fails like %d earlier tests: %s" % (
+                        test.id, self.signatures.signatures[test.signature]["count"], test.signature))
+                    self.signatures.add(test.signature, result["signature"], test.id)
+                    for f in result["binary_traces"]:
+                        os.remove(f)
+                    test.removeFiles()
+                    return test
+
+        test.traceFiles.extend(result["binary_traces"])
         # save the state-test
-        test.saveArtefacts()
+        test.saveArtefacts(self.store)
         # save combined trace and abbreviated trace
-        test.addArtefact("combined_trace.log", "\n".join(trace_output))
-        test.addArtefact("shortened_trace.log", "\n".join(trace_summary))
+        test.addArtefact("combined_trace.log", "\n".join(result["trace_output"]), self.store)
+        test.addArtefact("shortened_trace.log", "\n".join(result["summary"]), self.store)
+        test.saved = True
+        if test.signature is not None:
+            self.signatures.add(test.signature, result["signature"], test.id, test.listArtefacts())
 
         return test
 
-    def get_summary(self, combined_trace, n=20):
+    @staticmethod
+    def get_summary(combined_trace, n=20):
         """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section
         """
         from collections import deque
@@ -664,78 +2950,139 @@ class Fuzzer(object):
         with open(sys.argv[1]) as f:
             print("".join(self.get_summary(f.readlines())))
 
-    def start_processes(self, test):
-
+    def start_process(self, test, client_name):
+        """ Starts the given client on the test, returns the procinfo, or None if the client is unknown """
         starters = {'geth': self.startGeth,
                     'cpp': self.startCpp,
                     'parity': self.startParity,
                     'hera': self.startHera}
 
-        logger.info("Starting processes for %s on test %s" % (self._config.clientNames, test.id))
+        if client_name not in starters.keys():
+            logger.warning("Undefined client %s", client_name)
+            return None
+        logger.debug("Starting %s on test %s (%s)" % (client_name, test.id, test.phaseName))
+        with self.metrics.timer("start", client_name):
+            return self.cachedRun(test, client_name) or starters[client_name](test)
+
+    def cachedRun(self, test, client_name):
+        """ Looks the run up in the TraceCache. On a hit, the cached output is copied to the trace
+        file, and a procinfo without any process is returned. Batches are not cached, since their
+        output is only split up afterwards """
+        if self.traceCache is None or isinstance(test, BatchStateTest):
+            return None
+        key = self.traceCache.key(test, client_name, self._config.step_budget)
+        if key is None:
+            return None
+        test.cacheKeys[client_name] = key
+        path = self.traceCache.lookup(key, client_name)
+        if path is None:
+            return None
+        try:
+            shutil.copyfile(path, test.tempTraceLocation(client_name))
+        except OSError as e:
+            logger.warning("Could not use the cached output %s: %s" % (path, e))
+            return None
+        test.cacheHits.add(client_name)
+        logger.debug("Using the cached output of %s on test %s" % (client_name, test.id))
+        return {'cmd': "cached %s" % key, 'output': None, 'cached': True}
+
+    def start_processes(self, test):
+        logger.info("Starting processes for %s on test %s (%s)" % (self._config.clientNames, test.id, test.phaseName))
+        test.startTime = time.time()
         # Start the processes
         for (client_name, x, y) in self._config.active_clients:
-            if client_name in starters.keys():
-                procinfo = starters[client_name](test)
+            procinfo = self.start_process(test, client_name)
+            if procinfo is not None:
                 test.procs.append((procinfo, client_name))
-            else:
-                logger.warning("Undefined client %s", client_name)
+
+    def run_processes(self, test):
+        """ Runs the clients on the test and waits until they are done, then sets up the traces
+        like end_processes. This is what the scheduler of TestExecutor does asynchronously, for
+        the tools which run one test at a time """
+        self.start_processes(test)
+        for (procinfo, client_name) in test.procs:
+            self.wait_process(test, procinfo, client_name)
+        self.end_processes(test)
+
+    def wait_process(self, test, procinfo, client_name):
+        """ Waits until the run of a client (as returned by start_process) is done """
+        try:
+            if "cached" in procinfo:
+                pass
+            elif "runner" in procinfo:
+                procinfo["exitcode"] = procinfo["runner"].wait_job(procinfo["job"])
+            elif "communicate" in procinfo:
+                output = procinfo["communicate"]()
+                if output is not None:
+                    test.outputs[test.tempTraceLocation(client_name)] = output
+            elif "procs" in procinfo:
+                for proc in procinfo["procs"]:
+                    proc.wait()
+                procinfo["exitcode"] = procinfo["procs"][0].returncode
+            elif procinfo["output"] is not None:
+                # A docker exec, which is done when its socket is closed
+                socket = procinfo["output"]
+                test.socketData = test.socketData + socket.readall()
+                test.socketEvent = test.socketEvent + "[closed]"
+                socket.close()
+            self.recordCut(test, procinfo, client_name)
+        finally:
+            if not self.job_done(procinfo):
+                # Treated like a docker failure, the test is skipped (see end_processes)
+                test.socketData = test.socketData + b"instance restarted"
+
+    def checkPhase(self, test, result=None):
+        """ Checks whether the clients agree on a test run in the untraced or nostack phase.
+        If no result of analyze_traces is given, the outputs are analyzed here """
+        if result is None:
+            result = analyze_traces(**self.traceJob(test))
+        self.cacheTraces(test, result)
+        return result["verdict"] != VMUtils.DIVERGED
 
     def end_processes(self, test):
-        """ End processes for the given test, slurp up the output and compare the traces
-        returns the length of the canon-trace emitted (or -1)
+        """ End processes for the given test, and set up the canonical traces for comparison.
+        The traces are not read here, but by analyze_traces
         """
         # Handle the old processes
         if test is None:
             return None
-        tracelen = 0
-        canon_steps = None
-        canon_trace = []
-        first = True
-        stats = VMUtils.Stats()
+        # Release the instance jobs which weren't recorded as done yet (see job_done), otherwise
+        # the instances would look wedged to the health checks
         for (proc_info, client_name) in test.procs:
-            t1 = time.time()
-            if len(test.socketData) > 0:
-                # If there was any output, it indicates an error, see #102. 
-                # The only possible output, since we wrap the execution and pipe everything to file, 
-                # are docker container exec errors if it could not instantiate the executable. 
-                # In that case, which happens about once a million execs, just ignore this test and move on. 
-                logger.warning("Got spurious docker failure: %s", str(test.socketData))
-                return (0, stats.result())
+            self.job_done(proc_info)
+        test.stats = VMUtils.Stats()
+        if len(test.socketData) > 0:
+            # If there was any output, it indicates an error, see #102.
+            # The only possible output, since we wrap the execution and pipe everything to file,
+            # are docker container exec errors if it could not instantiate the executable.
+            # In that case, which happens about once a million execs, just ignore this test and move on.
+            logger.warning("Got spurious docker failure: %s", str(test.socketData))
+            test.traceStats = (0, test.stats.result())
+            return
 
+        for (proc_info, client_name) in test.procs:
             test.storeTrace(client_name, proc_info['cmd'])
-            canonicalizer = self.canonicalizers[client_name]
-            canon_steps = []
-            filename = test.tempTraceLocation(client_name)
-            try:
-                with open(filename) as output:
-                    canon_step_generator = canonicalizer(output)
-                    stat_generator = stats.traceStats(canon_step_generator)
-                    canon_trace = [VMUtils.toText(step) for step in stat_generator]
-            except FileNotFoundError:
-                # We hit these sometimes, maybe twice every million execs or so
-                logger.warning("The file %s could not be found!" % filename)
-                logger.warning("Socket event %s" % test.socketEvent)
-                logger.warning("Socket data %s" %  str(test.socketData))
-                #TODO, try to find out what happened -- if there's any output from the process
-            stats.stop()
-            test.canon_traces.append(canon_trace)
-            tracelen = len(canon_trace)
-            self._num_traces_processed += 1
-            self._total_trace_len += tracelen
-            self._max_trace_len = max(self._max_trace_len, tracelen)
-            if tracelen==0:
-                self._num_zero_traces += 1
-            t2 = time.time()
-            logger.info("Processed %s steps for %s on test %s, pTime:%.02f ms (depth: %s, ConstantinopleOps: %s)"
-                        % (tracelen, client_name, test.identifier, 1000 * (t2 - t1),
-                        stats.result().get("maxDepth","nA"), stats.result().get("constatinopleOps","nA")))
-
-        # print(stats)
-        # print(canon_steps)
-        # print("\n".join(canon_trace))
-        return (tracelen, stats.result())
+            test.canon_traces.append(CanonicalTrace(test.tempTraceLocation(client_name),
+                                                    self.canonicalizers[client_name], test=test))
 
     def execInDocker(self, name, cmd, stdout=True, stderr=True):
+        """ Executes the command in the client container: through its runner if there is one,
+        otherwise via docker exec. Runner jobs are waited for with ClientRunner.wait, docker
+        execs by waiting for their 'output' socket to close """
+        (instance, token) = self.pick_instance(name)
+        retval = {'cmd': " ".join(cmd)}
+        if instance is not None:
+            retval.update({'instance': instance, 'token': token, 'generation': instance.generation})
+
+        runner = instance.runner if instance is not None else None
+        if runner is not None:
+            try:
+                retval.update({'output': None, 'runner': runner, 'job': runner.submit(cmd)})
+                return retval
+            except OSError as e:
+                logger.warning("Runner for %s failed (%s), falling back to docker exec" % (instance.name, e))
+                instance.runner = None
+
         start_time = time.time()
 
         # For now, we need to disable stream, since otherwise the stderr and stdout
@@ -749,11 +3096,12 @@ class Fuzzer(object):
         stream = False
         socket = True
         # logger.info("executing in %s: %s" %  (name," ".join(cmd)))
-        container = self._dockerclient.containers.get(name)
+        if instance is not None:
+            container = instance.container
+        else:
+            container = self._dockerclient.containers.get(name)
         (exitcode, output) = container.exec_run(cmd, stream=stream, socket=socket, stdout=stdout, stderr=stderr)
 
-        retval = {'cmd': " ".join(cmd)}
-
         # If stream is False, then docker soups up the output, and we just decode it once
         # when the caller wants it
 
@@ -769,10 +3117,157 @@ class Fuzzer(object):
 
         return retval
 
-    @staticmethod
-    def shWrap(cmd, output):
-        """ Wraps a command in /bin/sh, with output to the given file"""
-        return ["/bin/sh", "-c", " ".join(cmd) + " &> /logs/%s" % output]
+    # Lines of output allowed beyond the step budget, since not all lines are steps
+    BUDGET_SLACK = 100
+
+    def budgetLines(self, num_tests=1):
+        """ The number of output lines allowed under the step budget. The clients print lines
+        which aren't steps as well, and not equally many, so the output of a client can be cut
+        off before it reaches the step budget. Such outputs are recorded by recordCut """
+        return (self._config.step_budget + Fuzzer.BUDGET_SLACK) * num_tests
+
+    def recordCut(self, test, procinfo, client_name):
+        """ Records whether the output of a client run, which is done, was cut off at budgetLines.
+        The trace of such a client ends early, which analyze_traces takes into account """
+        if self._config.step_budget is None or "cached" in procinfo:
+            return
+        if "communicate" in procinfo:
+            cut = procinfo.get("truncated", False)
+        else:
+            # head stops after budgetLines, so a file with that many lines was (most likely) cut
+            cut = count_lines(test.tempTraceLocation(client_name)) >= self.budgetLines(test.numTests)
+        if cut:
+            test.cut.add(client_name)
+
+    def shWrap(self, cmd, output, num_tests=1):
+        """ Wraps a command in /bin/sh, with output to the given file.
+        With a step budget, the output is cut off by head, which makes the client exit on SIGPIPE"""
+        if self._config.step_budget is None:
+            return ["/bin/sh", "-c", " ".join(cmd) + " &> /logs/%s" % output]
+        return ["/bin/sh", "-c", " ".join(cmd) + " 2>&1 | head -n %d > /logs/%s" %
+                (self.budgetLines(num_tests), output)]
+
+    def clientBinary(self, client_name, default):
+        """ The binary to run: the configured <client>.binary, or the one in the container """
+        return self._config.binaries.get(client_name, default)
+
+    def clientTestfile(self, client_name, test):
+        """ The path of the test file, as seen by the client """
+        if self._config.io_mode == "pipes":
+            return "/dev/stdin"
+        if client_name in self._config.binaries:
+            return test.fullfilename
+        return "/testfiles/%s" % os.path.basename(test.filename)
+
+    def runClient(self, client_name, cmd, test, **kwargs):
+        """ Runs the client on the test, natively if it has a <client>.binary, otherwise in its container """
+        if self._config.io_mode == "pipes":
+            return self.startPiped(client_name, cmd, test)
+        if client_name in self._config.binaries:
+            return self.startNative(client_name, cmd, test)
+        cmd = self.shWrap(cmd, test.tempTraceFilename(client_name), test.numTests)
+        return self.execInDocker(client_name, cmd, **kwargs)
+
+    def startNative(self, client_name, cmd, test):
+        """ Starts a locally installed client binary, with its output (stdout and stderr) going to the
+        trace file. There's no shell involved: with a step budget, the output is piped into head.
+        The processes are waited for by the scheduler, see procinfo['procs']
+        """
+        procs = []
+        limits = self.resourceLimits()
+        with open(test.tempTraceLocation(client_name), "wb") as out:
+            if self._config.step_budget is None:
+                procs.append(subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT,
+                                              preexec_fn=limits))
+            else:
+                client = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT, preexec_fn=limits)
+                head = subprocess.Popen(["head", "-n", str(self.budgetLines(test.numTests))],
+                                        stdin=client.stdout, stdout=out)
+                # Only head reads the output now, so the client gets SIGPIPE once head exits
+                client.stdout.close()
+                procs.extend([client, head])
+        return {'cmd': " ".join(cmd), 'output': None, 'procs': procs}
+
+    def startPiped(self, client_name, cmd, test):
+        """ Starts the client with the test on stdin (io_mode = pipes). The returned procinfo has a
+        'communicate' function, which sends the test and returns the client output, cut off at
+        the step budget (then 'truncated' is set). An output longer than pipe_output_memory is
+        written to the trace file instead, and None is returned. It blocks, so the scheduler calls
+        it on a thread.
+
+        The clients read the whole test before they start executing, so the test is written
+        completely before the output is read.
+        """
+        data = test.serialized()
+        limit = self.budgetLines(test.numTests) if self._config.step_budget is not None else None
+        tracefile = test.tempTraceLocation(client_name)
+        memory = self._config.pipe_output_memory * 1024 * 1024
+        retval = {'cmd': " ".join(cmd), 'output': None}
+
+        if client_name in self._config.binaries:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    preexec_fn=self.resourceLimits())
+
+            def communicate():
+                try:
+                    proc.stdin.write(data)
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                (output, truncated) = read_limited(iter(lambda: proc.stdout.read1(65536), b""), limit,
+                                                   tracefile, memory)
+                retval['truncated'] = truncated
+                if truncated:
+                    proc.kill()
+                proc.stdout.close()
+                retval['exitcode'] = proc.wait()
+                return output
+            retval['communicate'] = communicate
+            return retval
+
+        (instance, token) = self.pick_instance(client_name)
+        if instance is not None:
+            retval.update({'instance': instance, 'token': token, 'generation': instance.generation})
+            container = instance.container
+        else:
+            container = self._dockerclient.containers.get(client_name)
+        (exitcode, sock) = container.exec_run(cmd, stdin=True, socket=True, stdout=True, stderr=True)
+
+        def communicate():
+            try:
+                raw = exec_socket(sock)
+                raw.sendall(data)
+                raw.shutdown(socketlib.SHUT_WR)
+                (output, truncated) = read_limited(exec_frames(sock), limit, tracefile, memory)
+                retval['truncated'] = truncated
+            finally:
+                sock.close()
+            return output
+        retval['communicate'] = communicate
+        return retval
+
+    def resourceLimits(self):
+        """ Returns a function which applies the configured resource limits, to run in a client
+        process before it executes the client (as its preexec_fn), or None if there are no limits.
+        Limiting the process from the inside means it never runs unlimited """
+        limits = []
+        if self._config.binary_memory_limit:
+            limits.append((resource.RLIMIT_AS, self._config.binary_memory_limit * 1024 * 1024))
+        if self._config.binary_cpu_limit:
+            limits.append((resource.RLIMIT_CPU, self._config.binary_cpu_limit))
+        if not limits:
+            return None
+
+        def apply():
+            for (limit, value) in limits:
+                try:
+                    resource.setrlimit(limit, (value, value))
+                except (ValueError, OSError):
+                    # More than the hard limit we already have, which then stays. There's no
+                    # logging in the child, the client is started either way
+                    pass
+        return apply
 
     def startGeth(self, test):
         """
@@ -783,15 +3278,21 @@ class Fuzzer(object):
         docker exec -it <name> <command>
 
         """
-        cmd = ["evm", "--json", "--nomemory", "statetest", "/testfiles/%s" % os.path.basename(test.filename)]
-        cmd = Fuzzer.shWrap(cmd, test.tempTraceFilename('geth'))
-        return self.execInDocker("geth", cmd, stdout=False)
+        evm = self.clientBinary("geth", "evm")
+        testfile = self.clientTestfile("geth", test)
+        cmd = [evm, "--json", "--nomemory", "statetest", testfile]
+        if test.phaseName == "untraced":
+            cmd = [evm, "statetest", testfile]
+        elif test.phaseName == "nostack":
+            cmd.insert(3, "--nostack")
+        return self.runClient("geth", cmd, test, stdout=False)
 
     def startParity(self, test):
-        cmd = ["/parity-evm", "state-test", "--std-json", "/testfiles/%s" % os.path.basename(test.filename)]
+        cmd = [self.clientBinary("parity", "/parity-evm"), "state-test", "--std-json", self.clientTestfile("parity", test)]
+        if test.phaseName == "untraced":
+            cmd.remove("--std-json")
         # cmd = ["/bin/sh","-c","/parity-evm state-test --std-json /testfiles/%s 1>&2" % os.path.basename(test.filename)]
-        cmd = Fuzzer.shWrap(cmd, test.tempTraceFilename('parity'))
-        return self.execInDocker("parity", cmd)
+        return self.runClient("parity", cmd, test)
 
     def startHera(self, test):
         cmd = ["/build/test/testeth",
@@ -3,6 +3,7 @@
 
 import fuzzer, sys, os, threading
 import logging
+from evmlab import artefacts
 logger = logging.getLogger()
 
 try:
@@ -15,24 +16,54 @@ except ImportError:
     sys.exit(1)
 
 
-f = fuzzer.configFuzzer()
-executor = fuzzer.TestExecutor(fuzzer=f)
- 
+# What the web view shows, see serve()
+view = {}
+
 @app.route("/")
 def index():
-    return flask.render_template("index.html", status = executor.status(), config = f._config.info)
+    metrics = view["metrics"]() if view.get("metrics") else None
+    return flask.render_template("index.html", status = view["status"](), config = view["config"], metrics = metrics)
+
+@app.route("/metrics")
+def metrics():
+    """ The latency histograms per stage, as json (see fuzzer.Metrics) """
+    if not view.get("metrics"):
+        flask.abort(404)
+    return flask.jsonify(view["metrics"]())
+
+def artefactStore():
+    """ The store in the artefacts dir (see evmlab.artefacts), if there is one """
+    if view.get("store") is None and artefacts.is_store(view["artefacts"]):
+        view["store"] = artefacts.ArtefactStore(view["artefacts"])
+    if view.get("store") is not None:
+        view["store"].reload()
+    return view.get("store")
 
 @app.route("/download/")
 @app.route("/download/<artefact>")
 def download(artefact = None):
-    """ Download a file -- only artefacts allowed """
+    """ Download a file -- only artefacts allowed. Artefacts in the store are decompressed
+    while they are sent """
 
-    artefactDir = fuzzer._config.artefacts
-    print("downlaod '%s'" % artefact)
+    artefactDir = view["artefacts"]
+    store = artefactStore()
+    logger.debug("download '%s'" % artefact)
     if artefact == None or artefact.strip() == "":
         # file listing
-        print("filelist")
-        return flask.render_template("listing.html", files = sorted(os.listdir(artefactDir), reverse=True) )
+        files = [f for f in os.listdir(artefactDir) if f not in (artefacts.INDEX, artefacts.OBJECTS)]
+        if store is not None:
+            files.extend(store.names())
+        return flask.render_template("listing.html", files = sorted(set(files), reverse=True) )
+
+    if store is not None and artefact in store:
+        stream = store.open(artefact)
+
+        def chunks():
+            with stream:
+                for chunk in iter(lambda: stream.read(65536), b""):
+                    yield chunk
+        return flask.Response(chunks(), mimetype="application/octet-stream",
+                              headers={"Content-Disposition": "attachment; filename=%s" % artefact})
 
     insecure_fullpath = os.path.realpath(os.path.join(artefactDir, artefact))
     # Now check that the path is a subdir of artefact idr
@@ -41,15 +72,43 @@ def download(artefact = None):
 
     return flask.send_from_directory(artefactDir, artefact, as_attachment=True)
 
+@app.route("/profile", methods=["GET", "POST"])
+def profile():
+    """ The state of the profiler (see fuzzer.Profiler). POST starts a profile, with the
+    arguments duration (seconds) and kinds (cpu, memory or both, comma-separated) """
+    profiler = view.get("profiler")
+    if profiler is None:
+        flask.abort(404)
+    if flask.request.method == "POST":
+        try:
+            duration = int(flask.request.values.get("duration", 60))
+            kinds = [k.strip() for k in flask.request.values.get("kinds", "cpu,memory").split(",") if k.strip()]
+            started = profiler.start(duration, kinds)
+        except ValueError as e:
+            return flask.jsonify(error=str(e)), 400
+        return flask.jsonify(dict(profiler.status(), started=started))
+    return flask.jsonify(profiler.status())
+
 def flaskRunner(host, port ):
     app.run(host, port)
 
+def serve(status, config, artefacts, host="localhost", port=8080, metrics=None, profiler=None):
+    """ Starts the web view on a thread. status is called for every page view, and returns
+    a dict like TestExecutor.status; config is a list of lines describing the setup.
+    metrics (if given) returns the latency histograms, like Metrics.summary, and profiler is
+    the fuzzer.Profiler to control on /profile """
+    view.update({"status": status, "config": config, "artefacts": artefacts, "metrics": metrics,
+                 "profiler": profiler})
+    thread = threading.Thread(target=flaskRunner, args = (host, port), daemon=True)
+    thread.start()
+    return thread
+
 def main():
-    host = "localhost"
-    port = 8080
+    f = fuzzer.configFuzzer()
+    executor = fuzzer.TestExecutor(fuzzer=f)
 
-    thread = threading.Thread(target=flaskRunner, args = (host, port))
-    thread.start()
+    serve(executor.status, f._config.info, f._config.artefacts, metrics=f.metrics.summary,
+          profiler=executor.profiler)
 
     # Start all docker daemons that we'll use during the execution
     f.start_daemons()
@@ -6,6 +6,7 @@ Executes state tests on multiple clients, checking for EVM trace equivalence
 """
 import json, sys, re, os, subprocess, io, itertools, traceback, time, collections, shutil
 from evmlab import vm as VMUtils
+from evmlab import artefacts
 from fuzzer import Fuzzer,  RawStateTest, Config
 import copy
 import time
@@ -22,9 +23,7 @@ def runTest(test_obj, filename, f):
         id = "".join(filename.split(".")[:-1])
     test = RawStateTest(copy.deepcopy(test_obj),id, filename, f._config)
     test.writeToFile()
-    f.start_processes(test)
-    time.sleep(1)
-    f.end_processes(test)
+    f.run_processes(test)
     failingTestcase = f.processTraces(test, forceSave = True)
     if failingTestcase is None:
             return
@@ -35,7 +34,8 @@ class dummy():
         self.configfile = "statetests.ini"
         self.force_save = True
         self.enable_reporting = False
-        self.docker_force_update_image = []
+        self.docker_force_update_image = None
+        self.set_config = []
 
 def main(args):
 
@@ -45,8 +45,8 @@ def main(args):
 
     path = args[0] 
     testcase = None
-    # Can we read the testfile? 
-    with open(path, "r") as f:
+    # Can we read the testfile? It may be compressed, or in an artefact store
+    with artefacts.open_artefact(path, "rt") as f:
         testcase = json.load(f)
     # Start all docker daemons that we'll use during the execution
     
@@ -6,7 +6,10 @@ Executes state tests on multiple clients, checking for EVM trace equivalence
 """
 import json, sys, re, os, subprocess, io, itertools, traceback, time, collections, shutil
 from evmlab import vm as VMUtils
-from fuzzer import startDaemons, StateTest, start_processes, end_processes, processTraces
+from evmlab import artefacts
+from evmlab import tracefile
+from fuzzer import Fuzzer, StateTest, Config
+from test_executor import dummy
 import copy
 
 import logging
@@ -105,21 +108,59 @@ def forkify(test_obj):
 
 
 
+# The binary traces of a failing test, as the fuzzer saves them with binary_traces = Yes
+TRACE_NAME = re.compile(r"-(?P<client>[^-/]+)\.trace\.log\.bin$")
+
+
+def reference_signature(paths, clientNames=()):
+    """ Returns the key of the divergence signature of the binary traces (see evmlab.tracefile) of
+    a failing test. The clients are named after the trace files, <test>-<client>.trace.log.bin,
+    or <client>=<path> can be given. They are compared in the order of clientNames, like the
+    fuzzer does, since the order of the clients is part of the signature """
+    traces = []
+    for path in paths:
+        (client, sep, filename) = path.partition("=")
+        if not sep:
+            match = TRACE_NAME.search(path)
+            if match is None:
+                raise ValueError("Can't tell the client of %s, pass it as <client>=%s" % (path, path))
+            (client, filename) = (match.group("client"), path)
+        traces.append((client, filename))
+    order = list(clientNames)
+    traces.sort(key=lambda trace: order.index(trace[0]) if trace[0] in order else len(order))
+    readers = [tracefile.TraceReader(filename) for (client, filename) in traces]
+    try:
+        (verdict, summary, signature) = VMUtils.trace_divergence(readers, [client for (client, filename) in traces])
+    finally:
+        for reader in readers:
+            reader.close()
+    if signature is None:
+        raise ValueError("The traces do not diverge")
+    return VMUtils.signature_key(signature)
+
+
 class Mimizer():
-    def __init__(self):
+    def __init__(self, fuzzer, signature=None):
         self.counter = 0
+        self.fuzzer = fuzzer
+        # The signature key of the failure to keep, if the traces of the test were given
+        self.signature = signature
 
     def isConsensus(self, test_obj):
-        """ Returns true if the clients are in consensus over the testcase """
+        """ Returns true if the clients are in consensus over the testcase, or if they fail
+        differently than the given traces did. Variants which were run before are answered from
+        the trace cache, if one is configured (see fuzzer.TraceCache) """
         self.counter = self.counter +1 
-        test = StateTest(copy.deepcopy(test_obj), self.counter, overwriteFork=False)
+        test = StateTest(copy.deepcopy(test_obj), self.counter, config=self.fuzzer._config, overwriteFork=False)
         test.writeToFile()
-        start_processes(test)
-        data = end_processes(test)
-        failingTestcase = processTraces(test, forceSave = False)
-        if failingTestcase is not None:
-            return False
-        return True
+        self.fuzzer.run_processes(test)
+        failingTestcase = self.fuzzer.processTraces(test, forceSave = False)
+        if failingTestcase is None:
+            return True
+        if self.signature is not None and failingTestcase.signature != self.signature:
+            print("Different failure: %s" % failingTestcase.signature)
+            return True
+        return False
 
 
     def reportResult(self, testcase, typ, path):
@@ -173,19 +214,28 @@ class Mimizer():
 
 
 def main(args):
+    """ test_minimizer.py <testfile> [<trace.bin> ...]
+
+    With the binary traces of the failing test, only variants which fail the same way (with the
+    same divergence signature) are kept. Otherwise, any consensus failure is """
     if len(args) < 1:
         logger.warning("please provide a filename")
         return
 
     path = args[0] 
     testcase = None
-    # Can we read the testfile? 
-    with open(path, "r") as f:
+    # Can we read the testfile? It may be compressed, or in an artefact store
+    with artefacts.open_artefact(path, "rt") as f:
         testcase = json.load(f)
     # Start all docker daemons that we'll use during the execution
-    startDaemons()
+    f = Fuzzer(config=Config(dummy()))
+    signature = None
+    if len(args) > 1:
+        signature = reference_signature(args[1:], f._config.clientNames)
+        print("Minimizing failure: %s" % signature)
+    f.start_daemons()
     
-    Mimizer().startMutation(testcase, path)
+    Mimizer(f, signature).startMutation(testcase, path)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -54,6 +54,8 @@ def parse_config():
     cfg['SINGLE_TEST_TMP_FILE'] ="%s-%d" % (config[uname]['single_test_tmp_file'], os.getpid())
 
     cfg['LOGS_PATH'] = config[uname]['logs_path']
+    # Tests are cut off after this many steps, which saves time on huge traces (0 = no limit)
+    cfg['STEP_BUDGET'] = config[uname].getint('step_budget', fallback=0) or None
 
     logger.info("Config")
     logger.info("\tActive clients:")
@@ -67,6 +69,7 @@ def parse_config():
     logger.info("\tPrestate tempfile:    %s",   cfg['PRESTATE_TMP_FILE'])
     logger.info("\tSingle test tempfile: %s",cfg['SINGLE_TEST_TMP_FILE'])
     logger.info("\tLog path:             %s",            cfg['LOGS_PATH'])
+    logger.info("\tStep budget:          %s",          cfg['STEP_BUDGET'])
 
 
 
@@ -472,6 +475,7 @@ def testIterator():
 def main():
     fail_count = 0
     pass_count = 0
+    truncated_count = 0
     failing_files = []
     test_number = 0
     start_time = time.time()
@@ -489,13 +493,14 @@ def main():
                 continue
 
 
-        (test_number, num_fails, num_passes,failures) = perform_test(f, test_name, test_number)
+        (test_number, num_fails, num_passes,failures, num_truncated) = perform_test(f, test_name, test_number)
 
         failing_files.extend(failures)
 
         #Total sums
         fail_count = fail_count + num_fails
         pass_count = pass_count + num_passes
+        truncated_count = truncated_count + num_truncated
 
         time_elapsed = time.time() - start_time
 
@@ -512,31 +517,48 @@ def main():
     # done with all tests. print totals
     logger.info("fail_count: %d" % fail_count)
     logger.info("pass_count: %d" % pass_count)
+    logger.info("truncated:  %d" % truncated_count)
     logger.info("total:      %d" % (fail_count + pass_count))
 
 
-def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
-    """ Ends the process, returns the canonical trace and also writes the 
-    full process output to a file, along with the command used to start the process"""
+def streamTrace(name, processInfo, canonicalizer, fulltrace_filename = None):
+    """ Yields the canonical trace of the process while it's running, and also writes the
+    full process output to a file, along with the command used to start the process.
 
-    process = processInfo['proc']
+    The output is canonicalized (and written to file) line by line, so the full output is
+    never held in memory. Closing the generator stops the process"""
 
     extraTime = False
     if name == "py":
         extraTime = True
 
-    outp = VMUtils.finishProc(processInfo['proc'], extraTime, processInfo['output'])
-
-    if fulltrace_filename is not None:
+    outp = VMUtils.streamProc(processInfo['proc'], extraTime, processInfo['output'])
+    try:
+        if fulltrace_filename is None:
+            yield from canonicalizer(outp)
+            return
         #logging.info("Writing %s full trace to %s" % (name, fulltrace_filename))
         with open(fulltrace_filename, "w+") as f: 
             f.write("# command\n")
             f.write("# %s\n\n" % processInfo['cmd'])
-            f.write("\n".join(outp))
+            yield from canonicalizer(tee(outp, f))
+    finally:
+        outp.close()
 
-    canon_text = [toText(step) for step in canonicalizer(outp)]
-    logging.info("Processed %s steps for %s" % (len(canon_text), name))
-    return canon_text
+def finishProc(name, processInfo, canonicalizer, fulltrace_filename = None):
+    """ Ends the process, returns the canonical trace and also writes the 
+    full process output to a file, along with the command used to start the process"""
+
+    canon_trace = list(streamTrace(name, processInfo, canonicalizer, fulltrace_filename))
+    logging.info("Processed %s steps for %s" % (len(canon_trace), name))
+    return canon_trace
+
+def tee(lines, f):
+    """ Passes the lines through, while writing them to f """
+    for line in lines:
+        f.write(line)
+        f.write("\n")
+        yield line
 
 def get_summary(combined_trace, n=20):
     """Returns (up to) n (default 20) preceding steps before the first diff, and the diff-section
@@ -561,6 +583,7 @@ def perform_test(testfile, test_name, test_number = 0):
     logger.info("file: %s, test name %s " % (testfile,test_name))
 
     pass_count = 0
+    truncated_count = 0
     failures = []
     fork_name        = cfg['FORK_CONFIG']
     clients          = cfg['DO_CLIENTS']
@@ -571,7 +594,7 @@ def perform_test(testfile, test_name, test_number = 0):
         prestate, txs_dgv = convertGeneralTest(testfile, fork_name)
     except Exception as e:
         logger.warn("problem with test file, skipping.")
-        return (test_number, fail_count, pass_count, failures)
+        return (test_number, len(failures), pass_count, failures, truncated_count)
 
 #    logger.info("prestate: %s", prestate)
     logger.debug("txs: %s", txs_dgv)
@@ -598,6 +621,7 @@ def perform_test(testfile, test_name, test_number = 0):
 
 
         clients_canon_traces = []
+        client_names = []
         procs = []
 
         canonicalizers = {
@@ -628,26 +652,33 @@ def perform_test(testfile, test_name, test_number = 0):
             procs.append( (procinfo, client_name ))
 
         traceFiles = []
-        # Read the outputs
+        # Read the outputs, all clients are compared while they're running
         for (procinfo, client_name) in procs:
             if procinfo['proc'] is None:
                 continue
 
             canonicalizer = canonicalizers[client_name]
             full_trace_filename = os.path.abspath("%s/%s-%s.trace.log" % (cfg['LOGS_PATH'],test_id, client_name))
-            traceFiles.append(full_trace_filename)
-            canon_trace = finishProc(client_name, procinfo, canonicalizer, full_trace_filename)
-            clients_canon_traces.append(canon_trace)
+            traceFiles.append((full_trace_filename, canonicalizer))
+            clients_canon_traces.append(streamTrace(client_name, procinfo, canonicalizer, full_trace_filename))
+            client_names.append(client_name)
+
+        (verdict, trace_summary) = VMUtils.trace_verdict(clients_canon_traces, client_names, max_steps=cfg['STEP_BUDGET'])
 
-        (equivalent, trace_output) = VMUtils.compare_traces(clients_canon_traces, clients) 
+        # Once there's a verdict, the rest of the traces is not needed: stop the clients still running
+        for canon_trace in clients_canon_traces:
+            canon_trace.close()
 
-        if equivalent:
+        if verdict != VMUtils.DIVERGED:
             #delete non-failed traces
-            for f in traceFiles:
+            for (f, _) in traceFiles:
                 os.remove(f)
 
             pass_count += 1
             passfail = 'PASS'
+            if verdict == VMUtils.TRUNCATED:
+                logger.info("Test %s truncated after %d steps" % (test_id, cfg['STEP_BUDGET']))
+                truncated_count += 1
         else:
             logger.warning("CONSENSUS BUG!!!")
             failures.append(test_name)
@@ -656,7 +687,11 @@ def perform_test(testfile, test_name, test_number = 0):
             statetest_filename = "%s/%s-test.json" %(cfg['LOGS_PATH'], test_id)
             os.rename(test_tmpfile,statetest_filename)
 
-            # save combined trace
+            # save combined trace, the trace files were cut off shortly after the diff
+            def readTrace(filename, canonicalizer):
+                with open(filename) as f:
+                    yield from canonicalizer(f)
+            (_, trace_output) = VMUtils.compare_traces([readTrace(f, c) for (f, c) in traceFiles], client_names)
             passfail = 'FAIL'
             passfail_log_filename = "%s/%s-%s.log.txt" % ( cfg['LOGS_PATH'], passfail,test_id)
             with open(passfail_log_filename, "w+") as f:
@@ -664,14 +699,13 @@ def perform_test(testfile, test_name, test_number = 0):
                 f.write("\n".join(trace_output))
 
             # save a summary of the trace, with up to 20 steps preceding the first diff
-            trace_summary = get_summary(trace_output)
             summary_log_filename = "%s/%s-%s.summary.txt" % ( cfg['LOGS_PATH'], passfail,test_id)
             with open(summary_log_filename, "w+") as f:
                 logger.info("Summary trace: %s" , summary_log_filename)
                 f.write("\n".join(trace_summary))
 
 
-    return (test_number, len(failures), pass_count, failures)
+    return (test_number, len(failures), pass_count, failures, truncated_count)
 
 """
 ## need to get redirect_stdout working for the python-afl fuzzer
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+Converts client traces into the binary evmlab trace format
+
+    python3 traceconvert.py -c parity trace1.log trace2.log
+
+"""
+import logging
+from evmlab import tracefile
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(filename)s - %(funcName)20s() ][%(levelname)8s] %(message)s',
+                        level=logging.INFO)
+    tracefile.main()